@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import time
+import numpy
+import reflect
+
+
+
+class NoiseVideoClip(reflect.core.clips.VideoClip):
+  """NoiseVideoClip(seed, size, frameCount)
+
+  A stand-in for a loaded video, so that the benchmarks don't depend on any media files. Each frame
+  is a shifted copy of the same pseudorandom image, which is cheap to produce (like decoding).
+  """
+
+  def __init__(self, seed, size, frameCount):
+    super().__init__("noise:{}".format(seed), reflect.core.clips.VideoClipMetadata(size = size, frameCount = frameCount, fps = 30))
+    self._image = numpy.random.RandomState(seed).randint(0, 256, (size[1], size[0], 3)).astype(numpy.uint8)
+
+  def _framegen(self, n):
+    return numpy.roll(self._image, n, axis = 1)
+
+class StillVideoClip(reflect.core.clips.VideoClip):
+  """StillVideoClip(image)
+
+  A clip whose every frame is `image` itself, so that timing an effect over it leaves out the
+  source.
+  """
+
+  def __init__(self, image):
+    super().__init__("still", reflect.core.clips.VideoClipMetadata(size = (image.shape[1], image.shape[0]), frameCount = 1, fps = 30))
+    self._image = image
+
+  def _framegen(self, n):
+    return self._image
+
+@reflect.core.clips.clipMethod
+def still(image):
+  return StillVideoClip(image)
+
+@reflect.core.clips.clipMethod
+def noise(seed = 0, size = (1280, 720), frameCount = 60):
+  return NoiseVideoClip(seed, size, frameCount)
+
+
+
+def session(cache, script):
+  # Run `script` as the server would run a user script, and return the clip that it previews
+  reflect.CompositionGraph.reset()
+  cache.userScriptIsRunning = True
+  leaf = script()
+  cache.userScriptIsRunning = False
+  cache.reprioritise(reflect.CompositionGraph.current())
+  cache.commit()
+  return leaf
+
+
+
+def benchmarkCache(algorithms, cacheSize, loops):
+  """benchmarkCache(algorithms, cacheSize, loops)
+
+  Compare cache algorithms on an edit-and-preview workload modelled on the eval scripts: the
+  previewed clip overlays an expensive clip (a large gaussian blur) on a cheap one (a brighten), and
+  the overlay is then moved a few times, so that frames of both sources can be reused across edits.
+  Each version of the script is played through `loops` times.
+  """
+
+  def script(offset):
+    def run():
+      x = noise()
+      return x.brighten(0.2).composite(x.gaussianBlur(41).crop(x1 = 0, y1 = 0, x2 = 640, y2 = 720), x1 = offset, y1 = 0)
+    return run
+
+  print("{:>12} {:>10} {:>10} {:>10} {:>10}".format("algorithm", "time (s)", "hits", "misses", "hit ratio"))
+  for algorithm in algorithms:
+    cache = reflect.cache.cacheAlgorithms[algorithm](cacheSize, enableStatistics = True)
+    reflect.Cache.current().swap(cache)
+
+    t1 = time.perf_counter()
+    for offset in [0, 100, 200, 300]:
+      leaf = session(cache, script(offset))
+      for i in range(loops):
+        for n in range(leaf.frameCount):
+          leaf.frame(n)
+    t2 = time.perf_counter()
+
+    hits = cache._stats["hits"]
+    misses = cache._stats["misses"]["compulsory"] + cache._stats["misses"]["noncompulsory"]
+    print("{:>12} {:>10} {:>10} {:>10} {:>10}".format(algorithm, round(t2 - t1, 2), hits, misses, round(hits / max(hits + misses, 1), 3)))
+
+
+
+def benchmarkBranches(workerCounts, frameCount):
+  """benchmarkBranches(workerCounts, frameCount)
+
+  Measure the latency of rendering a frame of a composite of two blurred 4K sources, with the
+  sources rendered one after the other (0 workers) or concurrently by a BranchExecutor. Every frame
+  is a cache miss, as when scrubbing through a newly edited clip.
+  """
+
+  def script():
+    bg = noise(1, size = (3840, 2160), frameCount = frameCount).gaussianBlur(41)
+    fg = noise(2, size = (3840, 2160), frameCount = frameCount).gaussianBlur(41).crop(x1 = 0, y1 = 0, x2 = 1920, y2 = 1080)
+    return bg.composite(fg, x1 = 960, y1 = 540)
+
+  print("{:>12} {:>16} {:>10}".format("workers", "latency (ms)", "speedup"))
+  baseline = None
+  for workerCount in workerCounts:
+    reflect.BranchExecutor.swap(reflect.BranchExecutor(workerCount)).close()
+    cache = reflect.SpecialisedCache(4 * 3840 * 2160 * 3)
+    reflect.Cache.current().swap(cache)
+    leaf = session(cache, script)
+
+    latencies = []
+    for n in range(leaf.frameCount):
+      t1 = time.perf_counter()
+      leaf.frame(n)
+      t2 = time.perf_counter()
+      latencies.append(t2 - t1)
+    latency = sorted(latencies)[len(latencies) // 2]
+    if baseline is None:
+      baseline = latency
+    print("{:>12} {:>16} {:>10}".format(workerCount, round(latency * 1000, 1), round(baseline / latency, 2)))
+
+
+
+def benchmarkKernels(resolutions, loops):
+  """benchmarkKernels(resolutions, loops)
+
+  Measure the time that brighten (a 256-entry LUT) and greyscale (cv2.cvtColor) take to render a
+  frame at each resolution, compared with the float64 arithmetic that they used before. The source
+  frame is the same every time, so only the effect itself is timed.
+  """
+
+  def floatBrighten(image):
+    result = numpy.empty(image.shape, numpy.uint8)
+    result[...] = image * (1 - 0.3) + (0.3 * 255)
+    return result
+
+  def floatGreyscale(image):
+    grey = numpy.dot(image[:, :, :3], [0.299, 0.587, 0.114]).astype(numpy.uint8)
+    rgb = numpy.empty(grey.shape + (3,), numpy.uint8)
+    rgb[:, :, 2] = rgb[:, :, 1] = rgb[:, :, 0] = grey
+    return rgb
+
+  def timePerFrame(f, image):
+    f(image) # Warm up (e.g. the frame pool)
+    t1 = time.perf_counter()
+    for i in range(loops):
+      f(image)
+    t2 = time.perf_counter()
+    return (t2 - t1) / loops
+
+  reflect.setMode("normal") # Render without the cache, so that every frame is rendered again
+
+  print("{:>12} {:>18} {:>14} {:>14} {:>10}".format("resolution", "effect", "float64 (ms)", "kernel (ms)", "speedup"))
+  for (width, height) in resolutions:
+    image = noise(size = (width, height), frameCount = 1).frame(0)
+    x = still(image)
+    effects = [
+      ("brighten", floatBrighten, x.brighten(0.3)),
+      ("greyscale", floatGreyscale, x.greyscale()),
+      ("greyscale (lazy)", floatGreyscale, x.greyscale(lazy = True)),
+    ]
+    for name, before, clip in effects:
+      t1 = timePerFrame(before, image)
+      t2 = timePerFrame(lambda image: clip.frame(0), image)
+      print("{:>12} {:>18} {:>14} {:>14} {:>10}".format("{}x{}".format(width, height), name, round(t1 * 1000, 2), round(t2 * 1000, 2), round(t1 / t2, 1)))
+
+
+
+def main():
+  reflect.setMode("server")
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("benchmark", choices = ["cache", "branches", "kernels"], help = "The benchmark to run.")
+  parser.add_argument("-a", "--algorithms", nargs = "+", default = ["specialised", "lru", "cost"], help = "The caching algorithms to compare.")
+  parser.add_argument("-m", "--cacheSize", required = False, default = 300, help = "The maximum size, in MiB, of the cache. Default is 300 MiB.")
+  parser.add_argument("-w", "--workers", nargs = "+", default = [0, 2], help = "The numbers of threads with which to render independent branches, for the branches benchmark.")
+  parser.add_argument("-n", "--frameCount", required = False, default = 20, help = "The number of frames to render in the branches benchmark. Default is 20.")
+  parser.add_argument("-l", "--loops", required = False, default = None, help = "The number of times to play through each version of the script (default 2), or to render each frame in the kernels benchmark (default 20).")
+  args = parser.parse_args()
+
+  if args.benchmark == "cache":
+    benchmarkCache(args.algorithms, int(args.cacheSize) * 1024 * 1024, int(args.loops or 2))
+  elif args.benchmark == "branches":
+    benchmarkBranches([int(w) for w in args.workers], int(args.frameCount))
+  elif args.benchmark == "kernels":
+    benchmarkKernels([(1280, 720), (1920, 1080), (3840, 2160)], int(args.loops or 20))
+
+
+
+if __name__ == "__main__":
+  main()
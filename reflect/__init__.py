@@ -16,5 +16,8 @@ def setMode(mode):
 def setTransformations(transformations):
   core.clips.transformations = transformations
 
+def setMaxReadersPerFile(count):
+  core.roots.load.maxReadersPerFile = count
+
 def setVisualiseFilepath(filepath):
   cache.visualiseFilepath = filepath
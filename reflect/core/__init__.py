@@ -2,5 +2,7 @@
 
 from .util import CompositionGraph
 from .clips import Clip, VideoClip
+from .pool import FramePool
+from .executor import BranchExecutor
 
 from .vfx import all
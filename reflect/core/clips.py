@@ -6,12 +6,20 @@ import imageio
 import os
 import inspect
 import time
+import hashlib
+import threading
+import collections
+import numpy
 
 mode = "normal" # "normal" or "server"
-transformations = ["CanonicalOrder", "FlattenConcats"]
+transformations = ["CanonicalOrder", "FlattenConcats", "FlattenComposites", "FusePointwise"]
 
 clipConstructionCounter = [0] # Used for ordering clips by the time at which they were constructed
 
+# For each thread, a stack holding the time spent rendering source frames by each _framegen call in
+# progress, so that a clip's own render time can be told apart from that of its sources
+renderTimers = threading.local()
+
 
 
 class Clip(object):
@@ -76,6 +84,31 @@ class Clip(object):
 
 
 
+def ffmpegExecutable():
+  # The ffmpeg binary that imageio uses (bundled with imageio-ffmpeg by newer versions of imageio)
+  try:
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+  except ImportError:
+    return imageio.plugins.ffmpeg.get_exe()
+
+
+
+def _renderSegment(pickledClip, start, stop, options, batchSize):
+  # Runs in a worker process of VideoClip.save(..., workers = N): encode frames `start` to `stop` of
+  # the pickled clip with a writer created from `options`
+  import pickle
+  global mode
+  mode = "normal" # The worker has no cache of its own, and can't use the server's
+  clip = pickle.loads(pickledClip)
+  writer = imageio.get_writer(**options)
+  try:
+    clip._writeFrames(writer, batchSize, start, stop)
+  finally:
+    writer.close()
+
+
+
 def memoizeHash(f):
   """@memoizeHash
 
@@ -152,6 +185,8 @@ class VideoClip(Clip):
         source._childCount += 1
 
     self._constantImage = None # Used as a local cache when not in server mode
+    self._renderTime = None     # Moving averages of the wall time taken to render a frame, including
+    self._selfRenderTime = None # and excluding the time spent rendering source frames (server mode only)
 
 
 
@@ -171,6 +206,83 @@ class VideoClip(Clip):
 
 
 
+  @property
+  def fingerprint(self):
+    """fingerprint
+
+    A hex digest identifying the structure of this clip: its type, metadata, parameters, and
+    (recursively) its sources. Unlike __hash__, which relies on Python's salted hash(), the
+    fingerprint is stable across processes, so it can be used to key persistent caches.
+    """
+
+    if not hasattr(self, "_fingerprint"):
+      if isinstance(self._source, tuple):
+        source = tuple(s.fingerprint for s in self._source)
+      else:
+        source = self._source
+      description = (type(self).__name__, source, self._metadata.size, self._metadata.frameCount, self._metadata.fps, self._fingerprintParameters())
+      self._fingerprint = hashlib.sha1(repr(description).encode("utf-8")).hexdigest()
+    return self._fingerprint
+
+
+
+  def _fingerprintParameters(self):
+    # Subclasses with parameters should return them as a tuple with a deterministic repr.
+    return ()
+
+
+
+  def __getstate__(self):
+    # Clips are pickled to send them to the worker processes of save(..., workers = N), where only
+    # the clip and its sources are needed, not the graph or the cache that they belong to.
+    # Subclasses that hold OS resources (e.g. readers) should drop them here and reopen them in
+    # __setstate__.
+    state = self.__dict__.copy()
+    state["cacheEntry"] = None
+    state["_constantImage"] = None
+    state.pop("_graph", None)
+    state.pop("indirectionsTakenCareOf", None) # Left over from Cache.reprioritise
+    state.pop("_branchNodes", None) # Ids of clips in this process (see BranchExecutor)
+    state.pop("_memoizedHash", None) # hash() of a str differs between processes
+    return state
+
+
+
+  def _colourStages(self):
+    # Per-pixel colour effects return the stages that they apply to each frame of their source, as
+    # for fuse (e.g. [("lut", lut)] or [("grey",)]), so that CompositionGraph.fusePointwise can
+    # combine consecutive effects into one. Other clips return None.
+    return None
+
+
+
+  def _withSources(self, sources):
+    """_withSources(sources)
+
+    Return a copy of this clip whose sources are replaced by `sources` (which must produce the same
+    frames, e.g. after a graph pass has rewritten them), added to the graph in the same way as a
+    clip returned by a clipMethod.
+    """
+
+    clip = object.__new__(type(self))
+    clip.__dict__.update(VideoClip.__getstate__(self))
+    clip.__dict__.pop("_fingerprint", None)
+    clip._source = tuple(sources)
+    clip._childCount = 0
+    clip._renderTime = None
+    clip._selfRenderTime = None
+    for source in clip._source:
+      source._childCount += 1
+
+    clip._graph = clip._source[0]._graph
+    for source in clip._source:
+      if clip._graph.isLeaf(source):
+        clip._graph.removeLeaf(source)
+    clip._graph.addLeaf(clip)
+    return clip
+
+
+
   @property
   def size(self):
     return self._metadata.size
@@ -202,16 +314,49 @@ class VideoClip(Clip):
 
 
 
+  @property
+  def renderTime(self):
+    """renderTime
+
+    A moving average of the wall time, in seconds, that this clip has taken to render a frame
+    (including the time taken to fetch or render its source frames), or None if no frame has been
+    rendered yet. Only measured in server mode.
+    """
+
+    return self._renderTime
+
+  @property
+  def selfRenderTime(self):
+    """selfRenderTime
+
+    As for renderTime, but excluding the time spent rendering source frames, i.e. the time it would
+    take to render a frame again if its source frames were cached.
+    """
+
+    return self._selfRenderTime
+
+
+
   def _framegen(self, n):
     # _framegen must be implemented in the subclass.
     raise NotImplementedError()
 
 
 
-  def frame(self, n):
+  def frame(self, n, region = None):
+    """frame(n, region = None)
+
+    Returns frame `n` of this clip, or only the part of it inside `region` = (x1, y1, x2, y2) if
+    specified. Clips that implement _framegenRegion render just that part (and request just the
+    parts of their source frames that it depends on), but only whole frames are cached.
+    """
+
     if self._isConstant:
       n = 0 # Redirect the request to be for the first frame only, to avoid rendering/caching the same image multiple times
 
+    if region is not None and region != (0, 0, self.width, self.height):
+      return self._region(n, region)
+
     if mode == "server":
       from reflect.server.cache import Cache
       cache = Cache.current()
@@ -221,9 +366,7 @@ class VideoClip(Clip):
         return image
       else:
         # Render the frame, offer it to the cache, and then return it
-        image = self._framegen(n)
-        cache.set(self, n, image)
-        return image
+        return self._renderForCache(cache, [n], lambda: [self._framegen(n)])[0]
     else:
       # We are not in server mode, so there is no global cache.
       if self._isConstant:
@@ -237,6 +380,161 @@ class VideoClip(Clip):
 
 
 
+  def _framegenRegion(self, n, region):
+    # Subclasses may override this to render only the part (x1, y1, x2, y2) of frame n, e.g. by
+    # requesting only the corresponding parts of their source frames. By default the whole frame is
+    # rendered (and cached, as usual) and then sliced.
+    (x1, y1, x2, y2) = region
+    return self.frame(n)[y1:y2, x1:x2]
+
+
+
+  def _rendersRegions(self):
+    # Whether rendering part of a frame of this clip takes less work than rendering the whole frame.
+    # Clips that only pass regions through to their source (e.g. subclip) should defer to it.
+    return type(self)._framegenRegion is not VideoClip._framegenRegion
+
+
+
+  def _region(self, n, region):
+    (x1, y1, x2, y2) = region
+    if type(self)._framegenRegion is VideoClip._framegenRegion:
+      return self._framegenRegion(n, region)
+
+    # Use the whole frame if it has already been rendered
+    if mode == "server":
+      from reflect.server.cache import Cache
+      image = Cache.current().get(self, n, None)
+      if image is not None:
+        return image[y1:y2, x1:x2]
+    elif self._constantImage is not None:
+      return self._constantImage[y1:y2, x1:x2]
+
+    # Parts of frames aren't cached, so the requesting clip would have to render this part again to
+    # render its frame again. The time spent on it therefore isn't counted as time spent rendering
+    # sources (see frame), and it is part of the requesting clip's self render time.
+    return self._framegenRegion(n, region)
+
+
+
+  def _framegenBatch(self, ns):
+    # Subclasses may override this to render the frames at the indices `ns` in one go, e.g. by
+    # vectorising over the frames or by remapping the indices for their source, and return them
+    # stacked into an (N, height, width, 3) array. By default each frame is rendered separately.
+    first = self._framegen(ns[0])
+    result = numpy.empty((len(ns),) + first.shape, dtype = first.dtype)
+    result[0] = first
+    for i in range(1, len(ns)):
+      result[i] = self._framegen(ns[i])
+    return result
+
+
+
+  def frames(self, start = 0, stop = None):
+    """frames(start = 0, stop = None)
+
+    Returns frames `start` (inclusive) to `stop` (exclusive, by default the end of the clip) stacked
+    into an array of shape (N, height, width, 3). This gives the same images as calling frame(n) for
+    each n, but effects that implement _framegenBatch render the whole range in one call.
+    """
+
+    if stop is None:
+      stop = self.frameCount
+    if start < 0 or stop > self.frameCount or start > stop:
+      raise IndexError("received a request for frames {} to {}, but this clip contains {} frames".format(start, stop, self.frameCount))
+
+    return self._frames(range(start, stop))
+
+
+
+  def _frames(self, ns):
+    # As for frames, but for any sequence of frame indices. Sources are fetched with this method so
+    # that batches propagate down the composition graph.
+    ns = list(ns)
+    if len(ns) == 0:
+      return numpy.empty((0, self.height, self.width, 3), dtype = numpy.uint8)
+
+    if self._isConstant:
+      image = self.frame(0)
+      return numpy.repeat(image[numpy.newaxis], len(ns), axis = 0)
+
+    if mode != "server":
+      return self._framegenBatch(ns)
+
+    from reflect.server.cache import Cache
+    cache = Cache.current()
+    images = [cache.get(self, n, None) for n in ns]
+    missing = list(collections.OrderedDict.fromkeys(n for n, image in zip(ns, images) if image is None))
+    if len(missing) == 0:
+      return numpy.stack(images)
+
+    # Render the missing frames in one batch, and offer each of them to the cache
+    batch = self._renderForCache(cache, missing, lambda: self._framegenBatch(missing))
+    rendered = dict(zip(missing, batch))
+
+    if len(missing) == len(ns):
+      return batch
+    return numpy.stack([image if image is not None else rendered[n] for n, image in zip(ns, images)])
+
+
+
+  def _renderForCache(self, cache, ns, render):
+    # In server mode, render frames `ns` with render(), which returns them in order, and offer each
+    # of them to `cache`. The time taken is recorded as this clip's render time, shared equally
+    # between the frames, and is added to the time that the clip requesting these frames (if any)
+    # spent rendering its sources.
+    if not hasattr(renderTimers, "stack"):
+      renderTimers.stack = []
+    renderTimers.stack.append(0.0)
+    t1 = time.perf_counter()
+    try:
+      images = render()
+    finally:
+      elapsed = time.perf_counter() - t1
+      sourceTime = renderTimers.stack.pop()
+      if renderTimers.stack:
+        renderTimers.stack[-1] += elapsed
+
+    renderTime = elapsed / len(ns)
+    selfRenderTime = (elapsed - sourceTime) / len(ns)
+    self._recordRenderTime(renderTime, selfRenderTime)
+    for n, image in zip(ns, images):
+      cache.rendered(self, n, image, renderTime, selfRenderTime)
+      cache.set(self, n, image)
+    return images
+
+
+
+  def _frameBatches(self, batchSize, start = 0, stop = None):
+    # Yield frames `start` to `stop` (by default, all of them) of this clip in order, stacked into
+    # batches of up to `batchSize` frames. The batches are contiguous, as writers expect, even if
+    # the frames are views (e.g. of a lazy greyscale clip).
+    if stop is None:
+      stop = self.frameCount
+    for batchStart in range(start, stop, batchSize):
+      yield numpy.ascontiguousarray(self.frames(batchStart, min(batchStart + batchSize, stop)))
+
+
+
+  def _writeFrames(self, writer, batchSize, start = 0, stop = None):
+    # Append frames `start` to `stop` (by default, all of them) of this clip to `writer`, rendering
+    # them in batches of up to `batchSize` frames
+    for images in self._frameBatches(batchSize, start, stop):
+      for im in images:
+        writer.append_data(im)
+
+
+
+  def _recordRenderTime(self, renderTime, selfRenderTime):
+    if self._renderTime is None:
+      self._renderTime = renderTime
+      self._selfRenderTime = selfRenderTime
+    else:
+      self._renderTime = 0.75 * self._renderTime + 0.25 * renderTime
+      self._selfRenderTime = 0.75 * self._selfRenderTime + 0.25 * selfRenderTime
+
+
+
   def save(self, filepath, **kwargs):
     saveMethod = None
 
@@ -312,14 +610,74 @@ class VideoClip(Clip):
     if "ffmpegParams" in kwargs:
       options["ffmpeg_params"].extend(kwargs["ffmpegParams"])
 
+    if kwargs.get("workers", 1) > 1 and self.frameCount > 1:
+      self._saveVideoInParallel(filepath, options, kwargs["workers"], kwargs.get("batchSize", 16))
+      return
+
     writer = imageio.get_writer(**options)
-    for i in range(0, self.frameCount):
-      im = self.frame(i)
-      writer.append_data(im)
+    self._writeFrames(writer, kwargs.get("batchSize", 16))
     writer.close()
 
 
 
+  def _saveVideoInParallel(self, filepath, options, workers, batchSize):
+    """_saveVideoInParallel(filepath, options, workers, batchSize)
+
+    Split the frames of this clip into `workers` contiguous segments, render and encode each segment
+    in its own process, and then join the segments into `filepath` with ffmpeg's concat demuxer,
+    which copies the encoded streams rather than re-encoding them.
+
+    The clip (and its sources) are pickled once and sent to the workers, which reopen any readers.
+    Clips that can't be pickled (e.g. instances of a class defined in a script) are saved in this
+    process instead.
+
+    The workers are started afresh (by a fork server, or by spawning) rather than forked from this
+    process, since other threads (e.g. the prefetcher, or the branch executor) may be holding locks
+    of the cache, the frame pool or a reader, which a forked worker would inherit, held forever.
+    """
+
+    import pickle
+    import multiprocessing
+    import subprocess
+    import tempfile
+
+    try:
+      pickledClip = pickle.dumps(self)
+    except Exception as e:
+      logging.warn("Saving {} in a single process, because the clip can't be sent to other processes ({})".format(filepath, e))
+      writer = imageio.get_writer(**options)
+      self._writeFrames(writer, batchSize)
+      writer.close()
+      return
+
+    segmentCount = min(workers, self.frameCount)
+    bounds = [self.frameCount * i // segmentCount for i in range(segmentCount + 1)]
+    extension = os.path.splitext(filepath)[1]
+
+    with tempfile.TemporaryDirectory(prefix = "reflect-") as directory:
+      segmentFilepaths = []
+      jobs = []
+      for i in range(segmentCount):
+        segmentOptions = dict(options, uri = os.path.join(directory, "segment{}{}".format(i, extension)))
+        segmentFilepaths.append(segmentOptions["uri"])
+        jobs.append((pickledClip, bounds[i], bounds[i + 1], segmentOptions, batchSize))
+
+      startMethod = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+      pool = multiprocessing.get_context(startMethod).Pool(segmentCount)
+      try:
+        pool.starmap(_renderSegment, jobs)
+      finally:
+        pool.close()
+        pool.join()
+
+      listFilepath = os.path.join(directory, "segments.txt")
+      with open(listFilepath, "w") as f:
+        for segmentFilepath in segmentFilepaths:
+          f.write("file '{}'\n".format(segmentFilepath.replace("'", "'\\''")))
+      subprocess.check_call([ffmpegExecutable(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listFilepath, "-c", "copy", filepath])
+
+
+
   def _saveGif(self, filepath, **kwargs):
     options = {
       "uri": filepath,
@@ -360,22 +718,23 @@ class VideoClip(Clip):
       options["subrectangles"] = False
 
     writer = imageio.get_writer(**options)
-    for i in range(0, self.frameCount):
-      im = self.frame(i)
-      writer.append_data(im)
+    self._writeFrames(writer, kwargs.get("batchSize", 16))
     writer.close()
 
 
 
   def _saveImage(self, filepath, **kwargs):
     import math
-    for i in range(0, self.frameCount):
-      uri = "{0}_{1:0>{width}}.png".format(
-        os.path.splitext(filepath)[0],
-        i,
-        width = math.floor(math.log10(self.frameCount)) + 1
-      )
-      imageio.imwrite(uri, self.frame(i))
+    i = 0
+    for images in self._frameBatches(kwargs.get("batchSize", 16)):
+      for im in images:
+        uri = "{0}_{1:0>{width}}.png".format(
+          os.path.splitext(filepath)[0],
+          i,
+          width = math.floor(math.log10(self.frameCount)) + 1
+        )
+        imageio.imwrite(uri, im)
+        i += 1
 
 
 
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+class BranchExecutor(object):
+  """BranchExecutor(workerCount)
+
+  Renders the source frames of a clip with several sources (e.g. a composite, or a slide
+  transition) concurrently, on a pool of `workerCount` threads shared by every clip. The expensive
+  operations underneath (e.g. cv2's GaussianBlur, resize and blur, and decoding) release the GIL,
+  so independent branches of the composition graph can run on separate cores.
+
+  Only branches that have no clips in common are rendered concurrently, since otherwise both
+  branches could miss the cache for the same frame and render it twice. Branches that are known to
+  be cheap (see `minimumRenderTime`) are rendered inline, as are all branches if `workerCount` is 0.
+
+  While a thread waits for a branch that hasn't started yet, it renders the branch itself, so
+  nested composites can't deadlock the pool by waiting for each other.
+
+  At any point in time, there is exactly one active executor, accessible via the static `current`
+  method.
+  """
+
+
+
+  @staticmethod
+  def current():
+    return globals()["currentExecutor"]
+
+
+
+  @staticmethod
+  def swap(newExecutor):
+    """swap(newExecutor)
+
+    Set the current global executor to `newExecutor`, and return the old executor.
+    """
+
+    oldExecutor = globals()["currentExecutor"]
+    globals()["currentExecutor"] = newExecutor
+    return oldExecutor
+
+
+
+  @staticmethod
+  def branchOf(clip):
+    # Return the ids of the clips in the subgraph rooted at `clip`, i.e. the clip and its sources
+    nodes = clip.__dict__.get("_branchNodes", None)
+    if nodes is None:
+      nodes = { id(clip) }
+      if isinstance(clip._source, tuple):
+        for source in clip._source:
+          nodes |= BranchExecutor.branchOf(source)
+      nodes = frozenset(nodes)
+      clip._branchNodes = nodes
+    return nodes
+
+
+
+  def __init__(self, workerCount, minimumRenderTime = 0.001):
+    self.workerCount = workerCount
+    self.minimumRenderTime = minimumRenderTime
+
+    self._lock = threading.Lock()
+    self._pool = None # Created when it is first needed
+
+    self.resetStats()
+
+
+
+  def _isWorthwhile(self, clips):
+    for clip in clips:
+      renderTime = clip.renderTime
+      if renderTime is not None and renderTime < self.minimumRenderTime:
+        return False
+    return True
+
+
+
+  def _areIndependent(self, clips):
+    seen = set()
+    for clip in clips:
+      nodes = self.branchOf(clip)
+      if not seen.isdisjoint(nodes):
+        return False
+      seen |= nodes
+    return True
+
+
+
+  def frames(self, requests):
+    """frames(requests)
+
+    Return a list of the frames for a list of (clip, n) or (clip, n, region) requests, rendering
+    the clips concurrently if possible. As for VideoClip.frame, a region is (x1, y1, x2, y2).
+    """
+
+    return self.run([(clip, functools.partial(clip.frame, *args)) for (clip, *args) in requests])
+
+
+
+  def run(self, tasks):
+    """run(tasks)
+
+    Return a list of the results of a list of (clip, f) tasks, where f() renders frames (or parts
+    of frames) of `clip`, running the tasks concurrently if possible, as for frames.
+    """
+
+    clips = [clip for (clip, f) in tasks]
+    if self.workerCount <= 0 or len(tasks) < 2 or not self._isWorthwhile(clips) or not self._areIndependent(clips):
+      return [f() for (clip, f) in tasks]
+
+    with self._lock:
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(max_workers = self.workerCount, thread_name_prefix = "Branch")
+      self.concurrentFrames += 1
+
+    # Each branch reports the time it spent rendering (cached) frames, which counts as time spent
+    # rendering sources (see VideoClip.frame). Any other time, such as rendering parts of frames,
+    # which aren't cached, stays part of the requesting clip's self render time.
+    from .clips import renderTimers
+    stack = getattr(renderTimers, "stack", None)
+    sourceTime = stack[-1] if stack else None
+
+    def runHere(f):
+      # Frames rendered on this thread add their time to stack[-1] themselves
+      before = stack[-1] if stack else 0.0
+      result = f()
+      return (result, stack[-1] - before if stack else 0.0)
+
+    futures = [self._pool.submit(self._runBranch, f) for (clip, f) in tasks[1:]]
+    (result, hereTime) = runHere(tasks[0][1])
+    results = [result]
+    branchTimes = []
+    for future, (clip, f) in zip(futures, tasks[1:]):
+      if future.cancel():
+        # No worker has picked up this branch yet, so render it here rather than wait
+        (result, branchTime) = runHere(f)
+        hereTime += branchTime
+      else:
+        (result, branchTime) = future.result()
+        branchTimes.append(branchTime)
+      results.append(result)
+
+    # The branches ran side by side, so only the longest of them counts
+    if sourceTime is not None:
+      stack[-1] = sourceTime + max([hereTime] + branchTimes)
+    return results
+
+
+
+  @staticmethod
+  def _runBranch(f):
+    # Runs on a worker thread. The branch gets its own entry on the worker's render timer stack,
+    # standing in for the requesting clip's entry (see VideoClip.frame), so that it can report the
+    # time it spent rendering frames.
+    from .clips import renderTimers
+    if not hasattr(renderTimers, "stack"):
+      renderTimers.stack = []
+    renderTimers.stack.append(0.0)
+    try:
+      result = f()
+    finally:
+      branchTime = renderTimers.stack.pop()
+    return (result, branchTime)
+
+
+
+  def close(self):
+    with self._lock:
+      if self._pool is not None:
+        self._pool.shutdown(wait = False)
+        self._pool = None
+
+
+
+  def stats(self):
+    return "Branch executor: {} workers / {} frames rendered concurrently".format(self.workerCount, self.concurrentFrames)
+
+
+
+  def resetStats(self):
+    self.concurrentFrames = 0
+
+
+
+# Initialise an executor with a worker for each core (up to 4)
+currentExecutor = BranchExecutor(min(os.cpu_count() or 1, 4))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import weakref
+import numpy
+
+
+
+class FramePool(object):
+  """FramePool(maxSize)
+
+  A pool of reusable frame buffers, from which _framegen implementations can allocate their
+  output frames (see `empty` and `copy`), so that rendering at playback rate doesn't keep
+  allocating and freeing multi-megabyte blocks.
+
+  Buffers are grouped into size classes, so a frame may be backed by a slightly larger buffer.
+  When the cache evicts a frame, it releases the frame's buffer back to the pool. The buffer can't
+  be reused straight away, because the frame (or a view of it) may still be referenced elsewhere,
+  e.g. by the preview window; instead, released buffers are only reused once nothing else refers
+  to them. At most `maxSize` bytes of released buffers are kept.
+
+  At any point in time, there is exactly one active pool, accessible via the static `current`
+  method.
+  """
+
+
+
+  @staticmethod
+  def current():
+    return globals()["currentPool"]
+
+
+
+  @staticmethod
+  def swap(newPool):
+    """swap(newPool)
+
+    Set the current global pool to `newPool`, and return the old pool.
+    """
+
+    oldPool = globals()["currentPool"]
+    globals()["currentPool"] = newPool
+    return oldPool
+
+
+
+  @staticmethod
+  def sizeClassOf(nbytes):
+    # Round up to the next multiple of 1/16 of the enclosing power of two (wasting under 6.25%)
+    step = 1 << max((max(nbytes, 2) - 1).bit_length() - 4, 0)
+    return ((nbytes + step - 1) // step) * step
+
+
+
+  def __init__(self, maxSize):
+    self.maxSize = maxSize
+
+    self._lock = threading.Lock()
+    self._released = {}                          # size class → list of released buffers
+    self._issued = weakref.WeakValueDictionary() # id(buffer) → buffer, for buffers from this pool
+    self._currentSize = 0
+
+    self.resetStats()
+
+
+
+  @property
+  def currentSize(self):
+    return self._currentSize
+
+
+
+  def empty(self, shape, dtype = numpy.uint8):
+    """empty(shape, dtype = numpy.uint8)
+
+    Like numpy.empty, but the returned array may reuse the buffer of a released frame.
+    """
+
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    sizeClass = self.sizeClassOf(nbytes)
+
+    buffer = None
+    with self._lock:
+      released = self._released.get(sizeClass, None)
+      if released:
+        for i in range(len(released)):
+          # released[i] is referenced only by the list and by getrefcount's argument iff nothing
+          # else (e.g. a view) still refers to it
+          if sys.getrefcount(released[i]) <= 2:
+            buffer = released.pop(i)
+            self._currentSize -= sizeClass
+            self.reuses += 1
+            break
+      if buffer is None:
+        buffer = numpy.empty(sizeClass, dtype = numpy.uint8)
+        self._issued[id(buffer)] = buffer
+        self.allocations += 1
+
+    return buffer[:nbytes].view(dtype).reshape(shape)
+
+
+
+  def copy(self, image):
+    """copy(image)
+
+    Like numpy.copy, but the returned array may reuse the buffer of a released frame.
+    """
+
+    result = self.empty(image.shape, image.dtype)
+    numpy.copyto(result, image)
+    return result
+
+
+
+  def release(self, buffer):
+    """release(buffer)
+
+    Offer `buffer` (the object that owns a frame's memory, as found by BufferLedger.ownerOf) back
+    to the pool, e.g. because the cache has discarded the frame. Buffers that didn't come from this
+    pool are ignored.
+    """
+
+    with self._lock:
+      if self._issued.get(id(buffer), None) is not buffer:
+        return
+      sizeClass = buffer.nbytes
+      if self._currentSize + sizeClass > self.maxSize:
+        return
+      released = self._released.setdefault(sizeClass, [])
+      if any(b is buffer for b in released):
+        return
+      released.append(buffer)
+      self._currentSize += sizeClass
+      self.releases += 1
+
+
+
+  def clear(self):
+    with self._lock:
+      self._released = {}
+      self._currentSize = 0
+
+
+
+  def stats(self):
+    return "Frame pool: {} allocated / {} reused / {} released / {} MiB held".format(self.allocations, self.reuses, self.releases, round(self._currentSize / 1024 / 1024, 1))
+
+
+
+  def resetStats(self):
+    self.allocations = 0
+    self.reuses = 0
+    self.releases = 0
+
+
+
+# Initialise an empty pool
+currentPool = FramePool(64 * 1024 * 1024) # 64 MiB
@@ -2,14 +2,200 @@
 
 from ..clips import VideoClip, VideoClipMetadata, ImageClip, clipMethod, memoizeHash
 import os
+import time
 import imageio
-import collections
+import threading
 
 
 
-# Keeps track of open readers
-openReaders = {}
-readyReaders = {}
+# The maximum number of readers that a ReaderPool keeps open for each file
+maxReadersPerFile = 4
+
+# Keeps track of the reader pools of the files loaded in the current session, and of those from the
+# previous session that haven't been claimed yet
+openPools = {}
+readyPools = {}
+
+
+
+class ReaderPool(object):
+  """ReaderPool(filepath, maxReaders = 4, openReader = imageio.get_reader)
+
+  A pool of up to `maxReaders` readers of the file at `filepath`, opened with `openReader` when
+  needed. Seeking is expensive for a video reader, since it has to start decoding again from a
+  keyframe, so each request for a frame goes to the idle reader that can reach it by decoding the
+  fewest frames forwards, i.e. the reader that last read that frame or one just behind it. If every
+  idle reader would have to seek, another reader is opened (unless the pool is full, in which case
+  the reader that was used least recently seeks). This way, clips that read the same file at
+  far-apart positions (e.g. a composite of two subclips of it) each keep their own reader, rather
+  than making a single reader seek back and forth on every frame.
+
+  The pool counts the seeks and the time spent decoding; see `stats`.
+  """
+
+
+
+  # Like imageio's ffmpeg reader, assume that decoding forwards up to this many frames is cheaper
+  # than seeking
+  seekThreshold = 100
+
+
+
+  def __init__(self, filepath, maxReaders = 4, openReader = imageio.get_reader):
+    self.filepath = filepath
+    self.maxReaders = maxReaders
+    self._openReader = openReader
+
+    self._condition = threading.Condition()
+    self._idle = []         # [reader, position, last use], where position is the last frame read
+    self._readerCount = 0
+    self._useCount = 0
+    self._closed = False
+
+    # Open the first reader straight away, so that the file's format and metadata are known
+    reader = openReader(filepath)
+    self._idle.append([reader, -1, 0])
+    self._readerCount = 1
+    self.format = reader.format
+    self._metadata = reader.get_meta_data()
+
+    self.resetStats()
+
+
+
+  def get_meta_data(self):
+    return self._metadata
+
+
+
+  def _distance(self, position, n):
+    # Return the number of frames that a reader that last read frame `position` has to decode to
+    # read frame n, or None if it has to seek
+    if position <= n <= position + self.seekThreshold:
+      return n - position
+    return None
+
+
+
+  def _acquire(self, n):
+    # Check out the best reader for frame n, waiting for one to become idle if the pool is full
+    with self._condition:
+      while True:
+        if self._closed:
+          raise ValueError("The readers of \"{}\" have been closed.".format(self.filepath))
+
+        best = None
+        for entry in self._idle:
+          distance = self._distance(entry[1], n)
+          if distance is not None and (best is None or distance < self._distance(best[1], n)):
+            best = entry
+        if best is None and self._readerCount < self.maxReaders:
+          # Open another reader rather than move one away from where it is reading
+          self._readerCount += 1
+          break
+        if best is None and self._idle:
+          best = min(self._idle, key = lambda entry: entry[2])
+        if best is not None:
+          self._idle.remove(best)
+          return best
+        self._condition.wait()
+
+    try:
+      reader = self._openReader(self.filepath)
+    except Exception:
+      with self._condition:
+        self._readerCount -= 1
+        self._condition.notify()
+      raise
+    return [reader, -1, 0]
+
+
+
+  def _release(self, entry):
+    with self._condition:
+      if self._closed:
+        entry[0].close()
+        return
+      self._useCount += 1
+      entry[2] = self._useCount
+      self._idle.append(entry)
+      self._condition.notify()
+
+
+
+  def get_data(self, n):
+    """get_data(n)
+
+    Return frame n of the file, as imageio's Reader.get_data does, reading it with whichever reader
+    is closest to it.
+    """
+
+    entry = self._acquire(n)
+    try:
+      seeked = self._distance(entry[1], n) is None
+      t1 = time.perf_counter()
+      image = entry[0].get_data(n)
+      t2 = time.perf_counter()
+      entry[1] = n
+    except Exception:
+      # The reader's position is unknown, so discard it
+      entry[0].close()
+      with self._condition:
+        self._readerCount -= 1
+        self._condition.notify()
+      raise
+
+    with self._condition:
+      self.reads += 1
+      self.seeks += int(seeked)
+      self.decodeTime += t2 - t1
+    self._release(entry)
+    return image
+
+
+
+  def close(self):
+    with self._condition:
+      self._closed = True
+      for entry in self._idle:
+        entry[0].close()
+      self._idle = []
+      self._condition.notify_all()
+
+
+
+  @property
+  def readerCount(self):
+    return self._readerCount
+
+
+
+  def stats(self):
+    return "{}: {} readers / {} frames read / {} seeks / {} s decoding".format(os.path.basename(self.filepath), self._readerCount, self.reads, self.seeks, round(self.decodeTime, 3))
+
+
+
+  def resetStats(self):
+    self.reads = 0
+    self.seeks = 0
+    self.decodeTime = 0
+
+
+
+def stats():
+  """stats()
+
+  Return a summary of the reads, seeks and decoding times of the reader pools of the current
+  session.
+  """
+
+  return "Readers: {}".format(" | ".join(pool.stats() for pool in openPools.values()) or "none")
+
+
+
+def resetStats():
+  for pool in openPools.values():
+    pool.resetStats()
 
 
 
@@ -26,62 +212,58 @@ def load(filepath):
 
 
 
-  if filepath in readyReaders:
-    # Instead of creating a new reader process, reuse an existing one
-    reader = readyReaders[filepath].popleft()
-    if len(readyReaders[filepath]) == 0:
-      del readyReaders[filepath]
-  else:
-    reader = imageio.get_reader(filepath)
-
-  if filepath in openReaders:
-    openReaders[filepath].append(reader)
+  # Every clip of the same file shares the file's pool of readers. Instead of creating new reader
+  # processes, reuse the pool from the previous session if there is one.
+  if filepath in openPools:
+    pool = openPools[filepath]
+  elif filepath in readyPools:
+    pool = readyPools.pop(filepath)
   else:
-    # Create a queue to hold all open readers of this file.
-    # A queue (as opposed to a stack) is used here so that LoadedVideoClips are more likely to pop
-    # readers that were used by equivalent LoadedVideoClips in the previous session.
-    openReaders[filepath] = collections.deque([reader])
+    pool = ReaderPool(filepath)
+  pool.maxReaders = maxReadersPerFile
+  openPools[filepath] = pool
 
-  if "I" in reader.format.modes:
+  if "I" in pool.format.modes:
     # imageio has determined that the file can be read as a video (sequence of images)
     source = filepath
-    md = reader.get_meta_data()
+    md = pool.get_meta_data()
     metadata = VideoClipMetadata(md["size"], md["nframes"], md["fps"])
-    return LoadedVideoClip(source, metadata, reader)
-  elif "i" in reader.format.modes:
+    return LoadedVideoClip(source, metadata, pool)
+  elif "i" in pool.format.modes:
     # imageio has determined that the file can be read as a single image
-    return LoadedImageClip(filepath, reader)
+    return LoadedImageClip(filepath, pool)
   else:
     raise ValueError("The filetype of \"{}\" is unsupported.".format(filepath))
 
 
 
 class LoadedVideoClip(VideoClip):
-  """LoadedVideoClip(source, metadata)
+  """LoadedVideoClip(source, metadata, pool)
 
-  Represents a video clip sourced directly from a video file.
+  Represents a video clip sourced directly from a video file, whose frames are read by the file's
+  ReaderPool.
   """
 
 
 
-  def __init__(self, source, metadata, reader):
+  def __init__(self, source, metadata, pool):
     super().__init__(source, metadata)
 
-    self._reader = reader
+    self._pool = pool
 
 
 
   @memoizeHash
   def __hash__(self):
-    return hash(self._reader.request.filename)
+    return hash(self._source)
 
 
 
   def _pseudoeq(self, other):
     # self and other must both be of this class
     if type(other) == type(self):
-      # The readers must be reading the same file
-      if self._reader.request.filename == other._reader.request.filename:
+      # The clips must be reading the same file
+      if self._source == other._source:
         return True
 
     return False
@@ -93,22 +275,43 @@ class LoadedVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    # Include the file's size and modification time so that persistent caches don't serve frames
+    # of a file that has since been overwritten.
+    return (os.path.getsize(self._source), os.path.getmtime(self._source))
+
+
+
+  def __getstate__(self):
+    # The readers can't be shared with another process, so they are reopened when unpickled
+    state = super().__getstate__()
+    del state["_pool"]
+    return state
+
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._pool = ReaderPool(self._source, maxReadersPerFile)
+
+
+
   def _framegen(self, n):
-    return self._reader.get_data(n)
+    return self._pool.get_data(n)
 
 
 
 class LoadedImageClip(ImageClip):
-  """LoadedImageClip(filepath, reader)
+  """LoadedImageClip(filepath, pool)
 
   Represents a single image sourced directly from an image file.
   """
 
 
 
-  def __init__(self, filepath, reader):
+  def __init__(self, filepath, pool):
     # Before calling ImageClip.__init__, we need to determine the image dimensions
-    self._reader = reader
+    self._pool = pool
     self._filepath = filepath
     size = self._dimensions()
     if size is None:
@@ -166,14 +369,33 @@ class LoadedImageClip(ImageClip):
     if type(other) == type(self):
       # The parent class parts must be the same
       if super().__eq__(other):
-        # The readers must be reading the same file
-        if self._reader.request.filename == other._reader.request.filename:
+        # The clips must be reading the same file
+        if self._filepath == other._filepath:
           return True
 
     return False
 
 
 
+  def _fingerprintParameters(self):
+    return (os.path.getsize(self._filepath), os.path.getmtime(self._filepath))
+
+
+
+  def __getstate__(self):
+    # The readers can't be shared with another process, so they are reopened when unpickled
+    state = super().__getstate__()
+    del state["_pool"]
+    return state
+
+
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._pool = ReaderPool(self._filepath, maxReadersPerFile)
+
+
+
   def _imagegen(self):
-    image = self._reader.get_data(0)[:, :, 0:3] # Load the image into memory (discarding any alpha channel information)
+    image = self._pool.get_data(0)[:, :, 0:3] # Load the image into memory (discarding any alpha channel information)
     return image
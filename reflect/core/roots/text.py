@@ -86,6 +86,32 @@ class TextImageClip(ImageClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._fontPath, self._fontSize, self._text, self._antialias, self._color, self._background)
+
+
+
+  def __getstate__(self):
+    # pygame fonts can't be pickled, so the font is reloaded when unpickled
+    state = super().__getstate__()
+    font = state.pop("_pygameFont")
+    state["_fontStyle"] = (font.get_bold(), font.get_italic(), font.get_underline())
+    return state
+
+
+
+  def __setstate__(self, state):
+    (bold, italic, underline) = state.pop("_fontStyle")
+    self.__dict__.update(state)
+    if not pygame.font.get_init():
+      pygame.font.init()
+    self._pygameFont = pygame.font.Font(self._fontPath, self._fontSize)
+    self._pygameFont.set_bold(bold)
+    self._pygameFont.set_italic(italic)
+    self._pygameFont.set_underline(underline)
+
+
+
   def _imagegen(self):
     # TODO: support multiline text by rendering each line individually (and position according to a new align parameter)
     surface = self._pygameFont.render(self._text, self._antialias, self._color, self._background).convert_alpha()
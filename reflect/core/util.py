@@ -161,6 +161,146 @@ class CompositionGraph:
 
 
 
+  def _consumerCounts(self):
+    # Count the clips that use each clip as a source (a previewed clip counts as used by the preview)
+    consumerCounts = { id(leaf): 1 for leaf in self.leaves }
+    visited = set()
+    q = list(self.leaves)
+    while q:
+      clip = q.pop()
+      if id(clip) in visited or not isinstance(clip._source, tuple):
+        continue
+      visited.add(id(clip))
+      for source in clip._source:
+        consumerCounts[id(source)] = consumerCounts.get(id(source), 0) + 1
+        q.append(source)
+    return consumerCounts
+
+
+
+  def _rewrite(self, rewrite):
+    # Rebuild the graph from the leaves down, replacing each clip for which
+    # rewrite(clip, consumerCounts, rebuild) returns a new clip (built from sources passed through
+    # rebuild), and copying each other clip whose sources have changed. Return the number of
+    # leaves that were replaced.
+    consumerCounts = self._consumerCounts()
+    replacements = {}
+
+    def rebuild(clip):
+      if id(clip) in replacements:
+        return replacements[id(clip)][1]
+
+      if not isinstance(clip._source, tuple):
+        replacement = clip
+      else:
+        replacement = rewrite(clip, consumerCounts, rebuild)
+        if replacement is not None:
+          replacement._timestamp = clip.timestamp
+        else:
+          sources = tuple(rebuild(source) for source in clip._source)
+          if any(new is not old for (new, old) in zip(sources, clip._source)):
+            replacement = clip._withSources(sources)
+          else:
+            replacement = clip
+
+      replacements[id(clip)] = (clip, replacement) # Keep clip alive, so that its id isn't reused
+      return replacement
+
+    rewrittenCount = 0
+    for leaf in list(self.leaves):
+      newLeaf = rebuild(leaf)
+      if newLeaf is not leaf:
+        self.removeLeaf(leaf)
+        rewrittenCount += 1
+    return rewrittenCount
+
+
+
+  def fusePointwise(self):
+    """fusePointwise()
+
+    Replace each chain of consecutive per-pixel colour effects (e.g. brighten and greyscale) with a
+    single clip that applies all of them in one pass over each frame (see fuse). A clip is only
+    absorbed into a chain if nothing else uses it as a source, since otherwise its frames would
+    still have to be rendered for the other clip.
+    """
+
+    if self.forced:
+      raise Exception("Attempted to fuse pointwise effects before unifying the preview nodes")
+
+    ta1 = time.perf_counter()
+
+    def fuse(clip, consumerCounts, rebuild):
+      if clip._colourStages() is None:
+        return None
+      chain = [clip]
+      source = clip._source[0]
+      while isinstance(source._source, tuple) and source._colourStages() is not None and consumerCounts[id(source)] == 1:
+        chain.append(source)
+        source = source._source[0]
+      if len(chain) == 1:
+        return None
+      stages = []
+      for link in reversed(chain):
+        stages.extend(link._colourStages())
+      return rebuild(source).fuse(stages)
+
+    fusedCount = self._rewrite(fuse)
+
+    ta2 = time.perf_counter()
+    logging.info("Pointwise fusion took {0:.16f} s ({1} leaves rewritten)".format(ta2 - ta1, fusedCount))
+
+
+
+  def flattenComposites(self):
+    """flattenComposites()
+
+    Replace each chain of composites, where each composite is the background of the next, with a
+    single clip that draws every layer into one frame (see layered), rather than copying the whole
+    frame once per layer. A composite is only absorbed into a chain if nothing else uses it as a
+    source, so that the chain's cache entry replaces the entries of the composites inside it.
+    """
+
+    if self.forced:
+      raise Exception("Attempted to flatten composites before unifying the preview nodes")
+
+    ta1 = time.perf_counter()
+
+    from .vfx.composite import CompositeVideoClip
+    from .vfx.layered import LayeredCompositeVideoClip
+
+    def layersOf(clip):
+      # Return the background of a composite and its (fg, x1, y1) layers
+      if isinstance(clip, CompositeVideoClip):
+        return (clip._source[0], [(clip._source[1], clip._x1, clip._y1)])
+      else:
+        return (clip._source[0], [(fg, x1, y1) for (fg, (x1, y1)) in zip(clip._source[1:], clip._positions)])
+
+    def isLayerable(clip):
+      # A layered clip draws each layer for its whole duration, so a composite whose foreground is
+      # shorter than its background (e.g. one placed with both n1 and n2) has to stay as it is
+      return isinstance(clip, (CompositeVideoClip, LayeredCompositeVideoClip)) and all(fg.frameCount >= clip.frameCount for fg in clip._source[1:])
+
+    def flatten(clip, consumerCounts, rebuild):
+      if not isLayerable(clip):
+        return None
+      (bg, layers) = layersOf(clip)
+      chainLength = 1
+      while isLayerable(bg) and consumerCounts[id(bg)] == 1:
+        (bg, bgLayers) = layersOf(bg)
+        layers = bgLayers + layers
+        chainLength += 1
+      if chainLength == 1:
+        return None
+      return rebuild(bg).layered([(rebuild(fg), x1, y1) for (fg, x1, y1) in layers])
+
+    flattenedCount = self._rewrite(flatten)
+
+    ta2 = time.perf_counter()
+    logging.info("Composite flattening took {0:.16f} s ({1} leaves rewritten)".format(ta2 - ta1, flattenedCount))
+
+
+
 # Initialise an empty graph for normal use
 currentGraph = CompositionGraph()
 
@@ -248,3 +388,29 @@ def interpretSubclipParameters(n1, n2, frameCount):
     raise ValueError("invalid subclip parameters: n1 = {}, n2 = {}, clip.frameCount = {}".format(n1, n2, frameCount))
 
   return (n1, n2)
+
+
+
+def intersectRegions(a, b):
+  """intersectRegions(a, b)
+
+  Returns the intersection of the regions `a` and `b`, each (x1, y1, x2, y2), or None if they don't
+  overlap.
+  """
+
+  (x1, y1, x2, y2) = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+  if x1 >= x2 or y1 >= y2:
+    return None
+  return (x1, y1, x2, y2)
+
+
+
+def padRegion(region, xMargin, yMargin, size):
+  """padRegion(region, xMargin, yMargin, size)
+
+  Returns `region` = (x1, y1, x2, y2) widened by `xMargin` on the left and right and by `yMargin`
+  on the top and bottom, but kept within a frame of the given `size` = (width, height).
+  """
+
+  (x1, y1, x2, y2) = region
+  return (max(0, x1 - xMargin), max(0, y1 - yMargin), min(size[0], x2 + xMargin), min(size[1], y2 + yMargin))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
+from ..pool import FramePool
+from ..util import padRegion
 import cv2
 import copy
 
@@ -146,6 +148,23 @@ class BlurredVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._blurSize,)
+
+
+
   def _framegen(self, n):
     image = self._source[0].frame(n)
-    return cv2.blur(image, self._blurSize)
+    return cv2.blur(image, self._blurSize, dst = FramePool.current().empty(image.shape, image.dtype))
+
+
+
+  def _framegenRegion(self, n, region):
+    # Each output pixel depends on the source pixels within half the kernel of it, so blur a region
+    # widened by that much, and then discard the margins (at the edges of the frame, the region
+    # isn't widened, so the border is handled as usual)
+    (width, height) = self._blurSize
+    sourceRegion = padRegion(region, width // 2, height // 2, self.size)
+    image = cv2.blur(self._source[0].frame(n, sourceRegion), self._blurSize)
+    (x1, y1, x2, y2) = region
+    return image[y1 - sourceRegion[1]:y2 - sourceRegion[1], x1 - sourceRegion[0]:x2 - sourceRegion[0]]
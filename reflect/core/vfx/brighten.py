@@ -1,7 +1,45 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
+from ..pool import FramePool
 import copy
+import numpy
+import cv2
+
+
+
+def brightnessLUT(amount):
+  """brightnessLUT(amount)
+
+  Return the 256-entry uint8 lookup table that brightens (or darkens, if `amount` is negative) each
+  intensity by `amount`, as brighten does.
+  """
+
+  intensities = numpy.arange(256)
+  if amount >= 0:
+    return (intensities * (1 - amount) + (amount * 255)).astype(numpy.uint8)
+  else:
+    return (intensities * (1 + amount)).astype(numpy.uint8)
+
+
+
+def applyLUT(images, lut, result):
+  """applyLUT(images, lut, result)
+
+  Map every channel of a frame, or a stack of frames, through the 256-entry uint8 lookup table
+  `lut` into `result`, and return `result`.
+  """
+
+  if images.flags.c_contiguous and result.flags.c_contiguous:
+    # cv2.LUT only accepts single images, but the mapping is the same for every element, so view
+    # the frames as one image
+    cv2.LUT(images.reshape((-1, images.shape[-1])), lut, dst = result.reshape((-1, images.shape[-1])))
+  elif images.ndim == 4:
+    for i in range(len(images)):
+      cv2.LUT(images[i], lut, dst = result[i])
+  else:
+    cv2.LUT(images, lut, dst = result)
+  return result
 
 
 
@@ -58,7 +96,7 @@ def brighten(clip, amount):
     elif isinstance(clip, vfx.greyscale.GreyscaleVideoClip):
       # BrightenedVideoClip < GreyscaleVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].brighten(amount).greyscale()
+      return clip._source[0].brighten(amount).greyscale(lazy = clip._lazy)
     elif isinstance(clip, vfx.blur.BlurredVideoClip):
       # BrightenedVideoClip < BlurredVideoClip
       return clip._source[0].brighten(amount).blur(clip._blurSize)
@@ -120,6 +158,7 @@ class BrightenedVideoClip(VideoClip):
     super().__init__(source, metadata, isConstant = source[0]._isConstant)
 
     self._amount = amount
+    self._lut = brightnessLUT(amount) # Every intensity, brightened (see _framegen)
 
 
 
@@ -147,15 +186,27 @@ class BrightenedVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._amount,)
+
+
+
+  def _colourStages(self):
+    return [("lut", self._lut)]
+
+
+
   def _framegen(self, n):
-    amount = self._amount
-    image = self._source[0].frame(n)
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
+    image = self._source[0].frame(n, region)
+    return applyLUT(image, self._lut, FramePool.current().empty(image.shape, numpy.uint8))
+
 
-    if amount >= 0:
-      # Brighten
-      image = (image * (1 - amount) + (amount * 255)).astype("uint8")
-    else:
-      # Darken
-      image = (image * (1 + amount)).astype("uint8")
 
-    return image
+  def _framegenBatch(self, ns):
+    images = self._source[0]._frames(ns)
+    return applyLUT(images, self._lut, FramePool.current().empty(images.shape, numpy.uint8))
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
-from ..util import timecodeToFrame, interpretSubclipParameters
+from ..util import timecodeToFrame, interpretSubclipParameters, intersectRegions
+from ..pool import FramePool
+from ..executor import BranchExecutor
 import copy
 import numpy
 
@@ -151,6 +153,19 @@ def compositePart(clip, fg, n1, n2, x1, y1):
         offset = n
       return parts[0].concat(parts[1:])
 
+  covers = x1 <= 0 and y1 <= 0 and x1 + fg.width >= middleBg.width and y1 + fg.height >= middleBg.height
+  if covers and fg.frameCount >= middleBg.frameCount and fg.fps == middleBg.fps:
+    # The foreground covers the whole background, so the background would never be rendered: the
+    # result is just the part of the foreground that overlaps the background. The background is no
+    # longer a leaf, just as if it were a source of the composite.
+    if middleBg._graph.isLeaf(middleBg): middleBg._graph.removeLeaf(middleBg)
+    result = fg
+    if fg.frameCount != middleBg.frameCount:
+      result = result.subclip(0, middleBg.frameCount)
+    if result.size != middleBg.size:
+      result = result.crop(-x1, -y1, middleBg.width - x1, middleBg.height - y1)
+    return result
+
   metadata = copy.copy(middleBg._metadata)
   return CompositeVideoClip((middleBg, fg), metadata, x1, y1)
 
@@ -196,30 +211,64 @@ class CompositeVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._x1, self._y1)
+
+
+
   def _framegen(self, n):
+    return self._framegenRegion(n, (0, 0, self.width, self.height))
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions() or self._source[1]._rendersRegions()
+
+
+
+  def _framegenRegion(self, n, region):
     clip = self._source[0]
     fg = self._source[1]
 
+    (rx1, ry1, rx2, ry2) = region
+
+    # Determine the region of the output that the foreground covers, so that only the visible
+    # part of the foreground frame is requested (or none of it, if it is entirely off-screen)
     x1 = self._x1
     y1 = self._y1
-    x2 = x1 + fg.width
-    y2 = y1 + fg.height
-
-    image = clip.frame(n)
-
-    # Determine the region of the foreground frame that will actually be visible when blitted
-    fgx1 = max(0, -x1)
-    fgx2 = min(fg.width, fg.width - (x2 - clip.width))
-    fgy1 = max(0, -y1)
-    fgy2 = min(fg.height, fg.height - (y2 - clip.height))
-    imageToBlit = fg.frame(n)[fgy1:fgy2, fgx1:fgx2]
+    visible = intersectRegions(region, (x1, y1, x1 + fg.width, y1 + fg.height))
+
+    if visible is None:
+      return clip.frame(n, region)
+    (vx1, vy1, vx2, vy2) = visible
+    fgRegion = (vx1 - x1, vy1 - y1, vx2 - x1, vy2 - y1)
+    if visible == region:
+      # The foreground covers the whole region, so the background isn't needed at all
+      return fg.frame(n, fgRegion)
+
+    if clip._rendersRegions():
+      # Only request the parts of the background that the foreground doesn't cover: the bands above
+      # and below it, and to its left and right
+      uncovered = [(rx1, ry1, rx2, vy1), (rx1, vy2, rx2, ry2), (rx1, vy1, vx1, vy2), (vx2, vy1, rx2, vy2)]
+      uncovered = [part for part in uncovered if part[0] < part[2] and part[1] < part[3]]
+
+      # Render the background and foreground concurrently if possible
+      (imageToBlit, bgImages) = BranchExecutor.current().run([
+        (fg, lambda: fg.frame(n, fgRegion)),
+        (clip, lambda: [clip.frame(n, part) for part in uncovered])
+      ])
+
+      # Assemble the output from the foreground and the uncovered parts of the background
+      image = FramePool.current().empty((ry2 - ry1, rx2 - rx1) + imageToBlit.shape[2:], imageToBlit.dtype)
+      for (px1, py1, px2, py2), partImage in zip([visible] + uncovered, [imageToBlit] + bgImages):
+        image[py1 - ry1:py2 - ry1, px1 - rx1:px2 - rx1] = partImage
+      return image
+
+    # Render the background and foreground concurrently if possible
+    (image, imageToBlit) = BranchExecutor.current().frames([(clip, n, region), (fg, n, fgRegion)])
 
     # Blit the foreground frame over the background frame
-    x1 = max(0, x1)
-    x2 = x1 + (fgx2 - fgx1)
-    y1 = max(0, y1)
-    y2 = y1 + (fgy2 - fgy1)
-    image = numpy.copy(image)
-    image[y1:y2, x1:x2] = imageToBlit
+    image = FramePool.current().copy(image)
+    image[vy1 - ry1:vy2 - ry1, vx1 - rx1:vx2 - rx1] = imageToBlit
 
     return image
@@ -4,7 +4,8 @@ from ..clips import VideoClip, clipMethod, memoizeHash
 import copy
 import collections
 from itertools import accumulate
-from bisect import bisect_left
+import numpy
+from bisect import bisect_left, bisect_right
 
 
 
@@ -118,6 +119,30 @@ class ConcatenatedVideoClip(VideoClip):
 
 
 
+  def _framegenBatch(self, ns):
+    # Group the requested frames by the source clip that they come from, fetch each group in one
+    # batch, and then put the frames back in the requested order
+    groups = collections.OrderedDict() # clip index → ([position in ns], [frame index in the clip])
+    for i, n in enumerate(ns):
+      clipIndex = bisect_right(self.sourceStartFrames, n)
+      if n < 0 or clipIndex >= len(self._source):
+        raise IndexError("received a request for the frame at index {}, but this sequence of video clips contains only {} frames".format(n, self.frameCount))
+      offset = self.sourceStartFrames[clipIndex - 1] if clipIndex > 0 else 0
+      (positions, clipNs) = groups.setdefault(clipIndex, ([], []))
+      positions.append(i)
+      clipNs.append(n - offset)
+
+    result = None
+    for clipIndex, (positions, clipNs) in groups.items():
+      images = self._source[clipIndex]._frames(clipNs)
+      if result is None:
+        result = numpy.empty((len(ns),) + images.shape[1:], dtype = images.dtype)
+      result[positions] = images
+
+    return result
+
+
+
   @property
   def sourceStartFrames(self):
     if self._sourceStartFrames is None:
@@ -108,7 +108,7 @@ def crop(clip, x1 = None, y1 = None, x2 = None, y2 = None, xc = None, yc = None,
     elif isinstance(clip, vfx.greyscale.GreyscaleVideoClip):
       # CroppedVideoClip < GreyscaleVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].crop(x1, y1, x2, y2).greyscale()
+      return clip._source[0].crop(x1, y1, x2, y2).greyscale(lazy = clip._lazy)
     elif isinstance(clip, vfx.blur.BlurredVideoClip):
       # CroppedVideoClip | BlurredVideoClip
       pass
@@ -196,7 +196,10 @@ class CroppedVideoClip(VideoClip):
 
 
   def __init__(self, source, metadata, x1, y1, x2, y2):
-    super().__init__(source, metadata, isIndirection = True, isConstant = source[0]._isConstant)
+    # If the source renders only the part of each frame that is requested, then this clip's frames
+    # are rendered rather than sliced from the source's (cached) frames, so they are worth caching
+    isIndirection = not source[0]._rendersRegions()
+    super().__init__(source, metadata, isIndirection = isIndirection, isConstant = source[0]._isConstant)
 
     self._x1 = x1
     self._y1 = y1
@@ -229,6 +232,27 @@ class CroppedVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._x1, self._y1, self._x2, self._y2)
+
+
+
   def _framegen(self, n):
-    image = self._source[0].frame(n)
-    return image[self._y1:self._y2, self._x1:self._x2]
+    return self._source[0].frame(n, (self._x1, self._y1, self._x2, self._y2))
+
+
+
+  def _framegenRegion(self, n, region):
+    (x1, y1, x2, y2) = region
+    return self._source[0].frame(n, (self._x1 + x1, self._y1 + y1, self._x1 + x2, self._y1 + y2))
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions()
+
+
+
+  def _framegenBatch(self, ns):
+    images = self._source[0]._frames(ns)
+    return images[:, self._y1:self._y2, self._x1:self._x2]
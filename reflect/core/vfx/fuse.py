@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from ..clips import VideoClip, clipMethod, memoizeHash
+from ..pool import FramePool
+from .brighten import applyLUT
+from .greyscale import greyOf
+import copy
+import numpy
+
+
+
+identityLUT = numpy.arange(256, dtype = numpy.uint8)
+
+
+
+@clipMethod
+def fuse(clip, stages):
+  """fuse(clip, stages)
+
+  Returns a copy of `clip` where every frame has been passed through a sequence of per-pixel colour
+  stages in a single pass, as though each stage had been applied by a separate effect. Each stage
+  is either ("lut", lut), which maps every channel of every pixel through the 256-entry uint8
+  lookup table `lut`, or ("grey",), which converts the frame to greyscale as greyscale() does.
+
+  This is mainly used by CompositionGraph.fusePointwise, which replaces chains of effects such as
+  brighten and greyscale with a single fused clip.
+
+  Examples
+  --------
+  >>> clip.fuse([("lut", 255 - numpy.arange(256, dtype = numpy.uint8))])   # Invert the colours
+  >>> clip.fuse([("grey",), ("lut", lut)])                                 # Greyscale, then apply lut
+  """
+
+  if not isinstance(clip, VideoClip):
+    raise TypeError("fuse requires a clip of type VideoClip")
+
+  # Reduce the stages to a lookup table, an optional conversion to greyscale, and another lookup
+  # table. Consecutive tables compose exactly, and so do tables after a conversion to greyscale,
+  # since every channel of a grey pixel is the same. A second conversion to greyscale maps a grey
+  # pixel to a grey pixel, so it also becomes a table.
+  preLUT = identityLUT
+  grey = False
+  postLUT = identityLUT
+  for stage in stages:
+    if stage[0] == "lut":
+      lut = numpy.asarray(stage[1])
+      if lut.shape != (256,) or lut.dtype != numpy.uint8:
+        raise ValueError("expected a lookup table of 256 uint8 values")
+      if grey:
+        postLUT = lut[postLUT]
+      else:
+        preLUT = lut[preLUT]
+    elif stage[0] == "grey":
+      if grey:
+        postLUT = greyOf(numpy.repeat(postLUT[:, numpy.newaxis, numpy.newaxis], 3, axis = 2)).reshape(256)
+      else:
+        grey = True
+    else:
+      raise ValueError("unknown colour stage {}".format(stage[0]))
+
+  # Source: A single VideoClip
+  source = (clip,)
+
+  # Metadata: Exactly the same as the base clip's
+  metadata = copy.copy(clip._metadata)
+
+  return FusedColourVideoClip(source, metadata, preLUT, grey, postLUT)
+
+
+
+class FusedColourVideoClip(VideoClip):
+  """FusedColourVideoClip(source, metadata, preLUT, grey, postLUT)
+
+  Represents a video clip where every frame has been mapped through the lookup table `preLUT`,
+  converted to greyscale if `grey` is set, and then mapped through the lookup table `postLUT`, in a
+  single pass.
+  """
+
+
+
+  def __init__(self, source, metadata, preLUT, grey, postLUT):
+    super().__init__(source, metadata, isConstant = source[0]._isConstant)
+
+    self._preLUT = preLUT
+    self._grey = grey
+    self._postLUT = postLUT
+
+
+
+  @memoizeHash
+  def __hash__(self):
+    return hash((super().__hash__(), self._preLUT.tobytes(), self._grey, self._postLUT.tobytes()))
+
+
+
+  def _pseudoeq(self, other):
+    # self and other must both be of this class
+    if type(other) == type(self):
+      # The parent class parts must be the same
+      if super()._pseudoeq(other):
+        # The stages must be the same
+        if self._grey == other._grey and numpy.array_equal(self._preLUT, other._preLUT) and numpy.array_equal(self._postLUT, other._postLUT):
+          return True
+
+    return False
+
+
+
+  def __eq__(self, other):
+    return self._pseudoeq(other) and self._source == other._source
+
+
+
+  def _fingerprintParameters(self):
+    return (self._preLUT.tobytes().hex(), self._grey, self._postLUT.tobytes().hex())
+
+
+
+  def _colourStages(self):
+    if self._grey:
+      return [("lut", self._preLUT), ("grey",), ("lut", self._postLUT)]
+    else:
+      return [("lut", self._preLUT)]
+
+
+
+  def _apply(self, images):
+    if not self._grey:
+      return applyLUT(images, self._preLUT, FramePool.current().empty(images.shape, numpy.uint8))
+
+    if self._preLUT is not identityLUT:
+      images = applyLUT(images, self._preLUT, numpy.empty(images.shape, numpy.uint8))
+    grey = greyOf(images)
+    if self._postLUT is not identityLUT:
+      grey = applyLUT(grey, self._postLUT, grey)
+    result = FramePool.current().empty(grey.shape + (3,), numpy.uint8)
+    result[..., 2] = result[..., 1] = result[..., 0] = grey
+    return result
+
+
+
+  def _framegen(self, n):
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
+    return self._apply(self._source[0].frame(n, region))
+
+
+
+  def _framegenBatch(self, ns):
+    return self._apply(self._source[0]._frames(ns))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
+from ..util import padRegion
 import cv2
 import copy
 
@@ -160,6 +161,21 @@ class GaussianBlurredVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._blurSize, self._sigma)
+
+
+
   def _framegen(self, n):
     image = self._source[0].frame(n)
     return cv2.GaussianBlur(image, self._blurSize, self._sigma[0], self._sigma[1])
+
+
+
+  def _framegenRegion(self, n, region):
+    # As for BlurredVideoClip, blur a region widened by the kernel radius and discard the margins
+    (width, height) = self._blurSize
+    sourceRegion = padRegion(region, width // 2, height // 2, self.size)
+    image = cv2.GaussianBlur(self._source[0].frame(n, sourceRegion), self._blurSize, self._sigma[0], self._sigma[1])
+    (x1, y1, x2, y2) = region
+    return image[y1 - sourceRegion[1]:y2 - sourceRegion[1], x1 - sourceRegion[0]:x2 - sourceRegion[0]]
@@ -1,21 +1,62 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
+from ..pool import FramePool
 import copy
 import numpy
 import cv2
 
 
 
+def greyOf(images, result = None):
+  """greyOf(images, result = None)
+
+  Return the grey intensities (0.299 R + 0.587 G + 0.114 B, rounded to uint8) of a frame or a stack
+  of frames, without the colour axis, writing them into `result` if it is given.
+  """
+
+  code = cv2.COLOR_RGBA2GRAY if images.shape[-1] == 4 else cv2.COLOR_RGB2GRAY
+  if result is None:
+    result = numpy.empty(images.shape[:-1], numpy.uint8)
+
+  if images.ndim == 3:
+    cv2.cvtColor(images, code, dst = result)
+  elif images.flags.c_contiguous:
+    # cv2.cvtColor only accepts single frames, so treat the stack as one tall frame
+    cv2.cvtColor(images.reshape((-1,) + images.shape[2:]), code, dst = result.reshape((-1, images.shape[2])))
+  else:
+    for i in range(len(images)):
+      cv2.cvtColor(images[i], code, dst = result[i])
+
+  return result
+
+
+
+def broadcastGrey(grey):
+  """broadcastGrey(grey)
+
+  Return a read-only view of the grey intensities `grey` (a frame or a stack of frames without the
+  colour axis) with three identical colour channels, without copying them.
+  """
+
+  return numpy.broadcast_to(grey[..., numpy.newaxis], grey.shape + (3,))
+
+
+
 @clipMethod
-def greyscale(clip):
-  """greyscale(clip)
+def greyscale(clip, lazy = False):
+  """greyscale(clip, lazy = False)
 
   Returns a copy of `clip` where each pixel is grey with intensity 0.299 R + 0.587 G + 0.114 B.
 
+  If `lazy` is True, each frame only stores a single channel of intensities, and its three colour
+  channels are read-only views of that channel. This takes a third of the memory (in the cache, for
+  example), but effects that write into their source frames must copy them first.
+
   Examples
   --------
-  >>> clip.greyscale()    # Returns a greyscale version of the clip
+  >>> clip.greyscale()              # Returns a greyscale version of the clip
+  >>> clip.greyscale(lazy = True)   # The same, but its frames take a third of the memory
   """
 
   if not isinstance(clip, VideoClip):
@@ -32,7 +73,7 @@ def greyscale(clip):
       if clip.width * clip.height >= clip._source[0].width * clip._source[0].height:
         # GreyscaleVideoClip < ResizedVideoClip_↑
         if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-        return clip._source[0].greyscale().resize(clip.size, interpolation = clip._interpolation)
+        return clip._source[0].greyscale(lazy = lazy).resize(clip.size, interpolation = clip._interpolation)
       else:
         # GreyscaleVideoClip > ResizedVideoClip_↓
         pass
@@ -45,42 +86,42 @@ def greyscale(clip):
       return clip._source[0]
     elif isinstance(clip, vfx.blur.BlurredVideoClip):
       # GreyscaleVideoClip < BlurredVideoClip
-      return clip._source[0].greyscale().blur(clip._blurSize)
+      return clip._source[0].greyscale(lazy = lazy).blur(clip._blurSize)
     elif isinstance(clip, vfx.gaussianBlur.GaussianBlurredVideoClip):
       # GreyscaleVideoClip < GaussianBlurredVideoClip
-      return clip._source[0].greyscale().gaussianBlur(size = clip._blurSize, sigma = clip._sigma)
+      return clip._source[0].greyscale(lazy = lazy).gaussianBlur(size = clip._blurSize, sigma = clip._sigma)
     elif isinstance(clip, vfx.rate.ChangedRateVideoClip):
       # GreyscaleVideoClip < ChangedRateVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].greyscale().rate(clip.fps)
+      return clip._source[0].greyscale(lazy = lazy).rate(clip.fps)
     elif isinstance(clip, vfx.reverse.ReversedVideoClip):
       # GreyscaleVideoClip < ReversedVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].greyscale().reverse()
+      return clip._source[0].greyscale(lazy = lazy).reverse()
     elif isinstance(clip, vfx.speed.SpedVideoClip):
       # GreyscaleVideoClip < SpedVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].greyscale().speed(clip._scale)
+      return clip._source[0].greyscale(lazy = lazy).speed(clip._scale)
     elif isinstance(clip, vfx.subclip.SubVideoClip):
       # GreyscaleVideoClip < SubVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return clip._source[0].greyscale().subclip(clip._n1, clip._n2)
+      return clip._source[0].greyscale(lazy = lazy).subclip(clip._n1, clip._n2)
     elif isinstance(clip, vfx.slide.SlideTransitionVideoClip):
       # GreyscaleVideoClip < SlideTransitionVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      a = clip._source[0].greyscale()
-      b = clip._source[1].greyscale()
+      a = clip._source[0].greyscale(lazy = lazy)
+      b = clip._source[1].greyscale(lazy = lazy)
       return a.slide(b, origin = clip._origin, frameCount = clip._frameCount, fValues = clip._fValues, transitionOnly = True)
     elif isinstance(clip, vfx.composite.CompositeVideoClip):
       # GreyscaleVideoClip < CompositeVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
       bg = clip._source[0]
       fg = clip._source[1]
-      return bg.greyscale().composite(fg.greyscale(), x1 = clip._x1, y1 = clip._y1)
+      return bg.greyscale(lazy = lazy).composite(fg.greyscale(lazy = lazy), x1 = clip._x1, y1 = clip._y1)
     elif isinstance(clip, vfx.concat.ConcatenatedVideoClip):
       # GreyscaleVideoClip < ConcatenatedVideoClip
       if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-      return (clip._source[0].greyscale()).concat([s.greyscale() for s in clip._source[1:]])
+      return (clip._source[0].greyscale(lazy = lazy)).concat([s.greyscale(lazy = lazy) for s in clip._source[1:]])
 
   # Source: A single VideoClip
   source = (clip,)
@@ -88,26 +129,29 @@ def greyscale(clip):
   # Metadata: Exactly the same as the base clip's
   metadata = copy.copy(clip._metadata)
 
-  return GreyscaleVideoClip(source, metadata)
+  return GreyscaleVideoClip(source, metadata, lazy)
 
 
 
 class GreyscaleVideoClip(VideoClip):
-  """GreyscaleVideoClip(source, metadata)
+  """GreyscaleVideoClip(source, metadata, lazy = False)
 
-  Represents a video clip where each pixel is grey with intensity 0.299 R + 0.587 G + 0.114 B.
+  Represents a video clip where each pixel is grey with intensity 0.299 R + 0.587 G + 0.114 B. If
+  `lazy` is True, frames are single-channel images broadcast to three channels.
   """
 
 
 
-  def __init__(self, source, metadata):
+  def __init__(self, source, metadata, lazy = False):
     super().__init__(source, metadata, isConstant = source[0]._isConstant)
 
+    self._lazy = lazy
+
 
 
   @memoizeHash
   def __hash__(self):
-    return super().__hash__()
+    return hash((super().__hash__(), self._lazy))
 
 
 
@@ -116,7 +160,9 @@ class GreyscaleVideoClip(VideoClip):
     if type(other) == type(self):
       # The parent class parts must be the same
       if super()._pseudoeq(other):
-        return True
+        # The parameter must be the same
+        if self._lazy == other._lazy:
+          return True
 
     return False
 
@@ -127,12 +173,43 @@ class GreyscaleVideoClip(VideoClip):
 
 
 
-  def _framegen(self, n):
-    image = self._source[0].frame(n)
+  def _fingerprintParameters(self):
+    # cv2.cvtColor rounds where the old kernel truncated, so the kernel is named in the fingerprint
+    # to keep persistent tiers from serving frames that the old kernel rendered
+    return ("cv2",) + ((self._lazy,) if self._lazy else ())
+
+
+
+  def _colourStages(self):
+    # A fused clip renders full RGB frames, which would lose the memory saved by a lazy greyscale
+    if self._lazy:
+      return None
+    return [("grey",)]
 
-    grey = numpy.dot(image[:, :, :3], [0.299, 0.587, 0.114]).astype(numpy.uint8)
-    w, h = grey.shape
-    rgb = numpy.empty((w, h, 3), dtype = numpy.uint8)
-    rgb[:, :, 2] = rgb[:, :, 1] = rgb[:, :, 0] = grey
 
+
+  def _greyscale(self, images):
+    if self._lazy:
+      # The grey intensities are the frame, so they are kept in the pool like any other frame
+      return broadcastGrey(greyOf(images, FramePool.current().empty(images.shape[:-1], dtype = numpy.uint8)))
+
+    # Otherwise they are only needed until they have been expanded into the RGB frame
+    grey = greyOf(images, numpy.empty(images.shape[:-1], dtype = numpy.uint8))
+    rgb = FramePool.current().empty(grey.shape + (3,), dtype = numpy.uint8)
+    cv2.cvtColor(grey.reshape((-1, grey.shape[-1])), cv2.COLOR_GRAY2RGB, dst = rgb.reshape((-1, grey.shape[-1], 3)))
     return rgb
+
+
+
+  def _framegen(self, n):
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
+    return self._greyscale(self._source[0].frame(n, region))
+
+
+
+  def _framegenBatch(self, ns):
+    return self._greyscale(self._source[0]._frames(ns))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from ..clips import VideoClip, clipMethod, memoizeHash
+from ..util import intersectRegions
+from ..pool import FramePool
+from ..executor import BranchExecutor
+import copy
+import functools
+
+
+
+@clipMethod
+def layered(clip, layers):
+  """layered(clip, layers)
+
+  Returns `clip` with each clip in `layers`, a list of (fg, x1, y1), overlaid on top of it for its
+  whole duration, in order, so that later layers are drawn over earlier ones. This looks the same
+  as clip.composite(fg1, x1 = x1, y1 = y1).composite(fg2, ...)..., but every layer is drawn into a
+  single frame, rather than the frame being copied once per layer.
+
+  CompositionGraph.flattenComposites replaces chains of composites with layered clips.
+
+  Examples
+  --------
+  >>> clip.layered([(logo, 10, 10), (caption, 0, clip.height - caption.height)])
+  """
+
+  if not isinstance(clip, VideoClip):
+    raise TypeError("layered requires a clip of type VideoClip")
+
+  fgs = []
+  positions = []
+  for (fg, x1, y1) in layers:
+    if not isinstance(fg, VideoClip):
+      raise TypeError("layered requires layers of type VideoClip")
+    if fg.frameCount < clip.frameCount:
+      raise ValueError("expected layers of at least {} frames, but received a layer of {} frames".format(clip.frameCount, fg.frameCount))
+    fgs.append(fg)
+    positions.append((int(x1), int(y1)))
+
+  if not fgs:
+    return clip
+
+  # Source: The background clip followed by each layer, bottom to top
+  source = (clip,) + tuple(fgs)
+
+  # Metadata: Exactly the same as the background clip's
+  metadata = copy.copy(clip._metadata)
+
+  return LayeredCompositeVideoClip(source, metadata, positions)
+
+
+
+class LayeredCompositeVideoClip(VideoClip):
+  """LayeredCompositeVideoClip(source, metadata, positions)
+
+  Represents a video clip that has had several other clips overlaid in the foreground: source[0] is
+  the background, and each later source is drawn over the ones before it, with its top-left corner
+  at the corresponding (x1, y1) in `positions`.
+  """
+
+
+
+  def __init__(self, source, metadata, positions):
+    super().__init__(source, metadata, isConstant = all(s._isConstant for s in source))
+
+    self._positions = tuple(positions)
+
+
+
+  @memoizeHash
+  def __hash__(self):
+    return hash((super().__hash__(), self._positions))
+
+
+
+  def _pseudoeq(self, other):
+    # self and other must both be of this class
+    if type(other) == type(self):
+      # The parent class parts must be the same
+      if super()._pseudoeq(other):
+        # The layer positions must be the same
+        if self._positions == other._positions:
+          return True
+
+    return False
+
+
+
+  def __eq__(self, other):
+    return self._pseudoeq(other) and self._source == other._source
+
+
+
+  def _fingerprintParameters(self):
+    return self._positions
+
+
+
+  def _framegen(self, n):
+    return self._framegenRegion(n, (0, 0, self.width, self.height))
+
+
+
+  def _rendersRegions(self):
+    return any(s._rendersRegions() for s in self._source)
+
+
+
+  def _framegenRegion(self, n, region):
+    clip = self._source[0]
+
+    (rx1, ry1, rx2, ry2) = region
+
+    # Determine the part of the region that each layer covers, and the part of the layer's frame
+    # that it needs
+    layers = []
+    for fg, (x1, y1) in zip(self._source[1:], self._positions):
+      visible = intersectRegions(region, (x1, y1, x1 + fg.width, y1 + fg.height))
+      if visible is not None:
+        (vx1, vy1, vx2, vy2) = visible
+        layers.append((fg, visible, (vx1 - x1, vy1 - y1, vx2 - x1, vy2 - y1)))
+
+    # Drop the layers that are hidden behind a layer above them. A layer that covers the whole
+    # region hides the background too.
+    def hides(a, b):
+      return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+    layers = [layer for (i, layer) in enumerate(layers) if not any(hides(above[1], layer[1]) for above in layers[i + 1:])]
+    needsBackground = not any(visible == region for (fg, visible, fgRegion) in layers)
+
+    if not layers:
+      return clip.frame(n, region)
+    if len(layers) == 1 and not needsBackground:
+      return layers[0][0].frame(n, layers[0][2])
+
+    # Render the background and the layers concurrently if possible
+    tasks = [(fg, functools.partial(fg.frame, n, fgRegion)) for (fg, visible, fgRegion) in layers]
+    if needsBackground:
+      tasks.insert(0, (clip, functools.partial(clip.frame, n, region)))
+    images = BranchExecutor.current().run(tasks)
+
+    # Draw everything into a single frame, from the bottom up
+    image = FramePool.current().empty((ry2 - ry1, rx2 - rx1) + images[0].shape[2:], images[0].dtype)
+    if needsBackground:
+      image[...] = images.pop(0)
+    for (fg, (vx1, vy1, vx2, vy2), fgRegion), imageToBlit in zip(layers, images):
+      image[vy1 - ry1:vy2 - ry1, vx1 - rx1:vx2 - rx1] = imageToBlit
+
+    return image
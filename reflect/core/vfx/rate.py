@@ -138,4 +138,14 @@ class ChangedRateVideoClip(VideoClip):
 
 
   def _framegen(self, n):
-    return self._source[0].frame(n)
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
+    return self._source[0].frame(n, region)
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions()
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from ..clips import VideoClip, clipMethod, memoizeHash
+from ..pool import FramePool
 import cv2
 import copy
+import math
 
 
 
@@ -94,7 +96,7 @@ def resize(clip, size = None, width = None, height = None, interpolation = cv2.I
       elif isinstance(clip, vfx.greyscale.GreyscaleVideoClip):
         # ResizedVideoClip_↓ < GreyscaleVideoClip
         if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
-        return clip._source[0].resize(size, interpolation = interpolation).greyscale()
+        return clip._source[0].resize(size, interpolation = interpolation).greyscale(lazy = clip._lazy)
       elif isinstance(clip, vfx.blur.BlurredVideoClip):
         # ResizedVideoClip_↓ < BlurredVideoClip
         if clip._childCount == 0 and clip._graph.isLeaf(clip): clip._graph.removeLeaf(clip)
@@ -193,6 +195,51 @@ class ResizedVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._interpolation,)
+
+
+
   def _framegen(self, n):
     image = self._source[0].frame(n)
-    return cv2.resize(image, self.size, interpolation = self._interpolation)
+    result = FramePool.current().empty((self.height, self.width) + image.shape[2:], image.dtype)
+    return cv2.resize(image, self.size, dst = result, interpolation = self._interpolation)
+
+
+
+  def _rendersRegions(self):
+    # Other interpolations (e.g. cv2.INTER_LANCZOS4) don't always give exactly the same pixels for
+    # part of a frame (see _framegenRegion)
+    return self._interpolation in (cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA)
+
+
+
+  def _framegenRegion(self, n, region):
+    source = self._source[0]
+    if not self._rendersRegions():
+      return super()._framegenRegion(n, region)
+
+    # Each output pixel x samples the source around (x + 0.5) * p / q - 0.5, where the scale p / q
+    # is in lowest terms. A part of the output whose edges are multiples of q therefore maps to a
+    # part of the source whose edges are multiples of p, and cv2.resize gives exactly the same
+    # pixels for it as for the whole frame. So widen the region to such edges, with a margin for
+    # the pixels that each interpolation reads around each sample (unless it reaches the edge of
+    # the frame, where the border is handled as usual), resize that, and discard the margins.
+    sourceRegion = []
+    outputRegion = []
+    for (start, stop, sourceSize, outputSize) in [(region[0], region[2], source.width, self.width), (region[1], region[3], source.height, self.height)]:
+      gcd = math.gcd(sourceSize, outputSize)
+      (p, q) = (sourceSize // gcd, outputSize // gcd)
+      margin = math.ceil((5 + math.ceil(p / q)) * q / p)
+      start = max(0, (start - margin) // q * q)
+      stop = min(outputSize, -(-(stop + margin) // q) * q)
+      outputRegion += [start, stop]
+      sourceRegion += [start * p // q, stop * p // q]
+    (ox1, ox2, oy1, oy2) = outputRegion
+    (sx1, sx2, sy1, sy2) = sourceRegion
+    if (sx1, sy1, sx2, sy2) == (0, 0, source.width, source.height):
+      return super()._framegenRegion(n, region)
+
+    image = cv2.resize(source.frame(n, (sx1, sy1, sx2, sy2)), (ox2 - ox1, oy2 - oy1), interpolation = self._interpolation)
+    (x1, y1, x2, y2) = region
+    return image[y1 - oy1:y2 - oy1, x1 - ox1:x2 - ox1]
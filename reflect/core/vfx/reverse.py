@@ -122,8 +122,24 @@ class ReversedVideoClip(VideoClip):
 
 
   def _framegen(self, n):
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
     clip = self._source[0]
 
-    image = clip.frame(clip.frameCount - n - 1)
+    image = clip.frame(clip.frameCount - n - 1, region)
 
     return image
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions()
+
+
+
+  def _framegenBatch(self, ns):
+    clip = self._source[0]
+    return clip._frames([clip.frameCount - n - 1 for n in ns])
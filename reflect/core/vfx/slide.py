@@ -2,6 +2,9 @@
 
 from ..clips import VideoClip, clipMethod, memoizeHash
 from ..easing import linear
+from ..pool import FramePool
+from ..executor import BranchExecutor
+from ..util import intersectRegions
 import copy
 import numpy
 
@@ -147,7 +150,9 @@ class SlideTransitionVideoClip(VideoClip):
 
 
   def __init__(self, source, metadata, origin, frameCount, fValues):
-    super().__init__(source, metadata, isIndirection = True)
+    # As for crop, the frames are only worth caching if the sources render just the visible parts
+    isIndirection = not (source[0]._rendersRegions() or source[1]._rendersRegions())
+    super().__init__(source, metadata, isIndirection = isIndirection)
 
     self._origin = origin
     self._frameCount = frameCount
@@ -182,7 +187,17 @@ class SlideTransitionVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._origin, self._frameCount, tuple(self._fValues))
+
+
+
   def _framegen(self, n):
+    return self._framegenRegion(n, (0, 0, self.width, self.height))
+
+
+
+  def _framegenRegion(self, n, region):
     clip = self._source[0]
     successor = self._source[1]
     origin = self._origin
@@ -191,36 +206,40 @@ class SlideTransitionVideoClip(VideoClip):
     progress = fValues[n]
 
     if progress == 0.0:
-      return clip.frame(n)
+      return clip.frame(n, region)
     elif progress == 1.0:
-      return successor.frame(n)
-
-    image = clip.frame(n)
+      return successor.frame(n, region)
 
-    blittedImage = numpy.copy(image)
+    # Split the output into the part covered by the successor, which is shifted by (dx, dy) from
+    # where it is in the successor's frame, and the part where the clip is still visible
+    (width, height) = self.size
     if origin == "top":
-      h = int(progress * clip.height)
-      w = successor.width
-      y = clip.height - h
-      imageToBlit = successor.frame(n)[y:clip.height, 0:w]
-      blittedImage[0:h, 0:w] = imageToBlit
+      h = int(progress * height)
+      (successorPart, clipPart, dx, dy) = ((0, 0, width, h), (0, h, width, height), 0, h - height)
     elif origin == "bottom":
-      h = int(progress * clip.height)
-      w = successor.width
-      imageToBlit = successor.frame(n)[0:h, 0:w]
-      y = clip.height - h
-      blittedImage[y:clip.height, 0:clip.width] = imageToBlit
+      y = height - int(progress * height)
+      (successorPart, clipPart, dx, dy) = ((0, y, width, height), (0, 0, width, y), 0, y)
     elif origin == "left":
-      h = successor.height
-      w = int(progress * clip.width)
-      x = clip.width - w
-      imageToBlit = successor.frame(n)[0:h, x:clip.width]
-      blittedImage[0:h, 0:w] = imageToBlit
+      w = int(progress * width)
+      (successorPart, clipPart, dx, dy) = ((0, 0, w, height), (w, 0, width, height), w - width, 0)
     elif origin == "right":
-      h = successor.height
-      w = int(progress * clip.width)
-      imageToBlit = successor.frame(n)[0:h, 0:w]
-      x = clip.width - w
-      blittedImage[0:h, x:clip.width] = imageToBlit
+      x = width - int(progress * width)
+      (successorPart, clipPart, dx, dy) = ((x, 0, width, height), (0, 0, x, height), x, 0)
+
+    # Request only the visible parts of the two frames, rendering them concurrently if possible
+    successorPart = intersectRegions(successorPart, region)
+    clipPart = intersectRegions(clipPart, region)
+    requests = []
+    if clipPart is not None:
+      requests.append((clip, n, clipPart))
+    if successorPart is not None:
+      (x1, y1, x2, y2) = successorPart
+      requests.append((successor, n, (x1 - dx, y1 - dy, x2 - dx, y2 - dy)))
+    images = BranchExecutor.current().frames(requests)
+
+    (rx1, ry1, rx2, ry2) = region
+    blittedImage = FramePool.current().empty((ry2 - ry1, rx2 - rx1) + images[0].shape[2:], images[0].dtype)
+    for (x1, y1, x2, y2), image in zip([part for part in [clipPart, successorPart] if part is not None], images):
+      blittedImage[y1 - ry1:y2 - ry1, x1 - rx1:x2 - rx1] = image
 
     return blittedImage
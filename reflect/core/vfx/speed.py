@@ -149,5 +149,25 @@ class SpedVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._scale,)
+
+
+
   def _framegen(self, n):
-    return self._source[0].frame(int(n * self._scale))
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
+    return self._source[0].frame(int(n * self._scale), region)
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions()
+
+
+
+  def _framegenBatch(self, ns):
+    return self._source[0]._frames([int(n * self._scale) for n in ns])
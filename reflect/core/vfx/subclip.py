@@ -192,7 +192,17 @@ class SubVideoClip(VideoClip):
 
 
 
+  def _fingerprintParameters(self):
+    return (self._n1, self._n2)
+
+
+
   def _framegen(self, n):
+    return self._framegenRegion(n, None)
+
+
+
+  def _framegenRegion(self, n, region):
     clip = self._source[0]
 
     n1 = self._n1
@@ -203,6 +213,25 @@ class SubVideoClip(VideoClip):
     elif n >= n2 - n1:
       raise IndexError("received a request for the frame at index {}, but this subclip only contains {} frames".format(n, n2 - n1))
 
-    image = clip.frame(n + n1)
+    image = clip.frame(n + n1, region)
 
     return image
+
+
+
+  def _rendersRegions(self):
+    return self._source[0]._rendersRegions()
+
+
+
+  def _framegenBatch(self, ns):
+    n1 = self._n1
+    n2 = self._n2
+
+    for n in ns:
+      if n < 0:
+        raise IndexError("received a request for a frame with a negative index ({})".format(n))
+      elif n >= n2 - n1:
+        raise IndexError("received a request for the frame at index {}, but this subclip only contains {} frames".format(n, n2 - n1))
+
+    return self._source[0]._frames([n + n1 for n in ns])
@@ -2,5 +2,10 @@
 
 from .server import *
 from .cache import *
+from .tiers import Tier, CompressedTier, DiskTier, SharedMemoryTier
+from .memory import MemoryMonitor
+from .prefetch import Prefetcher
+from .trace import TraceRecorder, readTrace
+from .simulator import simulate
 from .util import getch
 from .window import Window
@@ -2,6 +2,15 @@
 
 import logging
 import time
+import os
+import json
+import math
+import threading
+import collections
+import tempfile
+import zlib
+import numpy
+from ..core.pool import FramePool
 
 visualiseFilepath = None
 
@@ -268,7 +277,7 @@ class CacheEntry(dict):
   def __init__(self, node, isRoot, isHotnode, precedesHotnode, rootDistance, isIndirection, traverseTime):
     super().__init__()
 
-    self.age = 0
+    self.epoch = 0 # The last epoch (see Cache.reprioritise) in which this entry's node was in the composition graph
     self.node = node
     self.isRoot = isRoot
     self.isHotnode = isHotnode
@@ -278,16 +287,38 @@ class CacheEntry(dict):
     self.associatedIndirections = []
     self.successors = {}
     self.traverseTime = traverseTime
+    self.renderCost = None # The measured render time per byte of this node's frames (see CostAwareCache)
+    self.stats = self.emptyStats() # Per-node statistics (see Cache.nodeStats)
 
 
 
-  def discardFrame(self, n):
-    """discardFrame(n)
+  @staticmethod
+  def emptyStats():
+    return {
+      "hits": 0,
+      "compulsoryMisses": 0,
+      "noncompulsoryMisses": 0,
+      "evictions": 0,
+      "renders": 0,
+      "renderTime": 0.0,    # Total wall time spent in _framegen, including source frames
+      "selfRenderTime": 0.0 # Total wall time spent in _framegen, excluding source frames
+    }
+
+
+
+  def discardFrame(self, n, onDiscard = None):
+    """discardFrame(n, onDiscard = None)
 
     Discard the specific frame `n`, and return the exact number of bytes discarded.
+    If given, `onDiscard(cacheEntry, n, data)` is called just before the frame is discarded, and
+    returns the number of bytes that discarding it will free.
     """
 
-    discardedBytes = self[n].nbytes
+    data = dict.__getitem__(self, n)
+    if onDiscard is not None:
+      discardedBytes = onDiscard(self, n, data)
+    else:
+      discardedBytes = data.nbytes
     del self[n]
 
     return discardedBytes
@@ -296,6 +327,7 @@ class CacheEntry(dict):
 
   @property
   def priority(self):
+    # The priority of this entry as of its epoch; it halves with every epoch after that (see dampedPriority)
     if self.isIndirection:
       return float("-inf")
     elif self.associatedIndirections:
@@ -310,9 +342,20 @@ class CacheEntry(dict):
   @property
   def rawPriority(self):
     if (self.precedesHotnode and not self.isHotnode) or len(self.successors) < 1:
-      return (1.0 + self.rootDistance + 100.0) / (2**self.age)
+      return 1.0 + self.rootDistance + 100.0
     else:
-      return (1.0 + self.rootDistance) / (2**self.age)
+      return 1.0 + self.rootDistance
+
+
+
+  def dampedPriority(self, epoch):
+    """dampedPriority(epoch)
+
+    Return the priority of this entry as of `epoch`, which is halved for each epoch that its node
+    has been absent from the composition graph.
+    """
+
+    return self.priority / (2**(epoch - self.epoch))
 
 
 
@@ -350,11 +393,11 @@ class SpecialisedCacheEntry(CacheEntry):
 
 
 
-  def discardBytes(self, target):
-    """discardBytes(target)
+  def discardBytes(self, target, onDiscard = None):
+    """discardBytes(target, onDiscard = None)
 
     Discard at least `target` bytes of data from this cache entry, and return the exact number
-    of bytes discarded.
+    of bytes discarded. `onDiscard` is as for discardFrame.
     """
 
     bytesDiscarded = 0
@@ -363,7 +406,11 @@ class SpecialisedCacheEntry(CacheEntry):
 
       # Using self[n] here would involve calling self.heldFrames.access(n), which would fail
       # because n has already been popped.
-      bytesDiscarded += dict.__getitem__(self, n).nbytes
+      data = dict.__getitem__(self, n)
+      if onDiscard is not None:
+        bytesDiscarded += onDiscard(self, n, data)
+      else:
+        bytesDiscarded += data.nbytes
 
       del self[n]
 
@@ -371,97 +418,840 @@ class SpecialisedCacheEntry(CacheEntry):
 
 
 
-class SpecialisedPriorityQueue(object):
-  """SpecialisedPriorityQueue()
+class StagingSpill(object):
+  """StagingSpill(directory = None)
+
+  A temporary file into which frames are spilled once the staging area is full (see Cache.stage).
+  Each frame is appended to the file and read back through a memory map, so that the operating
+  system can page it out instead of the process running out of memory. The file is created in
+  `directory` (by default, the system's temporary directory) when it is first needed, and is
+  deleted when the spill is closed; frames that were read from it remain valid until they are
+  garbage collected.
+  """
+
+
+
+  def __init__(self, directory = None):
+    self.directory = directory
+    self.size = 0 # The number of bytes spilled so far
+    self._file = None
+
+
+
+  def put(self, data):
+    """put(data)
+
+    Write `data` to the end of the file, and return a read-only copy of it that is backed by the file.
+    """
+
+    if data.nbytes == 0:
+      return data
+    if self._file is None:
+      self._file = tempfile.TemporaryFile(prefix = "reflect-staging-", dir = self.directory)
+
+    offset = self.size
+    self._file.seek(offset)
+    numpy.ascontiguousarray(data).tofile(self._file)
+    self._file.flush()
+    self.size += data.nbytes
+    return numpy.asarray(numpy.memmap(self._file, dtype = data.dtype, mode = "r", offset = offset, shape = data.shape))
+
+
+
+  @staticmethod
+  def isSpilled(data):
+    return isinstance(data.base, numpy.memmap)
 
-  Keeps track of clips in the cache in ascending order of their priority.
+
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    self.size = 0
+
+
+
+class BufferLedger(object):
+  """BufferLedger(compactionRatio = 4, deduplicate = False)
+
+  Keeps track of the memory that is actually held by cached frames. A frame may be a view of a
+  larger buffer (e.g. a crop of a decoded frame), and several frames may share one buffer, so each
+  frame is attributed to the buffer that ultimately owns its memory (found by following
+  `ndarray.base`), and each buffer is counted once, at its full size.
+
+  A view that is at most 1/`compactionRatio` of the size of its buffer is better off as a copy if
+  that would stop the whole buffer from being pinned in memory (see `compacted` and
+  `compactionCandidates`).
+
+  If `deduplicate` is set, the ledger also indexes cached frames by a hash of their contents, and
+  a frame that is identical to one already cached is replaced by that frame (see `compacted`), so
+  that the two share one buffer. This pays off for static title cards, letterboxing, slowed-down
+  clips that repeat frames, and the same effect applied to the same still.
   """
 
 
 
-  def __init__(self, cache):
-    self._cacheEntries = sorted(cache.values(), key = lambda entry: entry.priority)
+  def __init__(self, compactionRatio = 4, deduplicate = False):
+    self.compactionRatio = compactionRatio
+    self.deduplicate = deduplicate
 
-    # Create a map from cache entries to their index in the priority queue
-    self._cacheEntryIndices = {}
-    for i in range(len(self._cacheEntries)):
-      self._cacheEntryIndices[id(self._cacheEntries[i])] = i
+    # id(owner) → (owner, nbytes, holders), where holders maps (id(cacheEntry), n) to
+    # (cacheEntry, n, data) for every cached frame whose memory belongs to owner
+    self._buffers = {}
 
-    # Find the index of the leftmost lowest-priority nonempty cache entry
-    self._victimIndex = None
-    self.findNewVictim(start = 0)
+    self._digests = {}       # digest → { (id(cacheEntry), n): data }, for every cached frame with those contents
+    self._frameDigests = {}  # (id(cacheEntry), n) → digest
+    self._dedupedFrames = {} # (id(cacheEntry), n) → nbytes, for the frames that were replaced by an identical frame
+    self.dedupedBytes = 0    # The number of bytes that the frames in _dedupedFrames would otherwise hold
+    self.deduplications = 0  # The number of frames that have been replaced by an identical frame
+
+
+
+  def __len__(self):
+    return len(self._buffers)
+
+
+
+  @staticmethod
+  def ownerOf(data):
+    """ownerOf(data)
+
+    Return (owner, nbytes): the object that owns the memory of the array `data`, and its size.
+    """
+
+    owner = data
+    while isinstance(owner, numpy.ndarray) and owner.base is not None:
+      owner = owner.base
+    if owner is data:
+      return (data, data.nbytes)
+    try:
+      return (owner, memoryview(owner).nbytes)
+    except TypeError:
+      # The owner doesn't expose its buffer, so the best we can do is to count the frame itself
+      return (data, data.nbytes)
+
+
+
+  def cost(self, data):
+    # The number of bytes by which caching `data` would increase the memory held by the cache
+    (owner, nbytes) = self.ownerOf(data)
+    if id(owner) in self._buffers:
+      return 0
+    else:
+      return nbytes
+
+
+
+  @staticmethod
+  def digestOf(data):
+    # A cheap hash of the contents of `data`; frames with equal digests still need to be compared
+    return (data.shape, data.dtype.str, zlib.crc32(numpy.ascontiguousarray(data)))
+
+
+
+  def compacted(self, data, digest = None):
+    """compacted(data, digest = None)
+
+    Return (data, digest): the frame that should be cached in place of `data`, and its digest (or
+    None if not deduplicating), to be passed on to `add`. The frame is an identical frame that is
+    already cached (if deduplicating), or a copy of `data` if it is a small view of a buffer that
+    isn't otherwise held by the cache, or else `data` itself. `digest` may be given if it is already
+    known (see digestOf).
+    """
+
+    if self.deduplicate:
+      if digest is None:
+        digest = self.digestOf(data)
+      for identicalData in self._digests.get(digest, {}).values():
+        if numpy.array_equal(identicalData, data):
+          return (identicalData, digest)
+
+    (owner, nbytes) = self.ownerOf(data)
+    if owner is not data and id(owner) not in self._buffers and data.nbytes * self.compactionRatio <= nbytes:
+      data = data.copy()
+
+    return (data, digest)
+
+
+
+  def add(self, cacheEntry, n, data, digest = None):
+    # Record that frame n of cacheEntry holds `data`, whose digest is `digest` (if known), and
+    # return the number of bytes newly held
+    if self.deduplicate:
+      if digest is None:
+        digest = self.digestOf(data)
+      # The frame is a duplicate if compacted replaced it with a frame that is already cached
+      identicalFrames = self._digests.setdefault(digest, {})
+      isDuplicate = any(identicalData is data for identicalData in identicalFrames.values())
+      identicalFrames[(id(cacheEntry), n)] = data
+      self._frameDigests[(id(cacheEntry), n)] = digest
+      if isDuplicate:
+        self._dedupedFrames[(id(cacheEntry), n)] = data.nbytes
+        self.dedupedBytes += data.nbytes
+        self.deduplications += 1
+
+    (owner, nbytes) = self.ownerOf(data)
+    record = self._buffers.get(id(owner), None)
+    if record is None:
+      self._buffers[id(owner)] = (owner, nbytes, { (id(cacheEntry), n): (cacheEntry, n, data) })
+      return nbytes
+    else:
+      record[2][(id(cacheEntry), n)] = (cacheEntry, n, data)
+      return 0
+
+
+
+  def remove(self, cacheEntry, n, data):
+    # Record that frame n of cacheEntry no longer holds `data`, and return the number of bytes freed
+    if self.deduplicate:
+      digest = self._frameDigests.pop((id(cacheEntry), n), None)
+      wasDuplicate = (id(cacheEntry), n) in self._dedupedFrames
+      self.dedupedBytes -= self._dedupedFrames.pop((id(cacheEntry), n), 0)
+      if digest is not None:
+        identicalFrames = self._digests[digest]
+        identicalFrames.pop((id(cacheEntry), n), None)
+        if not identicalFrames:
+          del self._digests[digest]
+        elif not wasDuplicate:
+          # One of the duplicates of this frame now holds the buffer in its place
+          for key in identicalFrames:
+            if key in self._dedupedFrames:
+              self.dedupedBytes -= self._dedupedFrames.pop(key)
+              break
+
+    (owner, nbytes) = self.ownerOf(data)
+    record = self._buffers.get(id(owner), None)
+    if record is None:
+      return 0
+    record[2].pop((id(cacheEntry), n), None)
+    if record[2]:
+      return 0
+    else:
+      del self._buffers[id(owner)]
+      return nbytes
+
+
+
+  def compactionCandidates(self, data):
+    """compactionCandidates(data)
+
+    Return the (cacheEntry, n, data) frames that still hold the buffer of `data`, if copying them
+    would free that buffer and save at least 1 - 1/compactionRatio of its size. Otherwise, return
+    an empty list.
+    """
+
+    (owner, nbytes) = self.ownerOf(data)
+    record = self._buffers.get(id(owner), None)
+    if record is None:
+      return []
+    holders = list(record[2].values())
+    if sum(holderData.nbytes for holderEntry, holderN, holderData in holders) * self.compactionRatio <= nbytes:
+      return holders
+    else:
+      return []
+
+
+
+class IndexedHeap(object):
+  """IndexedHeap(keyOf, items = ())
+
+  A binary min-heap of objects ordered by `keyOf(item)`, which also keeps track of the index of
+  each item (by id), so that any item can be removed, or moved after its key has changed, in
+  O(log n) time.
+  """
+
+
+
+  def __init__(self, keyOf, items = ()):
+    self._keyOf = keyOf
+    self._heap = list(items)
+    self._indices = { id(item): i for i, item in enumerate(self._heap) } # id(item) → index in self._heap
+    for i in reversed(range(len(self._heap) // 2)):
+      self._siftDown(i)
+
+
+
+  def __len__(self):
+    return len(self._heap)
+
+
+
+  def __contains__(self, item):
+    return id(item) in self._indices
 
 
 
   def peek(self):
-    if self._victimIndex is not None:
-      return self._cacheEntries[self._victimIndex]
+    if self._heap:
+      return self._heap[0]
     else:
       return None
 
 
 
-  def findNewVictim(self, start = None):
-    # Find the index of the leftmost lowest-priority nonempty cache entry
-    if start is not None:
-      i = start
+  def add(self, item):
+    if id(item) in self._indices:
+      return
+    self._indices[id(item)] = len(self._heap)
+    self._heap.append(item)
+    self._siftUp(len(self._heap) - 1)
+
+
+
+  def remove(self, item):
+    i = self._indices.pop(id(item), None)
+    if i is None:
+      return
+    last = self._heap.pop()
+    if i < len(self._heap):
+      self._heap[i] = last
+      self._indices[id(last)] = i
+      self._siftUp(i)
+      self._siftDown(self._indices[id(last)])
+
+
+
+  def update(self, item):
+    # Restore the heap property after the key of `item` has changed (in either direction)
+    i = self._indices.get(id(item), None)
+    if i is not None:
+      self._siftUp(i)
+      self._siftDown(self._indices[id(item)])
+
+
+
+  def _less(self, i, j):
+    return self._keyOf(self._heap[i]) < self._keyOf(self._heap[j])
+
+
+
+  def _swap(self, i, j):
+    (self._heap[i], self._heap[j]) = (self._heap[j], self._heap[i])
+    self._indices[id(self._heap[i])] = i
+    self._indices[id(self._heap[j])] = j
+
+
+
+  def _siftUp(self, i):
+    while i > 0:
+      parent = (i - 1) // 2
+      if not self._less(i, parent):
+        break
+      self._swap(i, parent)
+      i = parent
+
+
+
+  def _siftDown(self, i):
+    n = len(self._heap)
+    while True:
+      smallest = i
+      for child in (2 * i + 1, 2 * i + 2):
+        if child < n and self._less(child, smallest):
+          smallest = child
+      if smallest == i:
+        break
+      self._swap(i, smallest)
+      i = smallest
+
+
+
+class SpecialisedPriorityQueue(object):
+  """SpecialisedPriorityQueue(cacheEntries, epoch)
+
+  Keeps track of the nonempty cache entries in ascending order of their priority, so that the
+  victim can be found, and entries can be added, removed, or have their priority changed, in
+  O(log n) time.
+
+  Priorities are cached as keys in the log domain. An entry's priority halves with each epoch
+  (reprioritisation) since its node was last in the composition graph, so its key is the log of its
+  priority as of that epoch, plus the epoch. The keys of entries outside the current graph
+  therefore never change, while the keys of entries inside it all rise by one with each epoch. The
+  two kinds of entry are kept in separate indexed heaps, whose orders are unaffected by a new
+  epoch, so a reprioritisation only needs to move the entries that joined or left the graph, and
+  update the entries whose priority changed (see Cache.reprioritise).
+  """
+
+
+
+  def __init__(self, cacheEntries, epoch):
+    self.epoch = epoch
+    self._keys = {}          # id(cacheEntry) → (key, tiebreaker), the log of its priority as of its epoch
+    self._retiredEpochs = {} # id(cacheEntry) → the last epoch in which it was in the graph, if it isn't in the current graph
+    self._counter = 0
+
+    currentCacheEntries = []
+    retiredCacheEntries = []
+    for cacheEntry in cacheEntries:
+      self._keys[id(cacheEntry)] = self._computeKey(cacheEntry)
+      if cacheEntry.epoch != epoch:
+        self._retiredEpochs[id(cacheEntry)] = cacheEntry.epoch
+        if len(cacheEntry) > 0:
+          retiredCacheEntries.append(cacheEntry)
+      elif len(cacheEntry) > 0:
+        currentCacheEntries.append(cacheEntry)
+    self._current = IndexedHeap(self._currentKey, currentCacheEntries) # The nonempty entries in the current graph
+    self._retired = IndexedHeap(self._retiredKey, retiredCacheEntries) # The nonempty entries that aren't
+
+
+
+  def __len__(self):
+    return len(self._current) + len(self._retired)
+
+
+
+  def __contains__(self, cacheEntry):
+    return cacheEntry in self._current or cacheEntry in self._retired
+
+
+
+  def _computeKey(self, cacheEntry):
+    priority = cacheEntry.priority
+    if priority > 0:
+      key = math.log2(priority)
+    else:
+      key = float("-inf")
+    # Ties are broken in favour of evicting the entry whose key was computed first
+    self._counter += 1
+    return (key, self._counter)
+
+
+
+  def _currentKey(self, cacheEntry):
+    # Every entry in the current graph has the same epoch, so it can be left out
+    return self._keys[id(cacheEntry)]
+
+
+
+  def _retiredKey(self, cacheEntry):
+    (key, tiebreaker) = self._keys[id(cacheEntry)]
+    return (key + self._retiredEpochs[id(cacheEntry)], tiebreaker)
+
+
+
+  def _fullKey(self, cacheEntry):
+    (key, tiebreaker) = self._keys[id(cacheEntry)]
+    return (key + self._retiredEpochs.get(id(cacheEntry), self.epoch), tiebreaker)
+
+
+
+  def priorityKey(self, cacheEntry):
+    """priorityKey(cacheEntry)
+
+    Return the cached key of `cacheEntry`. Keys are ordered in the same way as priorities.
+    """
+
+    if id(cacheEntry) not in self._keys:
+      self._keys[id(cacheEntry)] = self._computeKey(cacheEntry)
+    return self._fullKey(cacheEntry)[0]
+
+
+
+  def peek(self):
+    current = self._current.peek()
+    retired = self._retired.peek()
+    if current is None:
+      return retired
+    elif retired is None or self._fullKey(current) < self._fullKey(retired):
+      return current
+    else:
+      return retired
+
+
+
+  def add(self, cacheEntry):
+    # Called when `cacheEntry` may have become nonempty
+    self.priorityKey(cacheEntry)
+    if id(cacheEntry) in self._retiredEpochs:
+      self._retired.add(cacheEntry)
+    else:
+      self._current.add(cacheEntry)
+
+
+
+  def remove(self, cacheEntry):
+    # Called when `cacheEntry` has become empty
+    self._current.remove(cacheEntry)
+    self._retired.remove(cacheEntry)
+
+
+
+  def forget(self, cacheEntry):
+    # Called when `cacheEntry` is purged from the cache
+    self.remove(cacheEntry)
+    self._keys.pop(id(cacheEntry), None)
+    self._retiredEpochs.pop(id(cacheEntry), None)
+
+
+
+  def update(self, cacheEntry):
+    """update(cacheEntry)
+
+    Recompute the key of `cacheEntry` after its priority has changed (in either direction).
+    """
+
+    self._keys[id(cacheEntry)] = self._computeKey(cacheEntry)
+    self._current.update(cacheEntry)
+    self._retired.update(cacheEntry)
+
+
+
+  def reprioritise(self, epoch, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
+    """reprioritise(epoch, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries)
+
+    Move on to `epoch`, given the entries that joined the graph (including new entries), the
+    entries that left it, the entries that stayed in it but whose priority changed, and the entries
+    that were purged from the cache.
+    """
+
+    self.epoch = epoch
+    for cacheEntry in purgedCacheEntries:
+      self.forget(cacheEntry)
+    for cacheEntry in leftCacheEntries:
+      self._retiredEpochs[id(cacheEntry)] = cacheEntry.epoch
+      if cacheEntry in self._current:
+        self._current.remove(cacheEntry)
+        self._retired.add(cacheEntry)
+    for cacheEntry in joinedCacheEntries:
+      self._retired.remove(cacheEntry)
+      self._retiredEpochs.pop(id(cacheEntry), None)
+      self._keys[id(cacheEntry)] = self._computeKey(cacheEntry)
+      if len(cacheEntry) > 0:
+        self._current.add(cacheEntry)
+    for cacheEntry in changedCacheEntries:
+      self.update(cacheEntry)
+
+
+
+class CostAwarePriorityQueue(SpecialisedPriorityQueue):
+  """CostAwarePriorityQueue(cacheEntries, epoch)
+
+  A SpecialisedPriorityQueue whose keys also weigh each cache entry's measured render cost per
+  byte, in the manner of GreedyDual-Size: an entry's key is log2(priority × cost ÷ bytes), offset
+  by its epoch, which plays the part of GreedyDual's inflation value.
+
+  Entries whose render cost is unknown (e.g. because their frames were promoted from a secondary
+  tier rather than rendered) sort first, since they are presumably cheap to fetch again.
+  """
+
+
+
+  def _computeKey(self, cacheEntry):
+    (key, tiebreaker) = super()._computeKey(cacheEntry)
+    if cacheEntry.renderCost is not None and cacheEntry.renderCost > 0:
+      key += math.log2(cacheEntry.renderCost)
+    else:
+      key = float("-inf")
+    return (key, tiebreaker)
+
+
+
+class FrameQueue(RecentlyUsedQueue):
+  # A RecentlyUsedQueue of (cacheEntry, n) frames
+
+  def keyOf(self, data):
+    cacheEntry, n = data
+    return (id(cacheEntry), n)
+
+
+
+class AdaptiveReplacementQueue(object):
+  """AdaptiveReplacementQueue(capacity)
+
+  Keeps track of cached frames for the ARC algorithm. Frames that have been used once since they
+  were cached are kept in T1, and frames that have been used at least twice are kept in T2, each
+  ordered from most to least recently used. B1 and B2 are "ghost" lists, which remember the frames
+  that were recently evicted from T1 and T2 respectively, but not their data.
+
+  The victim is taken from T1 when T1 holds more than `target` bytes, and otherwise from T2. When
+  a frame is cached again soon after it has been evicted, i.e. while it is still in a ghost list,
+  the target is adjusted in favour of the list that it was evicted from, so ARC adapts between
+  recency (e.g. scrubbing back and forth) and frequency (e.g. playing a loop), and a single pass
+  over many new frames can only flush T1.
+
+  Sizes are measured in bytes rather than in frames, since frames of different clips differ in size.
+  """
+
+
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.target = 0 # The number of bytes that T1 should hold
+    self._lists = { "t1": FrameQueue(), "t2": FrameQueue(), "b1": FrameQueue(), "b2": FrameQueue() }
+    self._bytes = { "t1": 0, "t2": 0, "b1": 0, "b2": 0 }
+    self._sizes = {} # key → (name of the list holding the frame, nbytes)
+
+
+
+  def resize(self, capacity):
+    self.capacity = capacity
+    self.target = min(self.target, capacity)
+
+
+
+  def __len__(self):
+    return len(self._lists["t1"]) + len(self._lists["t2"])
+
+
+
+  def __contains__(self, data):
+    # Only resident frames count
+    record = self._sizes.get(self._lists["t1"].keyOf(data), None)
+    return record is not None and record[0] in ["t1", "t2"]
+
+
+
+  def isEmpty(self):
+    return len(self) == 0
+
+
+
+  def _add(self, name, data, nbytes):
+    self._lists[name].insert(data)
+    self._bytes[name] += nbytes
+    self._sizes[self._lists[name].keyOf(data)] = (name, nbytes)
+
+
+
+  def _remove(self, name, data):
+    self._lists[name].delete(data)
+    (name, nbytes) = self._sizes.pop(self._lists[name].keyOf(data))
+    self._bytes[name] -= nbytes
+    return nbytes
+
+
+
+  def _popTail(self, name):
+    data = self._lists[name].tail.data
+    return (data, self._remove(name, data))
+
+
+
+  def access(self, data):
+    # Called on a hit: the frame has now been used at least twice
+    (name, nbytes) = self._sizes[self._lists["t1"].keyOf(data)]
+    if name == "t1":
+      self._remove("t1", data)
+      self._add("t2", data, nbytes)
     else:
-      i = self._victimIndex
+      self._lists["t2"].access(data)
+
+
+
+  def admit(self, data, nbytes):
+    """admit(data, nbytes)
 
-    while i < len(self._cacheEntries) and len(self._cacheEntries[i]) == 0:
-      i += 1
+    Prepare to cache the frame `data`, adapting the target if the frame is in a ghost list. Must be
+    called before evicting any frames to make room for it. Returns the name of the ghost list that
+    the frame was found in (or None), which must be passed on to popVictim and insert.
+    """
 
-    if i < len(self._cacheEntries):
-      # A nonempty cache entry was found; this will be the first victim
-      self._victimIndex = i
+    record = self._sizes.get(self._lists["t1"].keyOf(data), None)
+    if record is None:
+      return None
+    (name, ghostBytes) = record
+    if name not in ["b1", "b2"]:
+      return None
+    if name == "b1":
+      # T1 was too small to keep this frame
+      delta = max(self._bytes["b2"] / max(self._bytes["b1"], 1), 1) * nbytes
+      self.target = min(self.capacity, self.target + delta)
     else:
-      self._victimIndex = None
+      # T2 was too small to keep this frame
+      delta = max(self._bytes["b1"] / max(self._bytes["b2"], 1), 1) * nbytes
+      self.target = max(0, self.target - delta)
+    self._remove(name, data)
+    return name
+
+
+
+  def popVictim(self, admittedFrom = None):
+    """popVictim(admittedFrom = None)
+
+    Remove and return the frame that should be evicted next, remembering it in a ghost list.
+    `admittedFrom` is the result of admit for the frame that is being made room for.
+    """
+
+    t1Bytes = self._bytes["t1"]
+    if len(self._lists["t1"]) > 0 and (t1Bytes > self.target or (t1Bytes == self.target and admittedFrom == "b2") or len(self._lists["t2"]) == 0):
+      (data, nbytes) = self._popTail("t1")
+      self._add("b1", data, nbytes)
+    else:
+      (data, nbytes) = self._popTail("t2")
+      self._add("b2", data, nbytes)
+    return data
 
 
 
-  def setVictim(self, cacheEntry):
-    newVictimIndex = self._cacheEntryIndices[id(cacheEntry)]
-    if self._victimIndex is not None and self.peek().priority == cacheEntry.priority:
-      # Ensure the new victim is the *leftmost* cache entry of this priority
-      self._victimIndex = min(self._victimIndex, newVictimIndex)
+  def insert(self, data, nbytes, admittedFrom = None):
+    # Called once the admitted frame has been cached, with the result of admit
+    if admittedFrom is None:
+      self._add("t1", data, nbytes)
     else:
-      self._victimIndex = newVictimIndex
+      self._add("t2", data, nbytes)
 
+    # Forget the oldest ghosts, so that T1 + B1 and the lists as a whole don't remember too much
+    while len(self._lists["b1"]) > 0 and self._bytes["t1"] + self._bytes["b1"] > self.capacity:
+      self._popTail("b1")
+    while len(self._lists["b2"]) > 0 and sum(self._bytes.values()) > 2 * self.capacity:
+      self._popTail("b2")
 
 
 
+class LIRSQueue(object):
+  """LIRSQueue(capacity, hirFraction = 0.1)
 
+  Keeps track of cached frames for the LIRS algorithm, which ranks frames by their inter-reference
+  recency (IRR): the number of other frames used between the last two uses of a frame.
 
+  Frames with a low IRR (LIR frames) take up to 1 - `hirFraction` of the capacity, and are only
+  evicted after being demoted. The remaining frames (HIR frames) cycle through a small FIFO queue,
+  from which victims are taken. The stack S holds frames in order of recency, including recently
+  evicted HIR frames ("ghosts"), and its bottom is always a LIR frame; a HIR frame that is used
+  again while it is in S has a lower IRR than the bottom LIR frame, so the two swap roles.
+
+  Unlike LRU, a loop over more frames than fit in the cache doesn't evict every frame before it is
+  used again: the LIR frames stay put, and only the HIR frames are cycled.
+  """
 
 
 
+  def __init__(self, capacity, hirFraction = 0.1):
+    self.capacity = capacity
+    self.hirFraction = hirFraction
+    self.lirCapacity = capacity * (1 - hirFraction)
+    self._stack = FrameQueue() # S, from most to least recent
+    self._queue = FrameQueue() # Q, the resident HIR frames, from newest to oldest
+    self._status = {} # key → ("lir" | "hir" | "ghost", nbytes)
+    self._ghosts = collections.OrderedDict() # key → data, from oldest to newest
+    self._lirBytes = 0
 
 
 
+  def __len__(self):
+    return len(self._status) - len(self._ghosts)
 
 
 
+  def __contains__(self, data):
+    record = self._status.get(self._stack.keyOf(data), None)
+    return record is not None and record[0] != "ghost"
 
 
 
+  def isEmpty(self):
+    return len(self) == 0
 
 
 
+  def _prune(self):
+    # Remove HIR frames from the bottom of S, so that the bottom is a LIR frame
+    while self._stack.tail is not None:
+      data = self._stack.tail.data
+      key = self._stack.keyOf(data)
+      (status, nbytes) = self._status[key]
+      if status == "lir":
+        break
+      self._stack.delete(data)
+      if status == "ghost":
+        del self._status[key]
+        del self._ghosts[key]
 
 
 
+  def resize(self, capacity):
+    self.capacity = capacity
+    self.lirCapacity = capacity * (1 - self.hirFraction)
+    while self._lirBytes > self.lirCapacity and self._stack.tail is not None:
+      self._demoteBottom()
 
 
 
+  def _demoteBottom(self):
+    # Turn the least recent LIR frame into a resident HIR frame
+    data = self._stack.popTail()
+    key = self._stack.keyOf(data)
+    (status, nbytes) = self._status[key]
+    self._status[key] = ("hir", nbytes)
+    self._lirBytes -= nbytes
+    self._queue.insert(data)
+    self._prune()
 
 
 
+  def _promote(self, data, nbytes):
+    # Turn a frame that is in S into a LIR frame, at the top of S
+    self._stack.access(data)
+    self._status[self._stack.keyOf(data)] = ("lir", nbytes)
+    self._lirBytes += nbytes
+    while self._lirBytes > self.lirCapacity and self._stack.keyOf(self._stack.tail.data) != self._stack.keyOf(data):
+      self._demoteBottom()
+    self._prune()
 
 
 
+  def access(self, data):
+    # Called on a hit
+    key = self._stack.keyOf(data)
+    (status, nbytes) = self._status[key]
+    if status == "lir":
+      self._stack.access(data)
+      self._prune()
+    elif data in self._stack:
+      self._queue.delete(data)
+      self._promote(data, nbytes)
+    else:
+      self._stack.insert(data)
+      self._queue.delete(data)
+      self._queue.insert(data)
+
+
+
+  def insert(self, data, nbytes):
+    # Called once a frame has been cached
+    key = self._stack.keyOf(data)
+    record = self._status.get(key, None)
+    if record is not None:
+      # The frame is a ghost, i.e. it was evicted recently enough that it is still in S
+      del self._ghosts[key]
+      self._promote(data, nbytes)
+    elif self._lirBytes + nbytes <= self.lirCapacity:
+      # The cache is still warming up
+      self._stack.insert(data)
+      self._status[key] = ("lir", nbytes)
+      self._lirBytes += nbytes
+    else:
+      self._stack.insert(data)
+      self._queue.insert(data)
+      self._status[key] = ("hir", nbytes)
 
 
 
+  def popVictim(self):
+    """popVictim()
+
+    Remove and return the frame that should be evicted next. If it is in S, it becomes a ghost.
+    """
+
+    if len(self._queue) == 0:
+      self._demoteBottom()
+    data = self._queue.popTail()
+    key = self._queue.keyOf(data)
+    if data in self._stack:
+      self._status[key] = ("ghost", self._status[key][1])
+      self._ghosts[key] = data
+      # Don't remember more ghosts than there are resident frames
+      while len(self._ghosts) > max(len(self), 1):
+        (ghostKey, ghost) = self._ghosts.popitem(last = False)
+        self._stack.delete(ghost)
+        del self._status[ghostKey]
+      self._prune()
+    else:
+      del self._status[key]
+    return data
+
+
 
 
 
@@ -501,6 +1291,73 @@ class SpecialisedPriorityQueue(object):
 
 
 
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+def synchronised(f):
+  """@synchronised
+
+  A decorator for Cache methods that restructure the cache (evicting frames, committing, resizing,
+  ...), which must hold the cache's eviction lock. The lock is reentrant, so synchronised methods
+  may call each other.
+  """
+
+  def wrapper(self, *args, **kwargs):
+    with self._evictionLock:
+      return f(self, *args, **kwargs)
+
+  return wrapper
+
+
+
+def queueSynchronised(f):
+  """@queueSynchronised
+
+  Like @synchronised, but also holds the queue lock, for Cache methods that change the priorities
+  of many entries at once (i.e. reprioritise), during which no frame may be added. Such methods
+  must not acquire any stripe locks.
+  """
+
+  def wrapper(self, *args, **kwargs):
+    with self._evictionLock:
+      with self._queueLock:
+        return f(self, *args, **kwargs)
+
+  return wrapper
+
+
+
 class Cache:
   """Cache()
 
@@ -513,10 +1370,22 @@ class Cache:
   At any point in time, there is exactly one active cache, accessible via the static
   `current` method. Usually it can be left untouched, but it may be swapped in order to enable
   advanced manipulation of multiple distinct caches.
+
+  The cache may be used from several threads at once. Reading or adding a frame holds the lock of
+  the cache entry's stripe, so that threads working on different entries don't contend with each
+  other, and then briefly the queue lock, which guards the eviction policy's queue and the count of
+  bytes held. Only evicting frames, committing, resizing and reprioritising hold the eviction lock
+  (see @synchronised), so one thread evicts at a time while others keep adding frames that fit.
+  Locks are always acquired in the order: eviction lock, stripe lock, queue lock, tier lock,
+  statistics lock, and no eviction or stripe lock is acquired while holding the queue lock.
   """
 
 
 
+  stripeCount = 64
+
+
+
   @staticmethod
   def current():
     return globals()["currentCache"]
@@ -536,7 +1405,7 @@ class Cache:
 
 
 
-  def __init__(self, maxSize, enableStatistics = False):
+  def __init__(self, maxSize, enableStatistics = False, maxStagedSize = None, stagingSpillDirectory = None, deduplicate = False):
     # These two-level dicts implement functions (clip → n → data).
     # They are expected (but not strictly required) to be disjoint, i.e.
     #   (n in committed[clip]) -> not(n in staged[clip]),
@@ -544,17 +1413,42 @@ class Cache:
     self._committed = {} # Persistent store
     self._staged = {}    # Temporary staging area, emptied at the end of script execution
 
+    # Staged frames are held in memory up to `maxStagedSize` bytes (by default, the size of the
+    # cache, following it if it is resized), and are spilled to a temporary file after that
+    self.maxStagedSize = maxStagedSize if maxStagedSize is not None else maxSize
+    self._stagedSizeFollowsMaxSize = maxStagedSize is None
+    self._stagedSize = 0 # The number of bytes of staged frames held in memory
+    self._stagingSpill = StagingSpill(stagingSpillDirectory)
+
     self._priorityQueue = None
+    self._epoch = 0 # The number of reprioritisations so far
+    self._graphCacheEntries = {}   # id(cacheEntry) → cacheEntry, for the nodes of the current composition graph
+    self._retiredCacheEntries = {} # epoch → { id(cacheEntry) → cacheEntry }, for entries whose nodes were last in the graph in that epoch
+    self._agedCacheEntries = {}    # id(cacheEntry) → cacheEntry, for entries that are old enough to be purged (see reprioritise)
 
     self.userScriptIsRunning = False # Determines which store to send incoming frames to
 
     self._stagingAreaIsLocked = False # Can be locked to temporarily prevent any frames from being staged
 
-    self._currentSize = 0
+    self._currentSize = 0 # The number of bytes held by the main cache, as counted by the ledger
+    self.rejections = 0 # The number of frames that were too low-priority to be cached
     self.maxSize = maxSize
+    self._ledger = BufferLedger(deduplicate = deduplicate) # If deduplicating, identical frames share one buffer
 
     self._enableStatistics = enableStatistics
 
+    self._evictionLock = threading.RLock()
+    self._stripeLocks = [threading.RLock() for _ in range(self.stripeCount)]
+    self._queueLock = threading.RLock()
+    self._tierLock = threading.RLock()
+    self._statsLock = threading.Lock()
+
+    # Secondary tiers (e.g. DiskTier), searched in order on a miss. Discarded frames spill into the
+    # first tier, which may in turn spill into the next.
+    self._tiers = []
+
+    self._trace = None # A TraceRecorder, if the workload is being traced (see startTrace)
+
     # For evaluation
     self.resetStats()
     self.CacheEntryImplementation = CacheEntry
@@ -566,6 +1460,7 @@ class Cache:
     stagedClips = len(self._staged)
     stagedFrames = 0
     stagedBytes = 0
+    spilledBytes = 0
     for clip, entry in self._staged.items():
       h = clip.__hash__()
       if h not in stagedBins:
@@ -573,6 +1468,8 @@ class Cache:
       stagedFrames += len(entry)
       for n, image in entry.items():
         stagedBytes += image.nbytes
+        if StagingSpill.isSpilled(image):
+          spilledBytes += image.nbytes
 
     committedBins = []
     committedClips = len(self._committed)
@@ -586,16 +1483,18 @@ class Cache:
       for n, image in entry.items():
         committedBytes += image.nbytes
 
-    return "<{}: ({} frames, {} MiB) staged / ({} bins, {} clips, {} frames, {} MiB) committed>".format(
+    return "<{}: ({} frames, {} MiB, {} MiB spilled) staged / ({} bins, {} clips, {} frames, {} of {} MiB) committed>".format(
       type(self).__name__,
       # len(stagedBins),
       # stagedClips,
       stagedFrames,
       round(stagedBytes / 1024 / 1024, 1),
+      round(spilledBytes / 1024 / 1024, 1),
       len(committedBins),
       committedClips,
       committedFrames,
-      round(committedBytes / 1024 / 1024, 1)
+      round(committedBytes / 1024 / 1024, 1),
+      round(self.maxSize / 1024 / 1024, 1)
     )
 
 
@@ -610,47 +1509,168 @@ class Cache:
     else:
       hitRatio = "inf"
 
-    return "Cache stats: {} h / {} ncm / {} cm / {} hr".format(
+    summary = "Cache stats: {} h / {} ncm / {} cm / {} hr".format(
       self._stats["hits"],
       self._stats["misses"]["noncompulsory"],
       self._stats["misses"]["compulsory"],
       hitRatio
     )
+    summary += " | size: {} of {} MiB".format(round(self._currentSize / 1024 / 1024, 1), round(self.maxSize / 1024 / 1024, 1))
+    if self._ledger.deduplicate:
+      summary += " | dedup: {} frames / {} MiB saved".format(self._ledger.deduplications, round(self._ledger.dedupedBytes / 1024 / 1024, 1))
+    for tier in self._tiers:
+      summary += " | {}".format(tier.stats())
+
+    return summary
 
 
 
   def resetStats(self):
-    self._stats = {
-      "hits": 0,
-      "misses": {
-        "compulsory": 0,
-        "noncompulsory": 0
-      },
-      "seenFrames": {}
-    }
+    with self._statsLock:
+      self._stats = {
+        "hits": 0,
+        "misses": {
+          "compulsory": 0,
+          "noncompulsory": 0
+        },
+        "seenFrames": {}
+      }
+      self._ledger.deduplications = 0
+    with self._evictionLock:
+      cacheEntries = list(self._committed.values())
+    with self._statsLock:
+      for cacheEntry in cacheEntries:
+        cacheEntry.stats = cacheEntry.emptyStats()
+    with self._tierLock:
+      for tier in self._tiers:
+        tier.resetStats()
+
+
+
+  def _stripeLock(self, cacheEntry):
+    # Object ids are aligned, so discard the low bits before choosing a stripe
+    return self._stripeLocks[(id(cacheEntry) >> 4) % self.stripeCount]
 
 
 
   def hit(self, cacheEntry, n):
+    # Must not be called while holding a stripe lock
     if self._enableStatistics:
       if not cacheEntry.isIndirection:
-        self._stats["hits"] += 1
+        with self._statsLock:
+          self._stats["hits"] += 1
+          cacheEntry.stats["hits"] += 1
 
 
 
   def miss(self, cacheEntry, n):
+    # (cacheEntry is None while the user's script is running)
     if self._enableStatistics:
-      if not cacheEntry.isIndirection:
-        if (id(cacheEntry), n) in self._stats["seenFrames"]:
-          self._stats["misses"]["noncompulsory"] += 1
-        else:
-          self._stats["misses"]["compulsory"] += 1
+      if cacheEntry is not None and not cacheEntry.isIndirection:
+        with self._statsLock:
+          if (id(cacheEntry), n) in self._stats["seenFrames"]:
+            self._stats["misses"]["noncompulsory"] += 1
+            cacheEntry.stats["noncompulsoryMisses"] += 1
+          else:
+            self._stats["misses"]["compulsory"] += 1
+            cacheEntry.stats["compulsoryMisses"] += 1
+
+
+
+  def rendered(self, clip, n, image, renderTime, selfRenderTime):
+    # Called by VideoClip.frame after rendering frame n of clip, with the time that it took
+    trace = self._trace
+    if trace is not None:
+      trace.render(clip, n, image.nbytes, renderTime, selfRenderTime, self.userScriptIsRunning)
+    if self._tiers and not clip.isIndirection:
+      # Share the frame with any tiers that other processes can see
+      with self._tierLock:
+        for tier in self._tiers:
+          if tier.writeThrough:
+            tier.put(tier.keyOf(clip, n), image)
+    if self._enableStatistics:
+      cacheEntry = clip.cacheEntry
+      if cacheEntry is not None:
+        with self._statsLock:
+          cacheEntry.stats["renders"] += 1
+          cacheEntry.stats["renderTime"] += renderTime
+          cacheEntry.stats["selfRenderTime"] += selfRenderTime
+
+
+
+  def nodeStats(self):
+    """nodeStats()
+
+    Return a list of statistics for each node in the cache, ordered from the most to the least
+    missed. Each item is a dict of the node's name, fingerprint, and cache entry details; the frames
+    and bytes it holds; its hits, compulsory and noncompulsory misses, evictions, and renders; and
+    the total and mean time spent rendering its frames, both including and excluding its sources.
+    The counters are only collected while statistics are enabled (see resetStats).
+    """
+
+    with self._evictionLock:
+      cacheEntries = list(self._committed.values())
+
+    nodes = []
+    for cacheEntry in cacheEntries:
+      with self._stripeLock(cacheEntry):
+        frames = list(dict.values(cacheEntry))
+      with self._statsLock:
+        stats = cacheEntry.stats.copy()
+      renders = stats["renders"]
+      nodes.append({
+        "node": str(cacheEntry.node),
+        "fingerprint": cacheEntry.node.fingerprint,
+        "isIndirection": cacheEntry.isIndirection,
+        "rootDistance": cacheEntry.rootDistance,
+        "age": self._epoch - cacheEntry.epoch,
+        "framesHeld": len(frames),
+        "bytesHeld": sum(data.nbytes for data in frames),
+        "hits": stats["hits"],
+        "compulsoryMisses": stats["compulsoryMisses"],
+        "noncompulsoryMisses": stats["noncompulsoryMisses"],
+        "evictions": stats["evictions"],
+        "renders": renders,
+        "totalRenderTime": stats["renderTime"],
+        "meanRenderTime": stats["renderTime"] / renders if renders != 0 else None,
+        "totalSelfRenderTime": stats["selfRenderTime"],
+        "meanSelfRenderTime": stats["selfRenderTime"] / renders if renders != 0 else None
+      })
+
+    nodes.sort(key = lambda node: (node["compulsoryMisses"] + node["noncompulsoryMisses"], node["noncompulsoryMisses"]), reverse = True)
+    return nodes
+
+
+
+  def writeNodeStats(self, filepath):
+    """writeNodeStats(filepath)
+
+    Write the global statistics and the per-node statistics (see nodeStats) to a JSON file.
+    """
+
+    with self._statsLock:
+      summary = {
+        "hits": self._stats["hits"],
+        "compulsoryMisses": self._stats["misses"]["compulsory"],
+        "noncompulsoryMisses": self._stats["misses"]["noncompulsory"]
+      }
+    report = {
+      "cache": type(self).__name__,
+      "maxSize": self.maxSize,
+      "currentSize": self._currentSize,
+      "summary": summary,
+      "nodes": self.nodeStats()
+    }
+    with open(filepath + ".tmp", "w", encoding = "utf-8") as f:
+      json.dump(report, f, indent = 2)
+    os.replace(filepath + ".tmp", filepath)
 
 
 
   def seenFrame(self, cacheEntry, n):
     if self._enableStatistics:
-      self._stats["seenFrames"][(id(cacheEntry), n)] = True
+      with self._statsLock:
+        self._stats["seenFrames"][(id(cacheEntry), n)] = True
 
 
 
@@ -663,19 +1683,44 @@ class Cache:
 
   @explicitChecker
   def get(self, clip, n, default = None, explicitParams = None):
-    # Check the staging area
-    if clip in self._staged:
-      if n in self._staged[clip]:
-        return self._staged[clip][n]
-
-    # Check the persistent store
+    # Check the staging area. The staging area may be replaced by a concurrent commit, so each
+    # dict is only read once (individual dict lookups are atomic).
+    stagedEntry = self._staged.get(clip, None)
+    if stagedEntry is not None:
+      data = stagedEntry.get(n, None)
+      if data is not None:
+        self.traceAccess(clip, n, True)
+        return data
+
+    # Check the persistent store. Reading a frame updates the cache entry's record of which frames
+    # are held (see SpecialisedCacheEntry), so the entry's stripe lock is needed.
     cacheEntry = clip.cacheEntry
-    if cacheEntry is not None and n in cacheEntry:
-      self.hit(cacheEntry, n)
-      return cacheEntry[n]
+    if cacheEntry is not None:
+      with self._stripeLock(cacheEntry):
+        if n in cacheEntry:
+          data = cacheEntry[n]
+        else:
+          data = None
+      if data is not None:
+        self.hit(cacheEntry, n)
+        self.traceAccess(clip, n, True)
+        return data
 
     # The sought data is neither cached nor staged for caching.
     self.miss(cacheEntry, n)
+
+    # Check the secondary tiers
+    if self._tiers and not clip.isIndirection:
+      data = self.getFromTiers(clip, n)
+      if data is not None:
+        self.traceAccess(clip, n, True)
+        if self.userScriptIsRunning or cacheEntry is not None:
+          # Promote the frame back into the main cache
+          self.set(clip, n, data)
+        return data
+
+    self.traceAccess(clip, n, False)
+
     if "default" in explicitParams:
       return default
     else:
@@ -683,6 +1728,159 @@ class Cache:
 
 
 
+  def contains(self, clip, n):
+    """contains(clip, n)
+
+    Return whether frame `n` of `clip` is either cached or staged, without affecting the statistics
+    or the order in which frames will be evicted.
+    """
+
+    stagedEntry = self._staged.get(clip, None)
+    if stagedEntry is not None and n in stagedEntry:
+      return True
+    cacheEntry = clip.cacheEntry
+    if cacheEntry is not None:
+      with self._stripeLock(cacheEntry):
+        return dict.__contains__(cacheEntry, n)
+    return False
+
+
+
+  def startTrace(self, filepath):
+    """startTrace(filepath)
+
+    Start recording a trace of every frame requested from and rendered for this cache, and of each
+    reprioritisation, to `filepath` (see TraceRecorder). The trace can be replayed against other
+    cache algorithms and capacities by reflect.server.simulator.
+    """
+
+    from .trace import TraceRecorder
+    self.stopTrace()
+    self._trace = TraceRecorder(filepath)
+
+
+
+  def stopTrace(self):
+    trace = self._trace
+    if trace is not None:
+      self._trace = None
+      trace.close()
+
+
+
+  def traceAccess(self, clip, n, served):
+    trace = self._trace
+    if trace is not None:
+      trace.access(clip, n, served, self.userScriptIsRunning)
+
+
+
+  def attachTier(self, tier):
+    """attachTier(tier)
+
+    Add `tier` (e.g. a DiskTier) beneath the existing tiers. Frames discarded by the main cache
+    spill into the first tier, and each tier spills into the one beneath it.
+    """
+
+    if self._tiers:
+      self._tiers[-1].lower = tier
+    self._tiers.append(tier)
+
+
+
+  def getFromTiers(self, clip, n):
+    key = self._tiers[0].keyOf(clip, n)
+    with self._tierLock:
+      for tier in self._tiers:
+        data = tier.get(key)
+        if data is not None:
+          return data
+    return None
+
+
+
+  def spill(self, clip, n, data):
+    """spill(clip, n, data)
+
+    Offer the frame `data` to the first secondary tier, if there is one.
+    """
+
+    if self._tiers and not clip.isIndirection:
+      with self._tierLock:
+        self._tiers[0].put(self._tiers[0].keyOf(clip, n), data)
+
+
+
+  def _discarded(self, cacheEntry, n, data):
+    # Called by cache entries as they discard frames. Returns the number of bytes freed.
+    if self._enableStatistics:
+      with self._statsLock:
+        cacheEntry.stats["evictions"] += 1
+    self.spill(cacheEntry.node, n, data)
+    with self._queueLock:
+      freedBytes = self._ledger.remove(cacheEntry, n, data)
+      holders = self._ledger.compactionCandidates(data)
+
+    # If the frames left holding the same buffer are small views of it, replace them with copies
+    # so that the buffer itself can be freed
+    for holderEntry, holderN, holderData in holders:
+      copy = holderData.copy()
+      with self._stripeLock(holderEntry):
+        dict.__setitem__(holderEntry, holderN, copy)
+        with self._queueLock:
+          freedBytes += self._ledger.remove(holderEntry, holderN, holderData)
+          freedBytes -= self._ledger.add(holderEntry, holderN, copy)
+
+    with self._queueLock:
+      isFreed = self._ledger.cost(data) > 0
+    if isFreed:
+      # No cached frame holds the buffer any more, so it may be reused once it is unreferenced
+      FramePool.current().release(self._ledger.ownerOf(data)[0])
+
+    return freedBytes
+
+
+
+  def persist(self):
+    """persist()
+
+    Spill every frame held in the main cache into the secondary tiers and flush them, e.g. before
+    the server shuts down.
+    """
+
+    with self._evictionLock:
+      for clip, cacheEntry in self._committed.items():
+        with self._stripeLock(cacheEntry):
+          frames = list(dict.items(cacheEntry))
+        for n, data in frames:
+          self.spill(cacheEntry.node, n, data)
+    self.flushTiers()
+
+
+
+  def flushTiers(self):
+    with self._tierLock:
+      for tier in self._tiers:
+        tier.flush()
+
+
+
+  def close(self):
+    """close()
+
+    Persist the main cache into the secondary tiers, and then close them (and the trace, if any).
+    Any staged frames are discarded.
+    """
+
+    self.stopTrace()
+    self.persist()
+    with self._tierLock:
+      for tier in self._tiers:
+        tier.close()
+    self.emptyStagingArea()
+
+
+
   def lockStagingArea(self):
     if self._stagingAreaIsLocked:
       raise Exception("Attempted to lock the staging area, but it was already locked")
@@ -700,12 +1898,100 @@ class Cache:
 
 
   def set(self, clip, n, data):
-    if clip.cacheEntry is not None:
-      self.seenFrame(clip.cacheEntry, n)
+    cacheEntry = clip.cacheEntry
+    if cacheEntry is not None:
+      self.seenFrame(cacheEntry, n)
+
+    if self.userScriptIsRunning:
+      if not self._stagingAreaIsLocked:
+        self.stage(clip, n, data)
+      return
+    if clip.isIndirection:
+      # There's no point in caching this data, so reject it immediately
+      return
+
+    # Hash the frame (if deduplicating) before taking any locks
+    digest = self._ledger.digestOf(data) if self._ledger.deduplicate else None
+    with self._queueLock:
+      admission = self._admit(cacheEntry, n, data.nbytes)
+
+    # Usually there is room for the frame, and it is added without evicting anything
+    cost = self._add(cacheEntry, n, data, digest, admission)
+    if cost is None:
+      return
+
+    # Otherwise evict frames to make room for it, one thread at a time
+    with self._evictionLock:
+      self._makeRoom(cacheEntry, cost, admission)
+      if self._add(cacheEntry, n, data, digest, admission) is not None:
+        # The frame was rejected, but a secondary tier may have room for it
+        self.rejections += 1
+        self.spill(clip, n, data)
+
+
+
+  def _add(self, cacheEntry, n, data, digest, admission):
+    # Add frame n of cacheEntry to the main cache if there is room for it, and return None, or
+    # else return the number of bytes that it would take up
+    with self._stripeLock(cacheEntry):
+      if n in cacheEntry:
+        # Another thread rendered and cached the same frame in the meantime
+        return None
+      with self._queueLock:
+        (data, digest) = self._ledger.compacted(data, digest)
+        cost = self._ledger.cost(data)
+        if self._currentSize + cost > self.maxSize:
+          return cost
+        cacheEntry[n] = data
+        self._currentSize += self._ledger.add(cacheEntry, n, data, digest)
+        self._inserted(cacheEntry, n, data, admission)
+        return None
+
+
+
+  def _admit(self, cacheEntry, n, nbytes):
+    # Called (holding the queue lock) before frame n of cacheEntry is added. The result is passed
+    # on to _makeRoom and _inserted.
+    return None
+
+
+
+  def _inserted(self, cacheEntry, n, data, admission):
+    # Called (holding the queue lock) once frame n of cacheEntry has been added
+    raise NotImplementedError()
 
 
 
+  def _popVictim(self, admission):
+    # Return the next (cacheEntry, n) to evict, removing it from the queue, or None
+    raise NotImplementedError()
+
+
+
+  def _makeRoom(self, cacheEntry, cost, admission):
+    # Evict frames until there is room for `cost` more bytes, or there is nothing left to evict
+    while True:
+      with self._queueLock:
+        if self._currentSize + cost <= self.maxSize:
+          return
+        victim = self._popVictim(admission)
+      if victim is None:
+        return
+      (victimEntry, frameToDiscard) = victim
+      with self._stripeLock(victimEntry):
+        freedBytes = victimEntry.discardFrame(frameToDiscard, self._discarded)
+      with self._queueLock:
+        self._currentSize -= freedBytes
+
+
+
+  @synchronised
   def stage(self, clip, n, data):
+    if self._stagedSize + data.nbytes > self.maxStagedSize:
+      data = self._stagingSpill.put(data)
+    else:
+      self._stagedSize += data.nbytes
+
     if clip in self._staged:
       self._staged[clip][n] = data
     else:
@@ -713,11 +1999,15 @@ class Cache:
 
 
 
+  @synchronised
   def emptyStagingArea(self):
     self._staged = {}
+    self._stagedSize = 0
+    self._stagingSpill.close()
 
 
 
+  @synchronised
   def commit(self):
     if self.userScriptIsRunning:
       raise Exception("Attempted to commit staged frames while a user script is still running")
@@ -732,16 +2022,61 @@ class Cache:
         # can therefore be safely discarded.
         continue
       for n, data in stagedEntry.items():
+        if StagingSpill.isSpilled(data):
+          # Read the frame back into memory, so that the spill file can be deleted
+          data = numpy.array(data)
         self.set(clip, n, data)
+        self.spill(clip, n, data)
     self._staged = {}
+    self._stagedSize = 0
+    self._stagingSpill.close()
 
+    self.flushTiers()
 
 
-  def _setUpPriorities(self):
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
     raise NotImplementedError()
 
 
 
+  def _evictOne(self):
+    # Discard frames of the next victim, and return whether there was one
+    with self._queueLock:
+      victim = self._popVictim(None)
+    if victim is None:
+      return False
+    (victimEntry, frameToDiscard) = victim
+    with self._stripeLock(victimEntry):
+      freedBytes = victimEntry.discardFrame(frameToDiscard, self._discarded)
+    with self._queueLock:
+      self._currentSize -= freedBytes
+    return True
+
+
+
+  @synchronised
+  def resize(self, maxSize):
+    """resize(maxSize)
+
+    Change the capacity of the main cache. If the cache now holds too much, frames are evicted in
+    the same order as they would be to make room for new frames.
+    """
+
+    self.maxSize = maxSize
+    if self._stagedSizeFollowsMaxSize:
+      self.maxStagedSize = maxSize
+    if self._priorityQueue is None:
+      return
+    if hasattr(self._priorityQueue, "resize"):
+      with self._queueLock:
+        self._priorityQueue.resize(maxSize)
+    while self._currentSize > self.maxSize and self._evictOne():
+      pass
+
+
+
+  @queueSynchronised
   def reprioritise(self, graph):
     """reprioritise(graph)
 
@@ -751,6 +2086,11 @@ class Cache:
                       maximum distance from the root
     2. Hotnodes:      Boost priorities of predecessors of hotnodes ("new" cache entries)
 
+    Dampening is implicit: each reprioritisation starts a new epoch, and an entry's priority halves
+    with every epoch since its node was last in a graph (see CacheEntry.dampedPriority). The graph
+    is compared with the previous one, so that only the entries that joined or left the graph, or
+    whose priority changed, need their keys updating (see SpecialisedPriorityQueue).
+
     Preconditions:
     * Every `clip` in `graph` must satisfy "clip.cacheEntry is None", i.e. this graph hasn't been
       used in a previous reprioritise call.
@@ -769,13 +2109,36 @@ class Cache:
         return
       break
 
-    # Sweep over the whole cache, incrementing each age counter (which will dampen priorities)
-    for node, cacheEntry in self._committed.items():
-      cacheEntry.age += 1
+    if self._trace is not None:
+      self._trace.session(graph.leaves)
+
+    self._epoch += 1
+
+    graphCacheEntries = {}   # id(cacheEntry) → cacheEntry, for the nodes of `graph`
+    joinedCacheEntries = []  # The entries that are new, or whose nodes weren't in the previous graph
+    previousPriorities = {}  # id(cacheEntry) → priority, for the entries whose nodes were in the previous graph
+
+    traverseTime = [time.time()]
+    def reset(cacheEntry, node):
+      # Called on the first visit to an existing cache entry of `node`, to reset its fields
+      if cacheEntry.epoch == self._epoch - 1:
+        previousPriorities[id(cacheEntry)] = cacheEntry.priority
+      else:
+        # The entry is no longer a candidate for purging
+        retiredCacheEntries = self._retiredCacheEntries.get(cacheEntry.epoch, None)
+        if retiredCacheEntries is not None:
+          retiredCacheEntries.pop(id(cacheEntry), None)
+        self._agedCacheEntries.pop(id(cacheEntry), None)
+        joinedCacheEntries.append(cacheEntry)
+      cacheEntry.isHotnode = (cacheEntry.epoch < self._epoch - 1) # True iff the node was not in the previous graph
+      cacheEntry.precedesHotnode = False
+      cacheEntry.isIndirection = node.isIndirection
+      cacheEntry.associatedIndirections = []
+      cacheEntry.epoch = self._epoch
+      cacheEntry.traverseTime = traverseTime[0]
 
     # Post-order graph traversal starting from the leaves
     N = [0] # debug counter
-    traverseTime = [time.time()]
     def traverse(node):
       if node.cacheEntry is not None:
         # This node has already been visited
@@ -787,16 +2150,13 @@ class Cache:
           cacheEntry = self._committed.get(node, None)
           if cacheEntry is None:
             cacheEntry = self.CacheEntryImplementation(node = node, isRoot = True, isHotnode = True, precedesHotnode = False, rootDistance = 0, isIndirection = node.isIndirection, traverseTime = traverseTime[0])
+            cacheEntry.epoch = self._epoch
             self._committed[node] = cacheEntry
+            joinedCacheEntries.append(cacheEntry)
           elif cacheEntry.traverseTime != traverseTime[0]: # Avoid updating the same cacheEntry more than once during this reprioritisation
+            reset(cacheEntry, node)
             cacheEntry.isRoot = True
-            cacheEntry.isHotnode = (cacheEntry.age > 1) # True iff the node was not in the previous graph
-            cacheEntry.precedesHotnode = False
             cacheEntry.rootDistance = 0
-            cacheEntry.isIndirection = node.isIndirection
-            cacheEntry.associatedIndirections = []
-            cacheEntry.age = 0
-            cacheEntry.traverseTime = traverseTime[0]
         elif isinstance(node._source, tuple):
           # First visit this node's sources
           sourceCacheEntries = []
@@ -826,7 +2186,7 @@ class Cache:
           # Update the predecessors if this node is hot, and determine the maximum distance from a root to this node
           maxRootDistance = None
           for sourceCacheEntry in sourceCacheEntries:
-            if cacheEntry is None or cacheEntry.age > 1:
+            if cacheEntry is None or cacheEntry.epoch < self._epoch - 1:
               # This node is hot, so we need to update the entry of the predecessor
               sourceCacheEntry.precedesHotnode = True
             if maxRootDistance is None or sourceCacheEntry.rootDistance > maxRootDistance:
@@ -834,16 +2194,13 @@ class Cache:
 
           if cacheEntry is None:
             cacheEntry = self.CacheEntryImplementation(node = node, isRoot = False, isHotnode = True, precedesHotnode = False, rootDistance = maxRootDistance + 1, isIndirection = node.isIndirection, traverseTime = traverseTime[0])
+            cacheEntry.epoch = self._epoch
             self._committed[node] = cacheEntry
+            joinedCacheEntries.append(cacheEntry)
           elif cacheEntry.traverseTime != traverseTime[0]: # Avoid updating the same cacheEntry more than once during this reprioritisation
+            reset(cacheEntry, node)
             cacheEntry.isRoot = False
-            cacheEntry.isHotnode = (cacheEntry.age > 1) # True iff the node was not in the previous graph
-            cacheEntry.precedesHotnode = False
             cacheEntry.rootDistance = maxRootDistance + 1
-            cacheEntry.isIndirection = node.isIndirection
-            cacheEntry.associatedIndirections = []
-            cacheEntry.age = 0
-            cacheEntry.traverseTime = traverseTime[0]
 
           # Make sure the source cacheEntries (predecessors) know that this cacheEntry is one of their successors.
           for sourceCacheEntry in sourceCacheEntries:
@@ -854,6 +2211,7 @@ class Cache:
 
         node.cacheEntry = cacheEntry
         node.indirectionsTakenCareOf = []
+        graphCacheEntries[id(cacheEntry)] = cacheEntry
         return cacheEntry
     for leaf in graph.leaves:
       traverse(leaf)
@@ -906,14 +2264,27 @@ class Cache:
     for leaf in graph.leaves:
       associateIndirections(leaf, {})
 
-    # Get rid of cache entries that are old, empty, and have low priority
+    # Compare the graph with the previous one
+    leftCacheEntries = [cacheEntry for i, cacheEntry in self._graphCacheEntries.items() if i not in graphCacheEntries]
+    changedCacheEntries = [graphCacheEntries[i] for i, priority in previousPriorities.items() if graphCacheEntries[i].priority != priority]
+    for cacheEntry in leftCacheEntries:
+      self._retiredCacheEntries.setdefault(cacheEntry.epoch, {})[id(cacheEntry)] = cacheEntry
+    self._graphCacheEntries = graphCacheEntries
+
+    # Get rid of cache entries that are old, empty, and have low priority. Entries become old when
+    # their nodes have been absent from the graph for more than `maximumAge` epochs, so only the
+    # entries that have just become old, and those that were too full or too important to be
+    # purged before, need to be checked.
     minimumPriority = 0.5 # Magic number
     maximumAge = 5 # Magic number
+    self._agedCacheEntries.update(self._retiredCacheEntries.pop(self._epoch - maximumAge - 1, {}))
     clipsToPurge = []
-    for clip, cacheEntry in self._committed.items():
-      if cacheEntry.age > maximumAge and len(cacheEntry) == 0 and cacheEntry.priority < minimumPriority:
-        clipsToPurge.append((clip, cacheEntry))
+    for cacheEntry in self._agedCacheEntries.values():
+      if len(cacheEntry) == 0 and cacheEntry.dampedPriority(self._epoch) < minimumPriority:
+        clipsToPurge.append((cacheEntry.node, cacheEntry))
     for clip, cacheEntry in clipsToPurge:
+      del self._agedCacheEntries[id(cacheEntry)]
+
       # Remove any references to this cacheEntry from cacheEntries of this node's sources
       if isinstance(clip._source, tuple):
         for source in clip._source:
@@ -923,10 +2294,10 @@ class Cache:
       # Remove the (clip, cacheEntry) item from the master dict
       del self._committed[clip]
 
-    self._setUpPriorities()
+    self._setUpPriorities(joinedCacheEntries, leftCacheEntries, changedCacheEntries, [cacheEntry for clip, cacheEntry in clipsToPurge])
 
     t2 = time.perf_counter()
-    logging.info("Reprioritised {0} nodes in {1:.16f} s".format(N[0], t2 - t1))
+    logging.info("Reprioritised {0} nodes in {1:.16f} s ({2} joined, {3} left, {4} changed, {5} purged)".format(N[0], t2 - t1, len(joinedCacheEntries), len(leftCacheEntries), len(changedCacheEntries), len(clipsToPurge)))
 
     # Debug
     if visualiseFilepath is not None:
@@ -1002,60 +2373,61 @@ class SpecialisedCache(Cache):
 
     self.CacheEntryImplementation = SpecialisedCacheEntry
 
-  def set(self, clip, n, data):
-    super().set(clip, n, data)
-
-    if self.userScriptIsRunning:
-      if not self._stagingAreaIsLocked:
-        self.stage(clip, n, data)
+  def _inserted(self, cacheEntry, n, data, admission):
+    # Ensure the priority queue knows about the (now nonempty) entry
+    self._priorityQueue.add(cacheEntry)
+
+  def _makeRoom(self, cacheEntry, cost, admission):
+    priorityQueue = self._priorityQueue
+    with self._queueLock:
+      candidateKey = priorityQueue.priorityKey(cacheEntry)
+    while True:
+      with self._queueLock:
+        # Only cached data with a lower priority than the candidate clip's may be discarded
+        victim = priorityQueue.peek()
+        if self._currentSize + cost <= self.maxSize or victim is None or priorityQueue.priorityKey(victim) > candidateKey:
+          return
+        excess = self._currentSize + cost - self.maxSize
+      with self._stripeLock(victim):
+        freedBytes = victim.discardBytes(excess, self._discarded)
+        with self._queueLock:
+          self._currentSize -= freedBytes
+          if len(victim) == 0:
+            # All of the victim's data has been discarded
+            priorityQueue.remove(victim)
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
+    if self._priorityQueue is None:
+      self._priorityQueue = SpecialisedPriorityQueue(self._committed.values(), self._epoch)
     else:
-      if clip.isIndirection:
-        # There's no point in caching this data, so reject it immediately
-        return
-      while self._currentSize + data.nbytes > self.maxSize and self._priorityQueue.peek() is not None and self._priorityQueue.peek().priority <= clip.cacheEntry.priority:
-        # There isn't room in the cache, but there exists some cached data with a lower priority than the candidate clip's
-        victim = self._priorityQueue.peek()
-        totalFreedBytes = victim.discardBytes(self._currentSize + data.nbytes - self.maxSize)
-        self._currentSize -= totalFreedBytes
-        if len(victim) == 0:
-          # All of the victim's data has been discarded
-          self._priorityQueue.findNewVictim()
-      if self._currentSize + data.nbytes <= self.maxSize:
-        # Add the data to the cache and ensure the priority queue knows the correct next victim
-        clip.cacheEntry[n] = data
-        self._currentSize += data.nbytes
-        currentVictim = self._priorityQueue.peek()
-        if currentVictim is None or currentVictim.priority >= clip.cacheEntry.priority:
-          self._priorityQueue.setVictim(clip.cacheEntry)
+      self._priorityQueue.reprioritise(self._epoch, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries)
 
-  def _setUpPriorities(self):
-    # Replace the priority queue
-    self._priorityQueue = SpecialisedPriorityQueue(self._committed)
+  def _evictOne(self):
+    with self._queueLock:
+      victim = self._priorityQueue.peek()
+    if victim is None:
+      return False
+    with self._stripeLock(victim):
+      freedBytes = victim.discardBytes(self._currentSize - self.maxSize, self._discarded)
+      with self._queueLock:
+        self._currentSize -= freedBytes
+        if len(victim) == 0:
+          self._priorityQueue.remove(victim)
+    return True
 
 
 
 class FIFOCache(Cache):
 
-  def set(self, clip, n, data):
-    super().set(clip, n, data)
+  def _inserted(self, cacheEntry, n, data, admission):
+    self._priorityQueue.append((cacheEntry, n))
 
-    if self.userScriptIsRunning:
-      if not self._stagingAreaIsLocked:
-        self.stage(clip, n, data)
-    else:
-      if clip.isIndirection:
-        # There's no point in caching this data, so reject it immediately
-        return
-      while self._currentSize + data.nbytes > self.maxSize and len(self._priorityQueue) > 0:
-        (victim, frameToDiscard) = self._priorityQueue.pop(0)
-        totalFreedBytes = victim.discardFrame(frameToDiscard)
-        self._currentSize -= totalFreedBytes
-      if self._currentSize + data.nbytes <= self.maxSize:
-        clip.cacheEntry[n] = data
-        self._currentSize += data.nbytes
-        self._priorityQueue.append((clip.cacheEntry, n))
-
-  def _setUpPriorities(self):
+  def _popVictim(self, admission):
+    if len(self._priorityQueue) == 0:
+      return None
+    return self._priorityQueue.pop(0)
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
     if self._priorityQueue is None:
       self._priorityQueue = []
 
@@ -1080,28 +2452,20 @@ class LRUCache(Cache):
 
   def hit(self, cacheEntry, n):
     super().hit(cacheEntry, n)
-    self._priorityQueue.access((cacheEntry, n))
+    with self._queueLock:
+      if (cacheEntry, n) in self._priorityQueue:
+        # (The frame may have been evicted by another thread since it was read)
+        self._priorityQueue.access((cacheEntry, n))
 
-  def set(self, clip, n, data):
-    super().set(clip, n, data)
+  def _inserted(self, cacheEntry, n, data, admission):
+    self._priorityQueue.insert((cacheEntry, n))
 
-    if self.userScriptIsRunning:
-      if not self._stagingAreaIsLocked:
-        self.stage(clip, n, data)
-    else:
-      if clip.isIndirection:
-        # There's no point in caching this data, so reject it immediately
-        return
-      while self._currentSize + data.nbytes > self.maxSize and not self._priorityQueue.isEmpty():
-        (victim, frameToDiscard) = self._priorityQueue.popTail()
-        totalFreedBytes = victim.discardFrame(frameToDiscard)
-        self._currentSize -= totalFreedBytes
-      if self._currentSize + data.nbytes <= self.maxSize:
-        clip.cacheEntry[n] = data
-        self._currentSize += data.nbytes
-        self._priorityQueue.insert((clip.cacheEntry, n))
-
-  def _setUpPriorities(self):
+  def _popVictim(self, admission):
+    if self._priorityQueue.isEmpty():
+      return None
+    return self._priorityQueue.popTail()
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
     if self._priorityQueue is None:
       self._priorityQueue = self.LeastRecentlyUsedQueue()
 
@@ -1126,30 +2490,124 @@ class MRUCache(Cache):
 
   def hit(self, cacheEntry, n):
     super().hit(cacheEntry, n)
-    self._priorityQueue.access((cacheEntry, n))
+    with self._queueLock:
+      if (cacheEntry, n) in self._priorityQueue:
+        # (The frame may have been evicted by another thread since it was read)
+        self._priorityQueue.access((cacheEntry, n))
+
+  def _inserted(self, cacheEntry, n, data, admission):
+    self._priorityQueue.insert((cacheEntry, n))
+
+  def _popVictim(self, admission):
+    if self._priorityQueue.isEmpty():
+      return None
+    return self._priorityQueue.popHead()
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
+    if self._priorityQueue is None:
+      self._priorityQueue = self.MostRecentlyUsedQueue()
+
+
+
+class CostAwareCache(SpecialisedCache):
+  """CostAwareCache(maxSize, enableStatistics = False)
+
+  Like SpecialisedCache, but frames of clips that take longer to render, per byte of memory, are
+  kept in preference to cheaper ones (see CostAwarePriorityQueue). For example, a gaussian blur of
+  a 4K frame outlives a brighten of the same frame. Render times are measured by VideoClip.frame.
+  """
 
   def set(self, clip, n, data):
+    if not self.userScriptIsRunning and not clip.isIndirection and clip.selfRenderTime is not None:
+      cacheEntry = clip.cacheEntry
+      renderCost = clip.selfRenderTime / max(data.nbytes, 1)
+      with self._queueLock:
+        if cacheEntry.renderCost is None or abs(math.log2(max(renderCost, 1e-12) / max(cacheEntry.renderCost, 1e-12))) > 0.5:
+          # The estimate has changed noticeably, so the entry needs a new key
+          cacheEntry.renderCost = renderCost
+          self._priorityQueue.update(cacheEntry)
+
     super().set(clip, n, data)
 
-    if self.userScriptIsRunning:
-      if not self._stagingAreaIsLocked:
-        self.stage(clip, n, data)
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
+    if self._priorityQueue is None:
+      self._priorityQueue = CostAwarePriorityQueue(self._committed.values(), self._epoch)
     else:
-      if clip.isIndirection:
-        # There's no point in caching this data, so reject it immediately
-        return
-      while self._currentSize + data.nbytes > self.maxSize and not self._priorityQueue.isEmpty():
-        (victim, frameToDiscard) = self._priorityQueue.popHead()
-        totalFreedBytes = victim.discardFrame(frameToDiscard)
-        self._currentSize -= totalFreedBytes
-      if self._currentSize + data.nbytes <= self.maxSize:
-        clip.cacheEntry[n] = data
-        self._currentSize += data.nbytes
-        self._priorityQueue.insert((clip.cacheEntry, n))
-
-  def _setUpPriorities(self):
+      self._priorityQueue.reprioritise(self._epoch, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries)
+
+
+
+class ARCCache(Cache):
+  """ARCCache(maxSize, enableStatistics = False)
+
+  Evicts frames using Adaptive Replacement Caching (see AdaptiveReplacementQueue), which balances
+  recency against frequency according to which of them would have avoided recent misses.
+  """
+
+  def hit(self, cacheEntry, n):
+    super().hit(cacheEntry, n)
+    with self._queueLock:
+      if (cacheEntry, n) in self._priorityQueue:
+        # (The frame may have been evicted by another thread since it was read)
+        self._priorityQueue.access((cacheEntry, n))
+
+  def _admit(self, cacheEntry, n, nbytes):
+    if (cacheEntry, n) in self._priorityQueue:
+      return None
+    return self._priorityQueue.admit((cacheEntry, n), nbytes)
+
+  def _inserted(self, cacheEntry, n, data, admission):
+    self._priorityQueue.insert((cacheEntry, n), data.nbytes, admission)
+
+  def _popVictim(self, admission):
+    if self._priorityQueue.isEmpty():
+      return None
+    return self._priorityQueue.popVictim(admission)
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
     if self._priorityQueue is None:
-      self._priorityQueue = self.MostRecentlyUsedQueue()
+      self._priorityQueue = AdaptiveReplacementQueue(self.maxSize)
+
+
+
+class LIRSCache(Cache):
+  """LIRSCache(maxSize, enableStatistics = False)
+
+  Evicts frames using the Low Inter-reference Recency Set algorithm (see LIRSQueue), which copes
+  with looping playback much better than LRU when the loop doesn't fit into the cache.
+  """
+
+  def hit(self, cacheEntry, n):
+    super().hit(cacheEntry, n)
+    with self._queueLock:
+      if (cacheEntry, n) in self._priorityQueue:
+        # (The frame may have been evicted by another thread since it was read)
+        self._priorityQueue.access((cacheEntry, n))
+
+  def _inserted(self, cacheEntry, n, data, admission):
+    self._priorityQueue.insert((cacheEntry, n), data.nbytes)
+
+  def _popVictim(self, admission):
+    if self._priorityQueue.isEmpty():
+      return None
+    return self._priorityQueue.popVictim()
+
+  def _setUpPriorities(self, joinedCacheEntries, leftCacheEntries, changedCacheEntries, purgedCacheEntries):
+    if self._priorityQueue is None:
+      self._priorityQueue = LIRSQueue(self.maxSize)
+
+
+
+# The cache algorithms that can be chosen by name (e.g. with start.py's --cacheAlgorithm)
+cacheAlgorithms = {
+  "specialised": SpecialisedCache,
+  "fifo": FIFOCache,
+  "lru": LRUCache,
+  "mru": MRUCache,
+  "cost": CostAwareCache,
+  "arc": ARCCache,
+  "lirs": LIRSCache
+}
 
 
 
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import logging
+
+
+
+def readMeminfo(filepath = "/proc/meminfo"):
+  """readMeminfo(filepath = "/proc/meminfo")
+
+  Return a dict of the fields of /proc/meminfo in bytes, or an empty dict if it can't be read (e.g.
+  on Windows).
+  """
+
+  fields = {}
+  try:
+    with open(filepath) as f:
+      for line in f:
+        (name, separator, value) = line.partition(":")
+        parts = value.split()
+        if parts and parts[0].isdigit():
+          fields[name] = int(parts[0]) * (1024 if parts[1:] == ["kB"] else 1)
+  except OSError:
+    pass
+  return fields
+
+
+
+def _readNumber(filepath):
+  # Return the integer in the file at `filepath`, or None if it is missing or says "max"
+  try:
+    with open(filepath) as f:
+      value = f.read().strip()
+  except OSError:
+    return None
+  return int(value) if value.isdigit() else None
+
+
+
+def _readStat(filepath, name):
+  # Return the value of `name` in a cgroup memory.stat file, or 0
+  try:
+    with open(filepath) as f:
+      for line in f:
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == name:
+          return int(parts[1])
+  except OSError:
+    pass
+  return 0
+
+
+
+def readCgroupMemory(root = "/sys/fs/cgroup", cgroupFilepath = "/proc/self/cgroup"):
+  """readCgroupMemory(root = "/sys/fs/cgroup", cgroupFilepath = "/proc/self/cgroup")
+
+  Return (limit, usage) in bytes for the memory cgroup (v2 or v1) of this process, or None for
+  either if it is unknown or unlimited. The usage excludes inactive file-backed pages, which the
+  kernel would reclaim before running out of memory.
+  """
+
+  # Find this process's cgroup in each hierarchy. In a container the paths are often just "/".
+  v2Path = None
+  v1Path = None
+  try:
+    with open(cgroupFilepath) as f:
+      for line in f:
+        (hierarchy, controllers, path) = line.rstrip("\n").split(":", 2)
+        if hierarchy == "0" and controllers == "":
+          v2Path = path
+        elif "memory" in controllers.split(","):
+          v1Path = path
+  except (OSError, ValueError):
+    pass
+
+  if os.path.exists(os.path.join(root, "cgroup.controllers")):
+    # cgroup v2: the effective limit is the smallest along the path to the root
+    directory = os.path.join(root, (v2Path or "/").lstrip("/"))
+    if not os.path.exists(os.path.join(directory, "memory.current")):
+      directory = root
+    limit = None
+    ancestor = directory
+    while True:
+      ancestorLimit = _readNumber(os.path.join(ancestor, "memory.max"))
+      if ancestorLimit is not None and (limit is None or ancestorLimit < limit):
+        limit = ancestorLimit
+      if os.path.normpath(ancestor) == os.path.normpath(root):
+        break
+      ancestor = os.path.dirname(ancestor)
+    usage = _readNumber(os.path.join(directory, "memory.current"))
+    if usage is not None:
+      usage -= _readStat(os.path.join(directory, "memory.stat"), "inactive_file")
+    return (limit, usage)
+
+  # cgroup v1
+  memoryRoot = os.path.join(root, "memory")
+  directory = os.path.join(memoryRoot, (v1Path or "/").lstrip("/"))
+  if not os.path.exists(os.path.join(directory, "memory.limit_in_bytes")):
+    directory = memoryRoot
+  limit = _readNumber(os.path.join(directory, "memory.limit_in_bytes"))
+  if limit is not None and limit >= 2**62:
+    # v1 reports "unlimited" as a huge number (just under 2**63, rounded to a page)
+    limit = None
+  usage = _readNumber(os.path.join(directory, "memory.usage_in_bytes"))
+  if usage is not None:
+    usage -= _readStat(os.path.join(directory, "memory.stat"), "total_inactive_file")
+  return (limit, usage)
+
+
+
+def memoryInfo():
+  """memoryInfo()
+
+  Return (total, available) in bytes: the memory that this process could use in total, and the
+  memory that is available to it now, taking into account both the host (/proc/meminfo) and the
+  memory cgroup of this process. Either may be None if it can't be determined.
+  """
+
+  meminfo = readMeminfo()
+  total = meminfo.get("MemTotal", None)
+  available = meminfo.get("MemAvailable", None)
+  if available is None and "MemFree" in meminfo:
+    # Kernels before 3.14 don't estimate the available memory
+    available = meminfo["MemFree"] + meminfo.get("Cached", 0)
+
+  (limit, usage) = readCgroupMemory()
+  if limit is not None:
+    total = limit if total is None else min(total, limit)
+    if usage is not None:
+      cgroupAvailable = max(limit - usage, 0)
+      available = cgroupAvailable if available is None else min(available, cgroupAvailable)
+  return (total, available)
+
+
+
+def autoCacheSize(fraction, currentSize = 0, minimumSize = 64 * 1024 * 1024):
+  """autoCacheSize(fraction, currentSize = 0, minimumSize = 64 MiB)
+
+  Return the size for a cache that currently holds `currentSize` bytes: `fraction` of the memory
+  that it could have (what it holds plus what is available), but no more than `fraction` of the
+  total memory, and no less than `minimumSize`. Returns None if the memory can't be determined.
+
+  Because the cache's own frames count as available to it, the size settles once the cache is
+  full, and only shrinks when something else starts using memory.
+  """
+
+  (total, available) = memoryInfo()
+  if total is None or available is None:
+    return None
+  size = int(fraction * min(total, available + currentSize))
+  return max(size, minimumSize)
+
+
+
+class MemoryMonitor(object):
+  """MemoryMonitor(cache, fraction = 0.5, interval = 5, minimumSize = 64 MiB)
+
+  Resizes `cache` every `interval` seconds on a background thread, according to autoCacheSize, so
+  that the cache shrinks (evicting frames as usual) when available memory drops, and grows again
+  when it recovers. Small changes (of less than 5%) are ignored.
+  """
+
+
+
+  def __init__(self, cache, fraction = 0.5, interval = 5, minimumSize = 64 * 1024 * 1024):
+    self.cache = cache
+    self.fraction = fraction
+    self.interval = interval
+    self.minimumSize = minimumSize
+
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target = self._run, name = "MemoryMonitor")
+    self._thread.daemon = True
+
+
+
+  def start(self):
+    self._thread.start()
+
+
+
+  def stop(self):
+    self._stopped.set()
+
+
+
+  def update(self):
+    size = autoCacheSize(self.fraction, self.cache._currentSize, self.minimumSize)
+    if size is None or abs(size - self.cache.maxSize) < 0.05 * self.cache.maxSize:
+      return
+    logging.info("Resizing the cache from {} MiB to {} MiB".format(round(self.cache.maxSize / 1024 / 1024, 1), round(size / 1024 / 1024, 1)))
+    self.cache.resize(size)
+
+
+
+  def _run(self):
+    while not self._stopped.wait(self.interval):
+      try:
+        self.update()
+      except Exception as e:
+        logging.warn("Failed to resize the cache ({})".format(e))
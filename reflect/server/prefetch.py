@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import logging
+from .cache import Cache
+
+
+
+class Prefetcher(object):
+  """Prefetcher(workerCount = 2, lookahead = 30)
+
+  Renders frames ahead of the playhead on background threads, so that they are already in the
+  cache by the time the preview window needs them.
+
+  After the window displays frame n of a clip, it calls `update(clip, n, step, loop)`, where `step`
+  is the last movement of the playhead (e.g. 1 while playing, -1 after stepping backwards, or a
+  multiple of the fps while skipping with shift/ctrl). The frames n + step, n + 2 step, ... are
+  then rendered, up to `lookahead` frames ahead, replacing any frames planned by an earlier update.
+
+  Prefetching stops early if the planned frames would take up more than half of the cache, or as
+  soon as the cache rejects a prefetched frame (because it is full of frames with a higher
+  priority). Nothing is prefetched while the user's script is running.
+  """
+
+
+
+  def __init__(self, workerCount = 2, lookahead = 30):
+    self.workerCount = workerCount
+    self.lookahead = lookahead
+
+    self._condition = threading.Condition()
+    self._clip = None
+    self._targets = [] # Frames of self._clip that are yet to be prefetched, in order
+    self._generation = 0 # Incremented by every update, so that workers can tell if their plan is stale
+    self._busyWorkers = 0
+    self._stopped = False
+
+    self._workers = []
+    for i in range(workerCount):
+      worker = threading.Thread(target = self._work, name = "Prefetcher-{}".format(i))
+      worker.daemon = True
+      self._workers.append(worker)
+
+
+
+  def start(self):
+    for worker in self._workers:
+      worker.start()
+
+
+
+  def stop(self):
+    with self._condition:
+      self._stopped = True
+      self._targets = []
+      self._condition.notify_all()
+
+
+
+  def plan(self, clip, n, step, loop):
+    """plan(clip, n, step, loop)
+
+    Return the frames that should be prefetched after displaying frame `n` of `clip`.
+    """
+
+    if step == 0 or clip.frameCount == 0:
+      return []
+
+    # Don't plan more frames than would fit into half of the cache
+    frameBytes = clip.width * clip.height * 3
+    count = min(self.lookahead, Cache.current().maxSize // 2 // max(frameBytes, 1))
+
+    targets = []
+    for i in range(1, count + 1):
+      m = n + i * step
+      if loop:
+        m %= clip.frameCount
+        if m == n:
+          # We have gone all the way round the clip
+          break
+      elif m < 0 or m >= clip.frameCount:
+        break
+      targets.append(m)
+    return targets
+
+
+
+  def update(self, clip, n, step = 1, loop = True):
+    targets = self.plan(clip, n, step, loop)
+    with self._condition:
+      self._clip = clip
+      self._targets = targets
+      self._generation += 1
+      self._condition.notify_all()
+
+
+
+  def waitUntilIdle(self, timeout = None):
+    """waitUntilIdle(timeout = None)
+
+    Block until every planned frame has been prefetched (or abandoned). Returns False on timeout.
+    """
+
+    with self._condition:
+      return self._condition.wait_for(lambda: not self._targets and self._busyWorkers == 0, timeout)
+
+
+
+  def _work(self):
+    while True:
+      with self._condition:
+        self._condition.wait_for(lambda: self._stopped or self._targets)
+        if self._stopped:
+          return
+        clip = self._clip
+        n = self._targets.pop(0)
+        generation = self._generation
+        self._busyWorkers += 1
+
+      try:
+        self._prefetch(clip, n, generation)
+      except Exception as e:
+        logging.warn("Failed to prefetch frame {} of {} ({})".format(n, clip, e))
+        self._abandon(generation)
+      finally:
+        with self._condition:
+          self._busyWorkers -= 1
+          self._condition.notify_all()
+
+
+
+  def _prefetch(self, clip, n, generation):
+    cache = Cache.current()
+    if cache.userScriptIsRunning:
+      # Any frames rendered now would only be staged; the next session will update us again
+      self._abandon(generation)
+      return
+
+    if not clip.isIndirection and cache.contains(clip, n):
+      return
+
+    rejections = cache.rejections
+    clip.frame(n)
+    if cache.rejections != rejections:
+      # The cache is full of frames that it values more highly, so stop here
+      self._abandon(generation)
+
+
+
+  def _abandon(self, generation):
+    with self._condition:
+      if self._generation == generation:
+        self._targets = []
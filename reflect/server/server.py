@@ -16,10 +16,11 @@ import tkinter
 from tkinter import filedialog
 
 debug = False
+statisticsFilepath = None # If set, per-node cache statistics are written here after each session
 
 
 
-def start(filepath, defaultFilepath, cacheSize, cacheAlgorithm = None, enableStatistics = False, logFilepath = None):
+def start(filepath, defaultFilepath, cacheSize, cacheFraction = 0.5, cacheAlgorithm = None, compressedCacheSize = 0, compressedCacheCodec = "zlib", sharedCacheName = None, sharedCacheSize = None, diskCachePath = None, diskCacheSize = None, prefetchWorkers = 2, prefetchFrames = 30, branchWorkers = 4, enableStatistics = False, deduplicate = False, stagingSize = None, stagingSpillPath = None, traceFilepath = None, logFilepath = None):
   if logFilepath is not None:
     logging.basicConfig(format = "%(levelname)s: %(message)s", level = logging.NOTSET, filename = logFilepath)
   else:
@@ -27,18 +28,42 @@ def start(filepath, defaultFilepath, cacheSize, cacheAlgorithm = None, enableSta
 
   logging.info("Starting the reflect server")
 
+  autoCacheSize = cacheSize == "auto"
+  if autoCacheSize:
+    cacheSize = reflect.memory.autoCacheSize(cacheFraction)
+    if cacheSize is None:
+      autoCacheSize = False
+      cacheSize = 100 * 1024 * 1024
+      logging.warn("Couldn't determine the available memory, so using a cache of {} MiB".format(round(cacheSize / 1024 / 1024, 1)))
+
   if cacheAlgorithm is None:
     cacheKind = reflect.SpecialisedCache
   else:
-    cacheKind = {
-      "specialised": reflect.SpecialisedCache,
-      "fifo": reflect.FIFOCache,
-      "lru": reflect.LRUCache,
-      "mru": reflect.MRUCache
-    }[cacheAlgorithm]
-  cache = cacheKind(cacheSize, enableStatistics = enableStatistics)
+    cacheKind = reflect.cache.cacheAlgorithms[cacheAlgorithm]
+  cache = cacheKind(cacheSize, enableStatistics = enableStatistics, maxStagedSize = stagingSize, stagingSpillDirectory = stagingSpillPath, deduplicate = deduplicate)
   reflect.Cache.current().swap(cache)
-  logging.info("Using a {} cache with capacity {} MiB".format(type(cache).__name__, round(cache.maxSize / 1024 / 1024, 1)))
+  logging.info("Using a {} cache with capacity {} MiB{}".format(type(cache).__name__, round(cache.maxSize / 1024 / 1024, 1), " (deduplicating frames)" if deduplicate else ""))
+  memoryMonitor = None
+  if autoCacheSize:
+    memoryMonitor = reflect.memory.MemoryMonitor(cache, fraction = cacheFraction)
+    memoryMonitor.start()
+    logging.info("Resizing the cache to {}% of the available memory as it changes".format(round(cacheFraction * 100)))
+  logging.info("Staging up to {} MiB of frames in memory while the script runs".format(round(cache.maxStagedSize / 1024 / 1024, 1)))
+  if sharedCacheName is not None:
+    cache.attachTier(reflect.SharedMemoryTier(sharedCacheName, sharedCacheSize))
+    logging.info("Sharing frames with other processes through the shared cache {}".format(sharedCacheName))
+  if compressedCacheSize:
+    cache.attachTier(reflect.CompressedTier(compressedCacheSize, codec = compressedCacheCodec))
+    logging.info("Using a compressed ({}) cache with capacity {} MiB".format(compressedCacheCodec, round(compressedCacheSize / 1024 / 1024, 1)))
+  if diskCachePath is not None:
+    cache.attachTier(reflect.DiskTier(diskCachePath, diskCacheSize))
+    logging.info("Using a persistent cache in {} with capacity {} MiB".format(diskCachePath, round(diskCacheSize / 1024 / 1024, 1)))
+  reflect.BranchExecutor.swap(reflect.BranchExecutor(branchWorkers)).close()
+  if branchWorkers > 0:
+    logging.info("Rendering independent sources of composites and transitions on up to {} threads".format(branchWorkers))
+  if traceFilepath is not None:
+    cache.startTrace(traceFilepath)
+    logging.info("Recording a cache trace to {}".format(traceFilepath))
 
   if filepath is None:
     tkinter.Tk().withdraw() # Hide tkinter's root window
@@ -56,7 +81,7 @@ def start(filepath, defaultFilepath, cacheSize, cacheAlgorithm = None, enableSta
 
   logging.info("Watching {}".format(filepath))
 
-  previewWindow = reflect.window.Window(filepath)
+  previewWindow = reflect.window.Window(filepath, prefetchWorkers = prefetchWorkers, prefetchFrames = prefetchFrames)
 
   # Set up a handler to wait for the directory to be modified
   eventHandler = WatchdogHandler(filepath, previewWindow)
@@ -75,6 +100,24 @@ def start(filepath, defaultFilepath, cacheSize, cacheAlgorithm = None, enableSta
   observer.stop()
   observer.join()
 
+  writeNodeStats()
+
+  if memoryMonitor is not None:
+    memoryMonitor.stop()
+
+  # Keep whatever is in the cache for the next run
+  cache.close()
+
+
+
+def writeNodeStats():
+  if statisticsFilepath is not None:
+    try:
+      reflect.Cache.current().writeNodeStats(statisticsFilepath)
+      logging.info("Wrote the cache statistics to {}".format(statisticsFilepath))
+    except Exception as e:
+      logging.warn("Failed to write the cache statistics to {} ({})".format(statisticsFilepath, e))
+
 
 
 class WatchdogHandler(FileSystemEventHandler):
@@ -130,8 +173,14 @@ class ConsoleHandler(threading.Thread):
         elif key == b"r":
           logging.info("Reset the cache statistics")
           reflect.Cache.current().resetStats()
+          reflect.FramePool.current().resetStats()
+          reflect.BranchExecutor.current().resetStats()
+          reflect.core.roots.load.resetStats()
         elif key == b"s":
           logging.info(reflect.Cache.current().stats())
+          logging.info(reflect.FramePool.current().stats())
+          logging.info(reflect.BranchExecutor.current().stats())
+          logging.info(reflect.core.roots.load.stats())
         elif key == b" ":
           # Manually re-run the script
           if not self._previewWindow.userScriptIsRunning:
@@ -163,6 +212,9 @@ class ScriptRunner(threading.Thread):
 
     t1 = time.perf_counter()
 
+    # The previous session is over
+    writeNodeStats()
+
     self._previewWindow.userScriptIsRunning = True
     self._previewWindow.startBusy()
 
@@ -222,6 +274,14 @@ class ScriptRunner(threading.Thread):
     if "FlattenConcats" in transformations:
       reflect.CompositionGraph.current().flattenConcats()
 
+    # Flatten chains of composites into layered clips
+    if "FlattenComposites" in transformations:
+      reflect.CompositionGraph.current().flattenComposites()
+
+    # Fuse chains of per-pixel colour effects
+    if "FusePointwise" in transformations:
+      reflect.CompositionGraph.current().fusePointwise()
+
 
     # Update priorities according to the new composition graph
     cache.reprioritise(reflect.CompositionGraph.current())
@@ -233,14 +293,13 @@ class ScriptRunner(threading.Thread):
       logging.info(cache)
 
     # Close readers that were opened in the previous session but not claimed in the current session
-    for filepath, readers in reflect.core.roots.load.readyReaders.items():
-      for reader in readers:
-        reader.close()
-    reflect.core.roots.load.readyReaders = {}
+    for filepath, pool in reflect.core.roots.load.readyPools.items():
+      pool.close()
+    reflect.core.roots.load.readyPools = {}
 
     # Make readers opened in the current session available to the next session
-    reflect.core.roots.load.readyReaders = reflect.core.roots.load.openReaders
-    reflect.core.roots.load.openReaders = {}
+    reflect.core.roots.load.readyPools = reflect.core.roots.load.openPools
+    reflect.core.roots.load.openPools = {}
 
     # Start a preview session for this script
     self._previewWindow.userScriptIsRunning = False
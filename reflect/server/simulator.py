@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from . import cache as cacheModule
+from .trace import readTrace
+
+
+
+class TraceClip(object):
+  """TraceClip(fingerprint, sources, isIndirection, name)
+
+  Stands in for a clip from a trace, with just enough of the VideoClip interface for the cache.
+  """
+
+  def __init__(self, fingerprint, sources, isIndirection, name):
+    self.cacheEntry = None
+    self._fingerprint = fingerprint
+    self._source = tuple(sources) if sources else "trace:{}".format(fingerprint)
+    self._isIndirection = isIndirection
+    self._isConstant = False
+    self._childCount = 0
+    self._name = name
+    self.renderTime = None
+    self.selfRenderTime = None
+
+  def __str__(self):
+    return self._name
+
+  def __hash__(self):
+    return hash(self._fingerprint)
+
+  def __eq__(self, other):
+    return isinstance(other, TraceClip) and self._fingerprint == other._fingerprint
+
+  def _pseudoeq(self, other):
+    return self == other
+
+  @property
+  def fingerprint(self):
+    return self._fingerprint
+
+  @property
+  def isIndirection(self):
+    return self._isIndirection
+
+
+
+class TraceFrame(object):
+  # Stands in for a frame: the cache only needs to know its size, so no memory is allocated for it
+  __slots__ = ["nbytes"]
+
+  def __init__(self, nbytes):
+    self.nbytes = nbytes
+
+
+
+class TraceGraph(object):
+  # Stands in for a CompositionGraph during reprioritisation
+
+  def __init__(self, leaves):
+    self.leaves = leaves
+
+
+
+def summarise(records):
+  """summarise(records)
+
+  Return (meanRenderTimes, frameSizes, workingSetSize) for a list of trace records: the mean
+  render time (including sources) of each node, the size of each node's frames, and the total size
+  of the distinct frames rendered.
+  """
+
+  totals = {}
+  frameSizes = {}
+  distinctFrames = {}
+  indirections = set()
+  for record in records:
+    if record[0] == "node" and record[2]:
+      indirections.add(record[1])
+    elif record[0] == "render":
+      (kind, nodeId, n, depth, thread, userScriptIsRunning, nbytes, renderTime, selfRenderTime) = record
+      (count, total) = totals.get(nodeId, (0, 0.0))
+      totals[nodeId] = (count + 1, total + renderTime)
+      frameSizes[nodeId] = nbytes
+      if nodeId not in indirections:
+        distinctFrames[(nodeId, n)] = nbytes
+
+  meanRenderTimes = { nodeId: total / count for nodeId, (count, total) in totals.items() }
+  return (meanRenderTimes, frameSizes, sum(distinctFrames.values()))
+
+
+
+def replay(records, cache, meanRenderTimes, frameSizes):
+  """replay(records, cache, meanRenderTimes, frameSizes)
+
+  Replay a list of trace records against `cache`, and return a dict of the number of hits and
+  misses, the render time spent on misses, and the render time saved by hits.
+
+  When the simulated cache has a frame that had to be rendered in the trace, the accesses made on
+  behalf of that render are skipped. When it lacks a frame that was served in the trace, it is
+  charged the node's mean render time (including sources), since the trace can't say which of
+  the sources would also have been missing.
+  """
+
+  nodes = {}       # node id → (fingerprint, sourceIds, isIndirection, name)
+  clips = {}       # node id → TraceClip, for the current session
+  skipDepths = {}  # thread → depth of the render whose accesses are being skipped
+  scriptWasRunning = False
+  result = { "hits": 0, "misses": 0, "renderTime": 0.0, "savedRenderTime": 0.0 }
+
+  def clipOf(nodeId):
+    clip = clips.get(nodeId, None)
+    if clip is None:
+      (fingerprint, sourceIds, isIndirection, name) = nodes[nodeId]
+      clip = TraceClip(fingerprint, [clipOf(sourceId) for sourceId in sourceIds], isIndirection, name)
+      clips[nodeId] = clip
+    return clip
+
+  def offer(clip, n, nbytes):
+    if cache.userScriptIsRunning or clip.cacheEntry is not None:
+      cache.set(clip, n, TraceFrame(nbytes))
+
+  for record in records:
+    kind = record[0]
+    if kind == "node":
+      (kind, nodeId, isIndirection, fingerprint, sourceIds, name) = record
+      nodes[nodeId] = (fingerprint, sourceIds, isIndirection, name)
+      continue
+    elif kind == "session":
+      cache.userScriptIsRunning = False
+      cache.reprioritise(TraceGraph([clipOf(leafId) for leafId in record[1]]))
+      cache.commit()
+      scriptWasRunning = False
+      continue
+
+    (nodeId, n, depth, thread) = record[1:5]
+    userScriptIsRunning = record[6] if kind == "access" else record[5]
+    if userScriptIsRunning and not scriptWasRunning:
+      # A new run of the user's script constructs new clips
+      clips = {}
+    scriptWasRunning = userScriptIsRunning
+    cache.userScriptIsRunning = userScriptIsRunning
+
+    skipDepth = skipDepths.get(thread, None)
+    if skipDepth is not None:
+      if depth > skipDepth:
+        continue
+      del skipDepths[thread]
+      if kind == "render" and depth == skipDepth:
+        # The render whose accesses were skipped
+        continue
+
+    clip = clipOf(nodeId)
+    if kind == "access":
+      served = record[5]
+      data = cache.get(clip, n, None)
+      if data is not None:
+        if not clip.isIndirection:
+          result["hits"] += 1
+        result["savedRenderTime"] += meanRenderTimes.get(nodeId, 0.0)
+        if not served:
+          skipDepths[thread] = depth
+      else:
+        if not clip.isIndirection:
+          result["misses"] += 1
+        if served and nodeId in frameSizes:
+          # The trace doesn't say how this frame would have been rendered
+          result["renderTime"] += meanRenderTimes.get(nodeId, 0.0)
+          clip.renderTime = meanRenderTimes.get(nodeId, 0.0)
+          clip.selfRenderTime = clip.renderTime
+          offer(clip, n, frameSizes[nodeId])
+    else:
+      (nbytes, renderTime, selfRenderTime) = record[6:9]
+      result["renderTime"] += selfRenderTime
+      clip.renderTime = renderTime
+      clip.selfRenderTime = selfRenderTime
+      offer(clip, n, nbytes)
+
+  return result
+
+
+
+def simulate(filepath, algorithms = None, capacities = None):
+  """simulate(filepath, algorithms = None, capacities = None)
+
+  Replay the trace at `filepath` (see Cache.startTrace) against each of the named cache
+  `algorithms` (by default, all of them) at each of the `capacities` in bytes (by default, 1/64 up
+  to 1 times the size of the distinct frames rendered in the trace). Return a list of
+  (algorithm, capacity, result) tuples, where result is as for `replay`.
+  """
+
+  records = list(readTrace(filepath))
+  (meanRenderTimes, frameSizes, workingSetSize) = summarise(records)
+
+  if algorithms is None:
+    algorithms = list(cacheModule.cacheAlgorithms.keys())
+  if capacities is None:
+    capacities = [max(workingSetSize // 2**i, 1) for i in reversed(range(7))]
+
+  results = []
+  oldCache = cacheModule.Cache.current()
+  try:
+    for algorithm in algorithms:
+      for capacity in capacities:
+        cache = cacheModule.cacheAlgorithms[algorithm](capacity)
+        cacheModule.Cache.swap(cache)
+        results.append((algorithm, capacity, replay(records, cache, meanRenderTimes, frameSizes)))
+        logging.info("Simulated {} at {} MiB".format(algorithm, round(capacity / 1024 / 1024, 1)))
+  finally:
+    cacheModule.Cache.swap(oldCache)
+  return results
+
+
+
+def printResults(results):
+  print("{:>12} {:>12} {:>10} {:>10} {:>10} {:>14} {:>14}".format("algorithm", "size (MiB)", "hits", "misses", "hit ratio", "rendered (s)", "saved (s)"))
+  for algorithm, capacity, result in results:
+    denominator = result["hits"] + result["misses"]
+    hitRatio = round(result["hits"] / denominator, 3) if denominator != 0 else "inf"
+    print("{:>12} {:>12} {:>10} {:>10} {:>10} {:>14} {:>14}".format(
+      algorithm,
+      round(capacity / 1024 / 1024, 1),
+      result["hits"],
+      result["misses"],
+      hitRatio,
+      round(result["renderTime"], 2),
+      round(result["savedRenderTime"], 2)
+    ))
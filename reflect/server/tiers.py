@@ -0,0 +1,728 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+import collections
+import threading
+import tempfile
+import zlib
+import numpy
+from multiprocessing import shared_memory
+try:
+  import fcntl
+except ImportError:
+  # Windows
+  fcntl = None
+  import msvcrt
+
+
+
+class Tier(object):
+  """Tier(name, maxSize)
+
+  Base class for the secondary stores that sit underneath the main cache (see Cache.attachTier).
+  Frames are stored under keys derived from the clip's fingerprint. A tier that discards a frame
+  may spill it into the tier beneath it (`lower`).
+
+  Frames are normally offered to the first tier only when the main cache discards them, but a tier
+  with `writeThrough` set is also offered every frame as soon as it is rendered.
+  """
+
+
+
+  writeThrough = False
+
+
+
+  def __init__(self, name, maxSize):
+    self.name = name
+    self.maxSize = maxSize
+    self.lower = None # The next tier down, into which this tier spills
+
+    self.hits = 0
+    self.misses = 0
+
+
+
+  @staticmethod
+  def keyOf(clip, n):
+    return "{}:{}".format(clip.fingerprint, n)
+
+
+
+  @property
+  def currentSize(self):
+    raise NotImplementedError()
+
+
+
+  def get(self, key):
+    raise NotImplementedError()
+
+
+
+  def put(self, key, data):
+    raise NotImplementedError()
+
+
+
+  def flush(self):
+    pass
+
+
+
+  def close(self):
+    pass
+
+
+
+  def stats(self):
+    denominator = self.hits + self.misses
+    if denominator != 0:
+      hitRatio = round(self.hits / denominator, 5)
+    else:
+      hitRatio = "inf"
+
+    return "{}: {} h / {} m / {} hr / {} MiB".format(self.name, self.hits, self.misses, hitRatio, round(self.currentSize / 1024 / 1024, 1))
+
+
+
+  def resetStats(self):
+    self.hits = 0
+    self.misses = 0
+
+
+
+class CompressedTier(Tier):
+  """CompressedTier(maxSize, codec = "zlib", quality = 90)
+
+  An in-memory store of compressed frames. With the default "zlib" codec frames are compressed
+  losslessly (at zlib's fastest level); the "jpeg" codec is lossy, but much more compact, and may
+  be good enough for previewing. `maxSize` limits the total size of the compressed frames.
+
+  When full, the least recently used frames are discarded. Losslessly compressed frames spill into
+  the tier beneath; lossy ones are dropped, so that they are never mistaken for exact frames later.
+  """
+
+
+
+  codecs = ["zlib", "jpeg"]
+
+
+
+  def __init__(self, maxSize, codec = "zlib", quality = 90):
+    super().__init__("compressed ({})".format(codec), maxSize)
+
+    if codec not in self.codecs:
+      raise ValueError("expected codec to be one of {}, but instead received {}".format(self.codecs, codec))
+
+    self.codec = codec
+    self.quality = quality
+
+    # key → (codec, payload, shape, dtype), ordered from least to most recently used
+    self._frames = collections.OrderedDict()
+    self._currentSize = 0
+    self._uncompressedSize = 0
+
+
+
+  def __len__(self):
+    return len(self._frames)
+
+
+
+  def __contains__(self, key):
+    return key in self._frames
+
+
+
+  @property
+  def currentSize(self):
+    return self._currentSize
+
+
+
+  def compress(self, data):
+    if self.codec == "jpeg" and data.dtype == numpy.uint8 and data.ndim == 3 and data.shape[2] == 3:
+      import cv2
+      (success, payload) = cv2.imencode(".jpg", cv2.cvtColor(data, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+      if success:
+        return ("jpeg", payload.tobytes())
+    return ("zlib", zlib.compress(numpy.ascontiguousarray(data).tobytes(), 1))
+
+
+
+  def decompress(self, codec, payload, shape, dtype):
+    if codec == "jpeg":
+      import cv2
+      return cv2.cvtColor(cv2.imdecode(numpy.frombuffer(payload, dtype = numpy.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    else:
+      return numpy.frombuffer(bytearray(zlib.decompress(payload)), dtype = dtype).reshape(shape)
+
+
+
+  def get(self, key):
+    record = self._frames.get(key, None)
+    if record is None:
+      self.misses += 1
+      return None
+
+    self._frames.move_to_end(key)
+    self.hits += 1
+    return self.decompress(*record)
+
+
+
+  def put(self, key, data):
+    if key in self._frames:
+      self._frames.move_to_end(key)
+      return
+
+    (codec, payload) = self.compress(data)
+    if len(payload) > self.maxSize:
+      return
+
+    while self._frames and self._currentSize + len(payload) > self.maxSize:
+      (victimKey, victim) = self._frames.popitem(last = False)
+      self._currentSize -= len(victim[1])
+      self._uncompressedSize -= numpy.prod(victim[2]) * numpy.dtype(victim[3]).itemsize
+      if self.lower is not None and victim[0] != "jpeg":
+        self.lower.put(victimKey, self.decompress(*victim))
+
+    self._frames[key] = (codec, payload, tuple(data.shape), data.dtype.str)
+    self._currentSize += len(payload)
+    self._uncompressedSize += data.nbytes
+
+
+
+  def close(self):
+    # This tier doesn't survive a restart, so hand its frames down to the tier beneath
+    if self.lower is not None:
+      for key, record in self._frames.items():
+        if record[0] != "jpeg":
+          self.lower.put(key, self.decompress(*record))
+    self._frames.clear()
+    self._currentSize = 0
+    self._uncompressedSize = 0
+
+
+
+  def stats(self):
+    if self._currentSize != 0:
+      ratio = round(self._uncompressedSize / self._currentSize, 2)
+    else:
+      ratio = "N/A"
+    return "{} / {}:1".format(super().stats(), ratio)
+
+
+
+class DiskTier(Tier):
+  """DiskTier(directory, maxSize)
+
+  A persistent store of frames that sits underneath the main (in-memory) cache. Frames that are
+  evicted from the main cache spill into this tier, and because frames are keyed by the clip's
+  fingerprint (which is stable across processes), they can still be retrieved after the server has
+  been restarted.
+
+  Frames are appended to a single data file. An index file maps each key to the offset, size,
+  shape, and dtype of its frame; the index is held in memory, so a lookup costs at most one seek.
+  When the live data would exceed `maxSize` bytes, the least recently used frames are dropped from
+  the index, and the data file is compacted once it consists mostly of dropped frames.
+  """
+
+
+
+  indexFilename = "index.json"
+  version = 1
+
+
+
+  def __init__(self, directory, maxSize):
+    super().__init__("disk", maxSize)
+
+    self.directory = directory
+
+    # key → (offset, nbytes, shape, dtype), ordered from least to most recently used
+    self._index = collections.OrderedDict()
+    self._liveSize = 0
+    self._generation = 0
+    self._file = None
+
+    os.makedirs(directory, exist_ok = True)
+    self._loadIndex()
+    self._file = open(self._dataFilepath(self._generation), "r+b" if os.path.exists(self._dataFilepath(self._generation)) else "w+b")
+    self._fileSize = self._file.seek(0, os.SEEK_END)
+
+    # Drop anything beyond the budget, e.g. if maxSize has been reduced since the last run
+    self._makeRoom(0)
+
+    logging.info("Opened the disk cache at {} ({} frames, {} MiB)".format(directory, len(self._index), round(self._liveSize / 1024 / 1024, 1)))
+
+
+
+  def __len__(self):
+    return len(self._index)
+
+
+
+  def __contains__(self, key):
+    return key in self._index
+
+
+
+  @property
+  def currentSize(self):
+    return self._liveSize
+
+
+
+  def _dataFilepath(self, generation):
+    return os.path.join(self.directory, "frames.{}.bin".format(generation))
+
+
+
+  def _loadIndex(self):
+    indexFilepath = os.path.join(self.directory, self.indexFilename)
+    if not os.path.exists(indexFilepath):
+      return
+
+    try:
+      with open(indexFilepath, "r", encoding = "utf-8") as f:
+        index = json.load(f)
+      if index["version"] != self.version:
+        raise ValueError("unsupported index version {}".format(index["version"]))
+      generation = index["generation"]
+      dataFileSize = os.path.getsize(self._dataFilepath(generation))
+      records = collections.OrderedDict()
+      for key, offset, nbytes, shape, dtype in index["records"]:
+        if offset + nbytes > dataFileSize:
+          raise ValueError("the record for {} lies beyond the end of the data file".format(key))
+        records[key] = (offset, nbytes, tuple(shape), dtype)
+    except Exception as e:
+      logging.warn("Ignoring the disk cache index at {} ({})".format(indexFilepath, e))
+      return
+
+    self._index = records
+    self._liveSize = sum(nbytes for offset, nbytes, shape, dtype in records.values())
+    self._generation = generation
+
+
+
+  def get(self, key):
+    """get(key)
+
+    Return the frame stored under `key`, or None if there is no such frame.
+    """
+
+    record = self._index.get(key, None)
+    if record is None:
+      self.misses += 1
+      return None
+
+    (offset, nbytes, shape, dtype) = record
+    buffer = bytearray(nbytes)
+    self._file.seek(offset)
+    if self._file.readinto(buffer) != nbytes:
+      # The data file has been truncated behind our back, so forget about this frame
+      logging.warn("The disk cache entry for {} is incomplete; discarding it".format(key))
+      self._drop(key)
+      self.misses += 1
+      return None
+
+    self._index.move_to_end(key)
+    self.hits += 1
+    return numpy.frombuffer(buffer, dtype = dtype).reshape(shape)
+
+
+
+  def put(self, key, data):
+    """put(key, data)
+
+    Store the frame `data` under `key`, making room by discarding the least recently used frames.
+    """
+
+    if key in self._index:
+      self._index.move_to_end(key)
+      return
+    if data.nbytes > self.maxSize:
+      return
+
+    self._makeRoom(data.nbytes)
+
+    offset = self._fileSize
+    self._file.seek(offset)
+    self._file.write(numpy.ascontiguousarray(data).tobytes())
+    self._fileSize += data.nbytes
+
+    self._index[key] = (offset, data.nbytes, tuple(data.shape), data.dtype.str)
+    self._liveSize += data.nbytes
+
+    if self._fileSize > 2 * self._liveSize and self._fileSize > self.maxSize / 2:
+      # Most of the data file is taken up by frames that have been dropped
+      self.compact()
+
+
+
+  def _drop(self, key):
+    (offset, nbytes, shape, dtype) = self._index.pop(key)
+    self._liveSize -= nbytes
+
+
+
+  def _makeRoom(self, nbytes):
+    while self._index and self._liveSize + nbytes > self.maxSize:
+      (key, record) = self._index.popitem(last = False)
+      self._liveSize -= record[1]
+
+
+
+  def compact(self):
+    """compact()
+
+    Rewrite the data file so that it contains only the frames in the index.
+    The new data file gets a new generation number, and the index is rewritten to point at it
+    before the old data file is deleted, so a crash at any point leaves a consistent cache.
+    """
+
+    oldGeneration = self._generation
+    newGeneration = oldGeneration + 1
+    newIndex = collections.OrderedDict()
+    offset = 0
+    with open(self._dataFilepath(newGeneration), "wb") as newFile:
+      for key, (oldOffset, nbytes, shape, dtype) in self._index.items():
+        self._file.seek(oldOffset)
+        newFile.write(self._file.read(nbytes))
+        newIndex[key] = (offset, nbytes, shape, dtype)
+        offset += nbytes
+
+    self._file.close()
+    self._index = newIndex
+    self._generation = newGeneration
+    self._file = open(self._dataFilepath(newGeneration), "r+b")
+    self._fileSize = offset
+    self.flush()
+    os.remove(self._dataFilepath(oldGeneration))
+
+
+
+  def flush(self):
+    """flush()
+
+    Write the index to disk, so that the frames stored so far will survive a restart.
+    """
+
+    self._file.flush()
+    index = {
+      "version": self.version,
+      "generation": self._generation,
+      "records": [[key, offset, nbytes, list(shape), dtype] for key, (offset, nbytes, shape, dtype) in self._index.items()]
+    }
+    indexFilepath = os.path.join(self.directory, self.indexFilename)
+    with open(indexFilepath + ".tmp", "w", encoding = "utf-8") as f:
+      json.dump(index, f)
+    os.replace(indexFilepath + ".tmp", indexFilepath)
+
+
+
+  def close(self):
+    if self._file is not None:
+      self.flush()
+      self._file.close()
+      self._file = None
+
+
+
+class InterprocessLock(object):
+  """InterprocessLock(filepath)
+
+  A lock that excludes other threads in this process, and other processes on the same host that
+  lock the same file.
+  """
+
+
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+    self._threadLock = threading.Lock()
+    self._file = open(filepath, "a+b")
+
+
+
+  def __enter__(self):
+    self._threadLock.acquire()
+    try:
+      if fcntl is not None:
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+      else:
+        self._file.seek(0)
+        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+    except:
+      self._threadLock.release()
+      raise
+    return self
+
+
+
+  def __exit__(self, *args):
+    try:
+      if fcntl is not None:
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+      else:
+        self._file.seek(0)
+        msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+    finally:
+      self._threadLock.release()
+
+
+
+  def close(self):
+    self._file.close()
+
+
+
+class SharedMemoryTier(Tier):
+  """SharedMemoryTier(name, maxSize = None, maxFrames = 4096, unlinkOnClose = None)
+
+  A store of frames in shared memory, which any process on the same host can attach to by `name`,
+  e.g. render worker processes, or a second preview server. Frames are keyed by the clip's
+  fingerprint, so every process finds the frames that the others have rendered, without them being
+  pickled and sent between processes.
+
+  The first process to use `name` creates two shared memory segments: a data segment of `maxSize`
+  bytes, and an index of up to `maxFrames` frames (the other processes use the sizes that it chose).
+  The data segment is a ring: each frame is written after the last one, overwriting (and spilling
+  into the tier beneath) the oldest frames. All access is serialised by an InterprocessLock, and
+  frames are copied out of shared memory while it is held, so that another process can't overwrite
+  a frame while it's being read.
+
+  Unlike the other tiers, this tier is also offered every rendered frame (`writeThrough`), so that
+  frames are shared as soon as they exist. The segments are unlinked when the tier is closed if
+  `unlinkOnClose` is set, which by default it is only for the process that created them.
+  """
+
+
+
+  magic = b"RFLSHM01"
+  keyLength = 64
+  maxDimensions = 4
+  headerType = numpy.dtype([
+    ("magic", "S8"),
+    ("dataSize", "<u8"),
+    ("frameCapacity", "<u8"),
+    ("dataHead", "<u8"),  # The number of bytes ever written to the ring
+    ("frameHead", "<u8")  # The number of frames ever written to the index
+  ])
+  recordType = numpy.dtype([
+    ("key", "S{}".format(keyLength)),
+    ("offset", "<u8"), # The value of dataHead when the frame was written
+    ("nbytes", "<u8"),
+    ("shape", "<u4", (maxDimensions,)),
+    ("ndim", "u1"),
+    ("dtype", "S8"),
+    ("valid", "u1")
+  ])
+  writeThrough = True
+
+
+
+  def __init__(self, name, maxSize = None, maxFrames = 4096, unlinkOnClose = None):
+    super().__init__("shared ({})".format(name), maxSize)
+
+    self.sharedName = name
+    self._lock = InterprocessLock(os.path.join(tempfile.gettempdir(), "{}.lock".format(name)))
+    self._data = None
+    try:
+      self._open(name, maxSize, maxFrames)
+    except ValueError:
+      self._lock.close()
+      raise
+
+    self.unlinkOnClose = self.created if unlinkOnClose is None else unlinkOnClose
+
+    logging.info("{} the shared cache {} ({} frames, {} MiB)".format("Created" if self.created else "Attached to", name, len(self), round(self.currentSize / 1024 / 1024, 1)))
+
+
+
+  def _open(self, name, maxSize, maxFrames):
+    with self._lock:
+      try:
+        self._indexMemory = self._attach("{}-index".format(name))
+        self._dataMemory = self._attach("{}-data".format(name))
+        created = False
+      except FileNotFoundError:
+        if maxSize is None:
+          raise ValueError("the shared cache {} doesn't exist, and no maxSize was given with which to create it".format(name))
+        self._indexMemory = self._create("{}-index".format(name), self.headerType.itemsize + maxFrames * self.recordType.itemsize)
+        self._dataMemory = self._create("{}-data".format(name), maxSize)
+        created = True
+
+      self._header = numpy.ndarray((1,), dtype = self.headerType, buffer = self._indexMemory.buf)
+      if created:
+        self._header[0] = (self.magic, maxSize, maxFrames, 0, 0)
+      elif self._header["magic"][0] != self.magic:
+        raise ValueError("the shared memory segment {}-index is not a reflect cache".format(name))
+      self.maxSize = int(self._header["dataSize"][0])
+      self.maxFrames = int(self._header["frameCapacity"][0])
+      self._records = numpy.ndarray((self.maxFrames,), dtype = self.recordType, buffer = self._indexMemory.buf, offset = self.headerType.itemsize)
+      self._data = numpy.ndarray((self.maxSize,), dtype = numpy.uint8, buffer = self._dataMemory.buf)
+      self.created = created
+
+
+
+  @staticmethod
+  def _attach(name):
+    memory = shared_memory.SharedMemory(name = name)
+    SharedMemoryTier._untrack(memory)
+    return memory
+
+
+
+  @staticmethod
+  def _create(name, size):
+    memory = shared_memory.SharedMemory(name = name, create = True, size = size)
+    SharedMemoryTier._untrack(memory)
+    return memory
+
+
+
+  @staticmethod
+  def _untrack(memory):
+    # Before Python 3.13, the resource tracker unlinks every segment that a process has used when
+    # it exits, which would pull the cache out from under the other processes. Segments are
+    # unlinked explicitly instead (see close).
+    try:
+      from multiprocessing import resource_tracker
+      resource_tracker.unregister(memory._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):
+      pass
+
+
+
+  def __len__(self):
+    with self._lock:
+      return int(numpy.count_nonzero(self._records["valid"]))
+
+
+
+  def __contains__(self, key):
+    with self._lock:
+      return self._find(key.encode("ascii")) is not None
+
+
+
+  @property
+  def currentSize(self):
+    with self._lock:
+      return int(self._records["nbytes"][self._records["valid"] != 0].sum())
+
+
+
+  def _find(self, keyBytes):
+    # Return the index of the valid record for keyBytes, if any. The lock must be held.
+    matches = numpy.flatnonzero((self._records["valid"] != 0) & (self._records["key"] == keyBytes))
+    if len(matches) == 0:
+      return None
+    else:
+      return int(matches[0])
+
+
+
+  def _read(self, i):
+    # Return a copy of the frame in record i. The lock must be held.
+    record = self._records[i]
+    start = int(record["offset"]) % self.maxSize
+    shape = tuple(int(d) for d in record["shape"][:record["ndim"]])
+    return self._data[start:start + int(record["nbytes"])].copy().view(numpy.dtype(record["dtype"].decode("ascii"))).reshape(shape)
+
+
+
+  def _invalidate(self, indices):
+    # Drop the frames in the given records, spilling them into the tier beneath. The lock must be held.
+    for i in indices:
+      if self.lower is not None:
+        self.lower.put(self._records["key"][i].decode("ascii"), self._read(i))
+      self._records["valid"][i] = 0
+
+
+
+  def get(self, key):
+    with self._lock:
+      i = self._find(key.encode("ascii"))
+      if i is None:
+        data = None
+      else:
+        data = self._read(i)
+
+    if data is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return data
+
+
+
+  def put(self, key, data):
+    keyBytes = key.encode("ascii")
+    nbytes = data.nbytes
+    if len(keyBytes) > self.keyLength or data.ndim > self.maxDimensions or nbytes > self.maxSize or nbytes == 0:
+      return
+    data = numpy.ascontiguousarray(data)
+
+    with self._lock:
+      if self._find(keyBytes) is not None:
+        return
+
+      header = self._header[0]
+      dataHead = int(header["dataHead"])
+      start = dataHead % self.maxSize
+      if start + nbytes > self.maxSize:
+        # The frame doesn't fit before the end of the ring, so skip to the beginning
+        dataHead += self.maxSize - start
+        start = 0
+
+      # Drop the frames that are about to be overwritten, and whichever frame last used the record
+      i = int(header["frameHead"]) % self.maxFrames
+      overwritten = self._records["valid"] != 0
+      if dataHead + nbytes > self.maxSize:
+        overwritten &= self._records["offset"] < dataHead + nbytes - self.maxSize
+      else:
+        overwritten &= False
+      overwritten[i] = self._records["valid"][i] != 0
+      self._invalidate(numpy.flatnonzero(overwritten))
+
+      self._data[start:start + nbytes] = data.reshape(-1).view(numpy.uint8)
+      shape = list(data.shape) + [0] * (self.maxDimensions - data.ndim)
+      self._records[i] = (keyBytes, dataHead, nbytes, shape, data.ndim, data.dtype.str.encode("ascii"), 1)
+      self._header["dataHead"] = dataHead + nbytes
+      self._header["frameHead"] = int(header["frameHead"]) + 1
+
+
+
+  def close(self):
+    if self._data is None:
+      return
+
+    if self.unlinkOnClose and self.lower is not None:
+      # The frames won't outlive this tier, so hand them down to the tier beneath
+      with self._lock:
+        self._invalidate(numpy.flatnonzero(self._records["valid"]))
+
+    # The views must be released before the segments can be closed
+    self._header = None
+    self._records = None
+    self._data = None
+    self._indexMemory.close()
+    self._dataMemory.close()
+    if self.unlinkOnClose:
+      for memory in [self._indexMemory, self._dataMemory]:
+        try:
+          memory.unlink()
+        except FileNotFoundError:
+          pass
+    self._lock.close()
+    if self.unlinkOnClose:
+      try:
+        os.remove(self._lock.filepath)
+      except OSError:
+        pass
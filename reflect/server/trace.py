@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import struct
+import threading
+from ..core.clips import renderTimers
+
+
+
+magic = b"RFLTRACE"
+version = 1
+
+# Record layouts (little-endian), each preceded by a one-byte tag
+nodeRecord = struct.Struct("<IB20sHH")      # N: node id, isIndirection, fingerprint, source count, name length
+                                            #    (followed by the source ids as uint32s, and the utf-8 name)
+accessRecord = struct.Struct("<IIBBB")      # A: node id, frame, depth, thread, flags
+renderRecord = struct.Struct("<IIBBBQff")   # R: node id, frame, depth, thread, flags, bytes, render time, self render time
+sessionRecord = struct.Struct("<I")         # S: leaf count (followed by the leaf ids as uint32s)
+
+servedFlag = 1        # The frame was found in the cache (or a tier), so it wasn't rendered
+scriptRunningFlag = 2 # The user's script was running at the time
+
+
+
+class TraceRecorder(object):
+  """TraceRecorder(filepath)
+
+  Writes a compact binary trace of the cache's workload, which can be replayed against any cache
+  algorithm and capacity by the simulator (see reflect.server.simulator), rather than re-running
+  the preview window.
+
+  The trace consists of:
+  * node records, which describe each clip the first time it appears (keyed by its fingerprint),
+    including its sources, so that the composition graph can be rebuilt;
+  * access records, for each frame requested from the cache, noting whether it was served from the
+    cache or had to be rendered;
+  * render records, for each frame rendered, with its size and its render time both including and
+    excluding its sources;
+  * session records, for each reprioritisation, listing the leaves of the new composition graph.
+
+  Accesses and renders also record their depth (how many renders are in progress on the same
+  thread), so that the simulator can tell which accesses were made on behalf of which render.
+  """
+
+
+
+  def __init__(self, filepath):
+    self.filepath = filepath
+
+    self._lock = threading.Lock()
+    self._nodeIds = {}   # fingerprint → node id
+    self._threadIds = {} # thread ident → small thread number
+    self._file = open(filepath, "wb")
+    self._file.write(magic + struct.pack("<H", version))
+
+
+
+  def _nodeId(self, clip):
+    # Return the id of `clip`, first writing node records for it and its sources if necessary
+    fingerprint = clip.fingerprint
+    nodeId = self._nodeIds.get(fingerprint, None)
+    if nodeId is not None:
+      return nodeId
+
+    if isinstance(clip._source, tuple):
+      sourceIds = [self._nodeId(source) for source in clip._source]
+    else:
+      sourceIds = []
+    nodeId = len(self._nodeIds)
+    self._nodeIds[fingerprint] = nodeId
+
+    name = str(clip).encode("utf-8")[:65535]
+    self._file.write(b"N" + nodeRecord.pack(nodeId, clip.isIndirection, bytes.fromhex(fingerprint), len(sourceIds), len(name)))
+    self._file.write(struct.pack("<{}I".format(len(sourceIds)), *sourceIds))
+    self._file.write(name)
+    return nodeId
+
+
+
+  def _threadId(self):
+    ident = threading.get_ident()
+    threadId = self._threadIds.get(ident, None)
+    if threadId is None:
+      threadId = len(self._threadIds) % 256
+      self._threadIds[ident] = threadId
+    return threadId
+
+
+
+  @staticmethod
+  def _depth():
+    return min(len(getattr(renderTimers, "stack", [])), 255)
+
+
+
+  def access(self, clip, n, served, userScriptIsRunning):
+    flags = (servedFlag if served else 0) | (scriptRunningFlag if userScriptIsRunning else 0)
+    with self._lock:
+      if self._file is None:
+        return
+      nodeId = self._nodeId(clip)
+      self._file.write(b"A" + accessRecord.pack(nodeId, n, self._depth(), self._threadId(), flags))
+
+
+
+  def render(self, clip, n, nbytes, renderTime, selfRenderTime, userScriptIsRunning):
+    flags = scriptRunningFlag if userScriptIsRunning else 0
+    with self._lock:
+      if self._file is None:
+        return
+      nodeId = self._nodeId(clip)
+      self._file.write(b"R" + renderRecord.pack(nodeId, n, self._depth(), self._threadId(), flags, nbytes, renderTime, selfRenderTime))
+
+
+
+  def session(self, leaves):
+    with self._lock:
+      if self._file is None:
+        return
+      leafIds = [self._nodeId(leaf) for leaf in leaves]
+      self._file.write(b"S" + sessionRecord.pack(len(leafIds)))
+      self._file.write(struct.pack("<{}I".format(len(leafIds)), *leafIds))
+
+
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+
+
+
+def readTrace(filepath):
+  """readTrace(filepath)
+
+  Yield the records of the trace at `filepath` as tuples:
+  * ("node", nodeId, isIndirection, fingerprint, sourceIds, name)
+  * ("access", nodeId, n, depth, thread, served, userScriptIsRunning)
+  * ("render", nodeId, n, depth, thread, userScriptIsRunning, nbytes, renderTime, selfRenderTime)
+  * ("session", leafIds)
+  """
+
+  with open(filepath, "rb") as f:
+    header = f.read(len(magic) + 2)
+    if header[:len(magic)] != magic:
+      raise ValueError("{} is not a reflect trace".format(filepath))
+    if struct.unpack("<H", header[len(magic):])[0] != version:
+      raise ValueError("unsupported trace version {}".format(struct.unpack("<H", header[len(magic):])[0]))
+
+    def read(size):
+      data = f.read(size)
+      if len(data) != size:
+        raise EOFError()
+      return data
+
+    while True:
+      tag = f.read(1)
+      if not tag:
+        return
+      try:
+        if tag == b"A":
+          (nodeId, n, depth, thread, flags) = accessRecord.unpack(read(accessRecord.size))
+          yield ("access", nodeId, n, depth, thread, bool(flags & servedFlag), bool(flags & scriptRunningFlag))
+        elif tag == b"R":
+          (nodeId, n, depth, thread, flags, nbytes, renderTime, selfRenderTime) = renderRecord.unpack(read(renderRecord.size))
+          yield ("render", nodeId, n, depth, thread, bool(flags & scriptRunningFlag), nbytes, renderTime, selfRenderTime)
+        elif tag == b"N":
+          (nodeId, isIndirection, fingerprint, sourceCount, nameLength) = nodeRecord.unpack(read(nodeRecord.size))
+          sourceIds = list(struct.unpack("<{}I".format(sourceCount), read(4 * sourceCount)))
+          name = read(nameLength).decode("utf-8", "replace")
+          yield ("node", nodeId, bool(isIndirection), fingerprint.hex(), sourceIds, name)
+        elif tag == b"S":
+          (leafCount,) = sessionRecord.unpack(read(sessionRecord.size))
+          yield ("session", list(struct.unpack("<{}I".format(leafCount), read(4 * leafCount))))
+        else:
+          raise ValueError("unknown record type {} in {}".format(tag, filepath))
+      except EOFError:
+        # The trace was cut off part way through a record, e.g. because the server was killed
+        return
@@ -12,22 +12,32 @@ import logging
 from reflect.server import ScriptRunner
 from reflect.core.util import frameToTimecode
 from reflect.server.cache import Cache
+from reflect.server.prefetch import Prefetcher
 
 
 
 class Window(object):
-  """Window()
+  """Window(filepath, prefetchWorkers = 2, prefetchFrames = 30)
 
   This class controls the preview window GUI.
+  Up to `prefetchFrames` frames ahead of the playhead are rendered by `prefetchWorkers` background
+  threads (see Prefetcher); set either to 0 to disable prefetching.
   """
 
 
 
-  def __init__(self, filepath):
+  def __init__(self, filepath, prefetchWorkers = 2, prefetchFrames = 30):
     super().__init__()
 
     self._filepath = filepath
 
+    if prefetchWorkers > 0 and prefetchFrames > 0:
+      self._prefetcher = Prefetcher(workerCount = prefetchWorkers, lookahead = prefetchFrames)
+    else:
+      self._prefetcher = None
+    self._seekStep = 1     # The last movement of the playhead, which tells the prefetcher where to look
+    self._seekLoops = True # Whether the last seek wrapped around the ends of the clip
+
     self._callQueue = queue.Queue()
 
     self._clock = pygame.time.Clock()
@@ -81,6 +91,9 @@ class Window(object):
   def run(self):
     # Preview window event loop
 
+    if self._prefetcher is not None:
+      self._prefetcher.start()
+
     while self._running:
       # Handle any incoming method calls
       while not self._callQueue.empty():
@@ -294,6 +307,9 @@ class Window(object):
 
       self._clock.tick(self._fps)
 
+    if self._prefetcher is not None:
+      self._prefetcher.stop()
+
     pygame.quit()
 
 
@@ -406,7 +422,9 @@ class Window(object):
       if relative is not None:
         raise Exception("Expected exactly one of `n` or `relative`, but received both")
       self._leaves[self._currentTab]["currentFrame"] = n
+      (self._seekStep, self._seekLoops) = (1, True)
     elif relative is not None:
+      (self._seekStep, self._seekLoops) = (math.ceil(relative), loop)
       self._leaves[self._currentTab]["currentFrame"] += math.ceil(relative)
       frameCount = self._leaves[self._currentTab]["clip"].frameCount
       if loop:
@@ -524,6 +542,10 @@ class Window(object):
     self._redrawTimeline(n, leaf)
     self._redrawProgress(n, leaf)
 
+    if self._prefetcher is not None:
+      # Start rendering the frames that are likely to be shown next
+      self._prefetcher.update(leaf, n, self._seekStep, self._seekLoops)
+
 
 
   def _redrawTimeline(self, n, leaf):
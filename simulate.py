@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import reflect
+from reflect.server.simulator import simulate, printResults
+
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("traceFilepath", help = "The trace to replay, as recorded by start.py --traceFilepath.")
+  parser.add_argument("-a", "--algorithms", nargs = "+", default = None, choices = list(reflect.cache.cacheAlgorithms.keys()), help = "The caching algorithms to simulate. Default is all of them.")
+  parser.add_argument("-m", "--cacheSizes", nargs = "+", default = None, help = "The cache sizes, in MiB, to simulate. Default is 1/64 up to 1 times the size of the distinct frames rendered in the trace.")
+  parser.add_argument("-v", "--verbose", action = "store_true", help = "Log the progress of the simulation.")
+  args = parser.parse_args()
+
+  if args.verbose:
+    logging.basicConfig(format = "%(levelname)s: %(message)s", level = logging.INFO)
+
+  if args.cacheSizes is not None:
+    capacities = [int(float(size) * 1024 * 1024) for size in args.cacheSizes]
+  else:
+    capacities = None
+
+  results = simulate(args.traceFilepath, algorithms = args.algorithms, capacities = capacities)
+  printResults(results)
+
+
+
+if __name__ == "__main__":
+  main()
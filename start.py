@@ -17,9 +17,25 @@ def main():
   parser.add_argument("-V", "--visualiseFilepath", required = False, default = None, help = "Write the priority graph to the specified path every time it is updated.")
   parser.add_argument("-t", "--disableTransformations", action = "store_true", help = "Prevent the order of effects from being automatically manipulated.")
   parser.add_argument("-f", "--filepath", required = False, default = None, help = "The path to the python script to watch.")
-  parser.add_argument("-m", "--cacheSize", required = False, default = 100, help = "The maximum size, in MiB, of the cache. Default is 100 MiB.")
-  parser.add_argument("-c", "--cacheAlgorithm", required = False, default = "specialised", choices = ["specialised", "fifo", "lru", "mru"], help = "The caching algorithm to use.")
+  parser.add_argument("-m", "--cacheSize", required = False, default = 100, help = "The maximum size, in MiB, of the cache, or \"auto\" to size it (and resize it as the available memory changes) from the system and container memory limits. Default is 100 MiB.")
+  parser.add_argument("-a", "--autoCacheFraction", required = False, default = 0.5, help = "The fraction of the available memory to use for the cache when --cacheSize is \"auto\". Default is 0.5.")
+  parser.add_argument("-c", "--cacheAlgorithm", required = False, default = "specialised", choices = ["specialised", "fifo", "lru", "mru", "cost", "arc", "lirs"], help = "The caching algorithm to use. cost weighs how long each frame took to render against its size; arc and lirs are scan-resistant alternatives to lru.")
+  parser.add_argument("-z", "--compressedCacheSize", required = False, default = 0, help = "Compress frames evicted from the cache and keep them in memory, up to the specified size in MiB. Default is 0 (disabled).")
+  parser.add_argument("-Z", "--compressedCacheCodec", required = False, default = "zlib", choices = ["zlib", "jpeg"], help = "The codec used by the compressed cache. zlib is lossless; jpeg is lossy but more compact, and is usually good enough for previewing.")
+  parser.add_argument("-x", "--sharedCacheName", required = False, default = None, help = "Share rendered frames, through shared memory, with any other processes (e.g. another instance of reflect) that use a shared cache of the same name.")
+  parser.add_argument("-X", "--sharedCacheSize", required = False, default = 512, help = "The size, in MiB, of the shared cache, if this process is the first to use it. Default is 512 MiB.")
+  parser.add_argument("-D", "--diskCachePath", required = False, default = None, help = "Spill frames evicted from the cache into a persistent cache in the specified directory, so that they survive restarts.")
+  parser.add_argument("-M", "--diskCacheSize", required = False, default = 1024, help = "The maximum size, in MiB, of the persistent cache. Default is 1024 MiB.")
+  parser.add_argument("-w", "--prefetchWorkers", required = False, default = 2, help = "The number of threads that render frames ahead of the playhead. Default is 2; 0 disables prefetching.")
+  parser.add_argument("-k", "--prefetchFrames", required = False, default = 30, help = "The maximum number of frames ahead of the playhead to prefetch. Default is 30.")
+  parser.add_argument("-r", "--readersPerFile", required = False, default = 4, help = "The maximum number of readers to keep open for each loaded video file, so that clips that read the same file at far-apart positions don't make one reader seek back and forth. Default is 4.")
+  parser.add_argument("-b", "--branchWorkers", required = False, default = 4, help = "The number of threads that render the independent sources of a composite or slide transition concurrently. Default is 4; 0 renders them one after the other.")
   parser.add_argument("-s", "--enableStatistics", action = "store_true", help = "Collect information about cache hits and misses. Press `s` in the console to print the current statistics, or `r` to reset them.")
+  parser.add_argument("-S", "--statisticsFilepath", required = False, default = None, help = "Write per-node cache statistics (hits, misses, evictions, render times, ...) to the specified JSON file after each session. Implies --enableStatistics.")
+  parser.add_argument("-T", "--traceFilepath", required = False, default = None, help = "Record a trace of the frames requested from the cache to the specified file, which can be replayed against other cache algorithms and sizes with simulate.py.")
+  parser.add_argument("-u", "--deduplicate", action = "store_true", help = "Store identical frames (e.g. of title cards, letterboxing, or slowed-down clips) only once in the cache, at the cost of hashing each frame as it is cached.")
+  parser.add_argument("-g", "--stagingSize", required = False, default = None, help = "The maximum size, in MiB, of the frames rendered while the script runs that are held in memory until they are committed to the cache. Any more are spilled to a temporary file. Default is the size of the cache.")
+  parser.add_argument("-G", "--stagingSpillPath", required = False, default = None, help = "The directory in which to create the temporary file for spilled frames (see --stagingSize). Default is the system's temporary directory.")
   parser.add_argument("-l", "--logFilepath", required = False, default = None, help = "Write the log output to the specified file.")
   args = parser.parse_args()
 
@@ -41,10 +57,13 @@ def main():
   if args.disableTransformations:
     reflect.setTransformations([])
   else:
-    reflect.setTransformations(["CanonicalOrder", "FlattenConcats"])
+    reflect.setTransformations(["CanonicalOrder", "FlattenConcats", "FlattenComposites", "FusePointwise"])
+
+  reflect.setMaxReadersPerFile(int(args.readersPerFile))
 
   reflect.server.debug = args.debug
-  reflect.server.start(filepath, defaultFilepath, cacheSize = int(args.cacheSize) * 1024 * 1024, cacheAlgorithm = args.cacheAlgorithm, enableStatistics = args.enableStatistics, logFilepath = args.logFilepath)
+  reflect.server.statisticsFilepath = args.statisticsFilepath
+  reflect.server.start(filepath, defaultFilepath, cacheSize = "auto" if args.cacheSize == "auto" else int(args.cacheSize) * 1024 * 1024, cacheFraction = float(args.autoCacheFraction), cacheAlgorithm = args.cacheAlgorithm, compressedCacheSize = int(args.compressedCacheSize) * 1024 * 1024, compressedCacheCodec = args.compressedCacheCodec, sharedCacheName = args.sharedCacheName, sharedCacheSize = int(args.sharedCacheSize) * 1024 * 1024, diskCachePath = args.diskCachePath, diskCacheSize = int(args.diskCacheSize) * 1024 * 1024, prefetchWorkers = int(args.prefetchWorkers), prefetchFrames = int(args.prefetchFrames), branchWorkers = int(args.branchWorkers), enableStatistics = args.enableStatistics or args.statisticsFilepath is not None, deduplicate = args.deduplicate, stagingSize = int(args.stagingSize) * 1024 * 1024 if args.stagingSize is not None else None, stagingSpillPath = args.stagingSpillPath, traceFilepath = args.traceFilepath, logFilepath = args.logFilepath)
 
   print("")
 
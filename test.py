@@ -4,8 +4,13 @@ import logging
 import sys
 import numpy
 import random
+import math
+import time
 import pygame
 import cv2
+import imageio
+import shutil
+import importlib.util
 
 pygame.init()
 random.seed(42)
@@ -14,6 +19,57 @@ bbb_480p_avi_path = "D:/Documents/University/Year 3/_Project/Media/sources/bbb_4
 
 
 
+class SyntheticVideoClip(reflect.core.clips.VideoClip):
+  """SyntheticVideoClip(seed, size, frameCount)
+
+  Deterministic pseudorandom frames, for tests that shouldn't depend on any media files.
+  """
+
+  def __init__(self, seed, size, frameCount):
+    super().__init__("synthetic:{}".format(seed), reflect.core.clips.VideoClipMetadata(size = size, frameCount = frameCount, fps = 30))
+    self._seed = seed
+
+  def _framegen(self, n):
+    return numpy.random.RandomState(self._seed * 100003 + n).randint(0, 256, (self.height, self.width, 3)).astype(numpy.uint8)
+
+@reflect.core.clips.clipMethod
+def synthetic(seed = 0, size = (64, 48), frameCount = 10):
+  return SyntheticVideoClip(seed, size, frameCount)
+
+
+
+class StillVideoClip(SyntheticVideoClip):
+  # Every frame is the same, like a title card
+
+  def _framegen(self, n):
+    return super()._framegen(0)
+
+@reflect.core.clips.clipMethod
+def still(seed = 0, size = (64, 48), frameCount = 10):
+  return StillVideoClip(seed, size, frameCount)
+
+
+
+class SlowVideoClip(SyntheticVideoClip):
+  # Expensive to render, but able to render just part of a frame, like a blurred crop
+
+  delay = 0.02
+
+  def _framegen(self, n):
+    time.sleep(self.delay)
+    return super()._framegen(n)
+
+  def _framegenRegion(self, n, region):
+    (x1, y1, x2, y2) = region
+    time.sleep(self.delay)
+    return super()._framegen(n)[y1:y2, x1:x2]
+
+@reflect.core.clips.clipMethod
+def slow(seed = 0, size = (64, 48), frameCount = 10):
+  return SlowVideoClip(seed, size, frameCount)
+
+
+
 def reflect_session(test_func):
   def do_test(self, *args, **kwargs):
     import warnings
@@ -26,10 +82,9 @@ def reflect_session(test_func):
 
     test_func(self, *args, **kwargs)
 
-    for filepath, readers in reflect.core.roots.load.openReaders.items():
-      for reader in readers:
-        reader.close()
-    reflect.core.roots.load.openReaders = {}
+    for filepath, pool in reflect.core.roots.load.openPools.items():
+      pool.close()
+    reflect.core.roots.load.openPools = {}
 
   return do_test
 
@@ -145,6 +200,892 @@ class CacheTestCase(unittest.TestCase):
 
 
 
+  @reflect_session
+  def test_incremental_reprioritisation(self):
+    cache = reflect.cache.Cache.current()
+
+    def session(script):
+      reflect.CompositionGraph.reset()
+      leaf = script()
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      return leaf
+
+    y = session(lambda: synthetic(1).brighten(0.1).blur(3))
+    y.frame(0)
+    blurEntry = y.cacheEntry
+    self.assertEqual(len(cache._committed), 3)
+
+    # Nodes that stay in the graph keep their entries, and nodes that leave it are only purged
+    # once they are old, empty, and have a low priority
+    for i in range(10):
+      session(lambda: synthetic(1).brighten(0.1).gaussianBlur(5))
+    self.assertEqual(len(cache._committed), 4)
+    self.assertIn(id(blurEntry), cache._agedCacheEntries)
+    self.assertEqual(cache.get(y, 0).shape, (48, 64, 3))
+
+    with cache._stripeLock(blurEntry):
+      blurEntry.discardBytes(blurEntry[0].nbytes, cache._discarded)
+    cache._priorityQueue.remove(blurEntry)
+    z = session(lambda: synthetic(1).brighten(0.1).gaussianBlur(5))
+    self.assertEqual(len(cache._committed), 3)
+    self.assertNotIn(id(blurEntry), cache._agedCacheEntries)
+
+    # A node that rejoins the graph is no longer old
+    z.frame(0)
+    for i in range(10):
+      session(lambda: synthetic(1).brighten(0.1))
+    w = session(lambda: synthetic(1).brighten(0.1).gaussianBlur(5))
+    self.assertEqual(cache._epoch - w.cacheEntry.epoch, 0)
+    self.assertEqual(w.cacheEntry.isHotnode, True)
+    self.assertEqual(len(cache._agedCacheEntries), 0)
+    self.assertIn(w.cacheEntry, cache._priorityQueue)
+    self.assertEqual(cache._priorityQueue.priorityKey(w.cacheEntry), math.log2(w.cacheEntry.priority) + cache._epoch)
+
+
+
+  @reflect_session
+  def test_staging_spill(self):
+    frameSize = 64 * 48 * 3
+    cache = reflect.cache.SpecialisedCache(100 * frameSize, maxStagedSize = 3 * frameSize)
+    reflect.cache.Cache.current().swap(cache)
+
+    cache.userScriptIsRunning = True
+    y = synthetic(1).brighten(0.1)
+    images = [y.frame(n).copy() for n in range(5)]
+    cache.userScriptIsRunning = False
+
+    # The frames of both clips are staged, but only the first 3 are held in memory
+    self.assertEqual(cache._stagedSize, 3 * frameSize)
+    self.assertEqual(cache._stagingSpill.size, 7 * frameSize)
+    for n in range(5):
+      self.assertTrue(numpy.array_equal(cache.get(y, n), images[n]))
+
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    self.assertEqual(cache._stagingSpill.size, 0)
+    for n in range(5):
+      self.assertFalse(reflect.cache.StagingSpill.isSpilled(y.cacheEntry[n]))
+      self.assertTrue(numpy.array_equal(cache.get(y, n), images[n]))
+
+
+
+  @reflect_session
+  def test_deduplication(self):
+    frameSize = 64 * 48 * 3
+    cache = reflect.cache.LRUCache(100 * frameSize, enableStatistics = True, deduplicate = True)
+    reflect.cache.Cache.current().swap(cache)
+
+    y = still(1).brighten(0.1)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    for n in range(y.frameCount):
+      y.frame(n)
+
+    # Each clip's frames are identical, so only one buffer per clip is held
+    self.assertEqual(cache._currentSize, 2 * frameSize)
+    self.assertEqual(cache._ledger.deduplications, 18)
+    self.assertEqual(cache._ledger.dedupedBytes, 18 * frameSize)
+    self.assertIn("dedup: 18 frames", cache.stats())
+    self.assertIs(cache.get(y, 3), cache.get(y, 7))
+
+    for n in range(9):
+      with cache._stripeLock(y.cacheEntry):
+        self.assertEqual(y.cacheEntry.discardFrame(n, cache._discarded), 0)
+    self.assertEqual(cache._ledger.dedupedBytes, 9 * frameSize)
+    with cache._stripeLock(y.cacheEntry):
+      self.assertEqual(y.cacheEntry.discardFrame(9, cache._discarded), frameSize)
+
+
+
+  @reflect_session
+  def test_resize(self):
+    frameSize = 64 * 48 * 3
+    for algorithm, cacheKind in reflect.cache.cacheAlgorithms.items():
+      cache = cacheKind(60 * frameSize)
+      reflect.cache.Cache.current().swap(cache)
+      reflect.CompositionGraph.reset()
+
+      y = synthetic(1, frameCount = 20).brighten(0.1)
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      for n in range(y.frameCount):
+        y.frame(n)
+      filled = cache._currentSize
+      self.assertGreater(filled, 15 * frameSize, algorithm)
+
+      # Shrinking the cache evicts frames through the usual policy
+      cache.resize(15 * frameSize)
+      self.assertLessEqual(cache._currentSize, 15 * frameSize, algorithm)
+      self.assertEqual(cache.maxStagedSize, 15 * frameSize)
+      self.assertEqual(cache._currentSize, sum(image.nbytes for entry in cache._committed.values() for image in entry.values()), algorithm)
+
+      # ... and then the cache only fills up to its new size
+      for n in range(y.frameCount):
+        y.frame(n)
+      self.assertLessEqual(cache._currentSize, 15 * frameSize, algorithm)
+
+      # ... until it is allowed to grow again
+      cache.resize(60 * frameSize)
+      reflect.CompositionGraph.reset()
+      y = synthetic(2, frameCount = 20).brighten(0.1)
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      for n in range(y.frameCount):
+        y.frame(n)
+      self.assertGreater(cache._currentSize, 15 * frameSize, algorithm)
+
+
+
+  def test_priority_queue(self):
+    rng = random.Random(1)
+    entries = []
+    for i in range(50):
+      entry = reflect.cache.CacheEntry(node = None, isRoot = False, isHotnode = False, precedesHotnode = False, rootDistance = rng.randint(0, 10), isIndirection = False, traverseTime = 0)
+      entry.epoch = rng.randint(0, 3)
+      entry.successors = { i: {} }
+      if rng.random() < 0.7:
+        dict.__setitem__(entry, 0, None)
+      entries.append(entry)
+    queue = reflect.cache.SpecialisedPriorityQueue(entries, 3)
+
+    def check():
+      nonempty = [e for e in entries if len(e) > 0]
+      self.assertEqual(len(queue), len(nonempty))
+      if nonempty:
+        self.assertEqual(queue.peek().dampedPriority(queue.epoch), min(e.dampedPriority(queue.epoch) for e in nonempty))
+
+    for step in range(200):
+      check()
+      entry = rng.choice(entries)
+      if len(entry) > 0:
+        dict.__delitem__(entry, 0)
+        queue.remove(entry)
+      else:
+        dict.__setitem__(entry, 0, None)
+        queue.add(entry)
+      if step % 20 == 0:
+        # Start a new epoch, in which some entries join or leave the graph, and some change priority
+        epoch = queue.epoch + 1
+        graph = [e for e in entries if e.epoch == queue.epoch]
+        left = rng.sample(graph, min(len(graph), 5))
+        outside = [e for e in entries if e not in graph]
+        joined = rng.sample(outside, min(len(outside), 5))
+        changed = [e for e in graph if e not in left][:3]
+        for e in joined + changed:
+          e.rootDistance = rng.randint(0, 10)
+        for e in joined + [e for e in graph if e not in left]:
+          e.epoch = epoch
+        queue.reprioritise(epoch, joined, left, changed, [])
+    check()
+
+
+
+  @reflect_session
+  def test_concurrent_access(self):
+    from concurrent.futures import ThreadPoolExecutor
+    frameSize = 64 * 48 * 3
+    for cacheKind in [reflect.cache.SpecialisedCache, reflect.cache.FIFOCache, reflect.cache.LRUCache, reflect.cache.MRUCache, reflect.cache.CostAwareCache, reflect.cache.ARCCache, reflect.cache.LIRSCache]:
+      cache = cacheKind(20 * frameSize)
+      reflect.cache.Cache.current().swap(cache)
+
+      def session(seeds):
+        reflect.CompositionGraph.reset()
+        cache.userScriptIsRunning = True
+        clips = [synthetic(seed, frameCount = 30).brighten(0.5).blur(3) for seed in seeds]
+        return clips
+
+      clips = session([1, 2])
+      cache.userScriptIsRunning = False
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      expected = { (i, n): clip.frame(n).copy() for i, clip in enumerate(clips) for n in range(clip.frameCount) }
+
+      def hammer(seed):
+        rng = random.Random(seed)
+        for _ in range(200):
+          i = rng.randrange(len(clips))
+          n = rng.randrange(clips[i].frameCount)
+          self.assertTrue(numpy.array_equal(clips[i].frame(n), expected[(i, n)]))
+
+      with ThreadPoolExecutor(max_workers = 8) as executor:
+        futures = [executor.submit(hammer, seed) for seed in range(16)]
+        # Meanwhile, run another session, as the script runner would
+        session([2, 3])
+        cache.userScriptIsRunning = False
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+        for future in futures:
+          future.result()
+
+      committedBytes = sum(data.nbytes for entry in cache._committed.values() for data in dict.values(entry))
+      self.assertEqual(cache._currentSize, committedBytes)
+      self.assertLessEqual(cache._currentSize, cache.maxSize)
+
+
+
+  @reflect_session
+  def test_view_accounting(self):
+    parent = numpy.zeros((100, 100, 3), dtype = numpy.uint8)
+    other = numpy.ones((100, 100, 3), dtype = numpy.uint8)
+    regions = [parent[0:50], parent[0:10, 0:10], other]
+    class ViewVideoClip(reflect.core.clips.VideoClip):
+      def _framegen(self, n):
+        return regions[n]
+    clip = reflect.core.clips.clipMethod(ViewVideoClip)("views", reflect.core.clips.VideoClipMetadata(size = (100, 100), frameCount = 3, fps = 30))
+
+    cache = reflect.cache.LRUCache(parent.nbytes + parent.nbytes // 10)
+    reflect.cache.Cache.current().swap(cache)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+
+    # Views of the same buffer count once, at the size of the whole buffer
+    clip.frame(0)
+    clip.frame(1)
+    self.assertEqual(cache._currentSize, parent.nbytes)
+
+    # Evicting the large view leaves only a small view of the parent, so it gets copied
+    clip.frame(2)
+    self.assertEqual(cache._currentSize, other.nbytes + regions[1].nbytes)
+    self.assertTrue(numpy.array_equal(cache.get(clip, 1), regions[1]))
+    self.assertIsNot(reflect.cache.BufferLedger.ownerOf(cache.get(clip, 1))[0], parent)
+
+    # A small view of a buffer that isn't otherwise cached is copied straight away
+    self.assertEqual(reflect.cache.BufferLedger().compacted(regions[1])[0].base, None)
+    self.assertIs(reflect.cache.BufferLedger().compacted(regions[0])[0], regions[0])
+
+
+
+  @reflect_session
+  def test_cost_aware_eviction(self):
+    import time
+    class SlowVideoClip(SyntheticVideoClip):
+      def _framegen(self, n):
+        time.sleep(0.02)
+        return super()._framegen(n)
+    expensive = reflect.core.clips.clipMethod(SlowVideoClip)(1, (64, 48), 5)
+    cheap = synthetic(2)
+
+    cache = reflect.cache.CostAwareCache(8 * 64 * 48 * 3)
+    reflect.cache.Cache.current().swap(cache)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+
+    for n in range(expensive.frameCount):
+      expensive.frame(n)
+    for n in range(cheap.frameCount):
+      cheap.frame(n)
+    self.assertGreaterEqual(expensive.selfRenderTime, 0.02)
+    self.assertLess(cheap.selfRenderTime, expensive.selfRenderTime)
+
+    # The cheap frames are evicted first, even though the expensive ones were rendered earlier
+    for n in range(expensive.frameCount):
+      self.assertTrue(cache.contains(expensive, n))
+    self.assertEqual(sum(cache.contains(cheap, n) for n in range(cheap.frameCount)), 3)
+    self.assertLessEqual(cache._currentSize, cache.maxSize)
+
+
+
+  @reflect_session
+  def test_scan_resistance(self):
+    frameSize = 64 * 48 * 3
+    hits = {}
+    for cacheKind in [reflect.cache.LRUCache, reflect.cache.ARCCache, reflect.cache.LIRSCache]:
+      reflect.CompositionGraph.reset()
+      y = synthetic(1, frameCount = 20)
+      cache = cacheKind(10 * frameSize, enableStatistics = True)
+      reflect.cache.Cache.current().swap(cache)
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+
+      # Loop over more frames than fit into the cache, with the odd scrub back and forth
+      for loop in range(4):
+        for n in list(range(y.frameCount)) + [3, 2, 1]:
+          self.assertTrue(numpy.array_equal(y.frame(n), y._framegen(n)))
+          self.assertLessEqual(cache._currentSize, cache.maxSize)
+      self.assertLessEqual(len(cache._priorityQueue), 10)
+      hits[cacheKind] = cache._stats["hits"]
+
+    self.assertGreater(hits[reflect.cache.ARCCache], hits[reflect.cache.LRUCache])
+    self.assertGreater(hits[reflect.cache.LIRSCache], hits[reflect.cache.LRUCache])
+
+
+
+  @reflect_session
+  def test_node_stats(self):
+    import os
+    import json
+    import tempfile
+    y = synthetic(1).brighten(0.5)
+    cache = reflect.cache.LRUCache(5 * y.width * y.height * 3, enableStatistics = True)
+    reflect.cache.Cache.current().swap(cache)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    for loop in range(2):
+      for n in range(y.frameCount):
+        y.frame(n)
+
+    nodes = { node["fingerprint"]: node for node in cache.nodeStats() }
+    brightened = nodes[y.fingerprint]
+    source = nodes[y._source[0].fingerprint]
+    self.assertEqual(brightened["compulsoryMisses"], y.frameCount)
+    self.assertEqual(brightened["hits"] + brightened["compulsoryMisses"] + brightened["noncompulsoryMisses"], 2 * y.frameCount)
+    self.assertEqual(brightened["renders"], brightened["compulsoryMisses"] + brightened["noncompulsoryMisses"])
+    self.assertGreater(brightened["evictions"] + source["evictions"], 0)
+    self.assertLessEqual(brightened["meanSelfRenderTime"], brightened["meanRenderTime"])
+    self.assertEqual(brightened["framesHeld"] + source["framesHeld"], 5)
+    self.assertEqual(sum(node["hits"] for node in nodes.values()), cache._stats["hits"])
+
+    with tempfile.TemporaryDirectory() as directory:
+      filepath = os.path.join(directory, "stats.json")
+      cache.writeNodeStats(filepath)
+      with open(filepath, encoding = "utf-8") as f:
+        report = json.load(f)
+    self.assertEqual(report["cache"], "LRUCache")
+    self.assertEqual(len(report["nodes"]), 2)
+
+    cache.resetStats()
+    self.assertTrue(all(node["hits"] == 0 and node["renders"] == 0 for node in cache.nodeStats()))
+
+
+
+class FramePoolTestCase(unittest.TestCase):
+
+  def test_reuse(self):
+    pool = reflect.FramePool(1024*1024)
+    a = pool.empty((48, 64, 3))
+    buffer = reflect.cache.BufferLedger.ownerOf(a)[0]
+    self.assertGreaterEqual(buffer.nbytes, a.nbytes)
+    pool.release(buffer)
+    del buffer
+
+    # The frame is still referenced, so its buffer mustn't be handed out again
+    b = pool.empty((48, 64, 3))
+    self.assertEqual((pool.allocations, pool.reuses), (2, 0))
+    self.assertFalse(numpy.shares_memory(a, b))
+
+    del a
+    c = pool.empty((64, 48, 3))
+    self.assertEqual((pool.allocations, pool.reuses), (2, 1))
+
+    # Buffers that don't come from the pool are ignored
+    pool.release(numpy.empty(100, dtype = numpy.uint8))
+    self.assertEqual(pool.releases, 1)
+
+
+
+  @reflect_session
+  def test_eviction_releases_buffers(self):
+    pool = reflect.FramePool(100*1024*1024)
+    oldPool = reflect.FramePool.swap(pool)
+    try:
+      y = synthetic(1).brighten(0.5)
+      cache = reflect.cache.LRUCache(2 * y.width * y.height * 3)
+      reflect.cache.Cache.current().swap(cache)
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      for n in range(y.frameCount):
+        self.assertTrue(numpy.array_equal(y.frame(n), y._framegen(n)))
+      self.assertGreater(pool.releases, 0)
+      self.assertGreater(pool.reuses, 0)
+    finally:
+      reflect.FramePool.swap(oldPool)
+
+
+
+class BranchExecutorTestCase(unittest.TestCase):
+
+  @reflect_session
+  def test_concurrent_branches(self):
+    def script():
+      a = synthetic(1, frameCount = 6).gaussianBlur(5)
+      b = synthetic(2, frameCount = 6).blur(3).crop(x1 = 0, y1 = 0, x2 = 32, y2 = 24)
+      c = synthetic(3, frameCount = 6).brighten(0.2)
+      d = synthetic(4, frameCount = 6).greyscale().crop(x1 = 0, y1 = 0, x2 = 16, y2 = 16)
+      return a.composite(b, x1 = 10, y1 = 5).composite(c.composite(d, x1 = 3, y1 = 3).crop(x1 = 0, y1 = 0, x2 = 40, y2 = 30), x1 = 20, y1 = 10)
+
+    results = []
+    oldExecutor = reflect.BranchExecutor.current()
+    try:
+      # A single worker means that nested composites have to render some branches themselves
+      for workerCount in [0, 1, 4]:
+        executor = reflect.BranchExecutor(workerCount, minimumRenderTime = 0)
+        reflect.BranchExecutor.swap(executor)
+        cache = reflect.cache.SpecialisedCache(100 * 1024 * 1024)
+        reflect.cache.Cache.current().swap(cache)
+        reflect.CompositionGraph.reset()
+        leaf = script()
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+        results.append(numpy.stack([leaf.frame(n) for n in range(leaf.frameCount)]))
+        # The outer composite requests the parts of the inner one that its foreground doesn't cover
+        # separately, and one of them overlaps the inner foreground too
+        self.assertEqual(executor.concurrentFrames, 0 if workerCount == 0 else 4 * leaf.frameCount)
+        executor.close()
+      self.assertTrue(numpy.array_equal(results[0], results[1]))
+      self.assertTrue(numpy.array_equal(results[0], results[2]))
+
+      # Branches that share a clip are rendered one after the other
+      executor = reflect.BranchExecutor(2, minimumRenderTime = 0)
+      reflect.BranchExecutor.swap(executor)
+      reflect.CompositionGraph.reset()
+      x = synthetic(5, frameCount = 4)
+      leaf = x.composite(x.brighten(0.5).crop(x1 = 0, y1 = 0, x2 = 8, y2 = 8), x1 = 0, y1 = 0)
+      cache.reprioritise(reflect.CompositionGraph.current())
+      cache.commit()
+      leaf.frame(0)
+      self.assertEqual(executor.concurrentFrames, 0)
+      executor.close()
+    finally:
+      reflect.BranchExecutor.swap(oldExecutor)
+
+
+
+  @reflect_session
+  def test_region_render_time(self):
+    # Parts of frames aren't cached, so the time spent rendering them is the requesting clip's own
+    oldExecutor = reflect.BranchExecutor.current()
+    try:
+      for workerCount in [0, 2]:
+        executor = reflect.BranchExecutor(workerCount, minimumRenderTime = 0)
+        reflect.BranchExecutor.swap(executor)
+        cache = reflect.cache.CostAwareCache(100 * 1024 * 1024)
+        reflect.cache.Cache.current().swap(cache)
+        reflect.CompositionGraph.reset()
+        # Only the top-left quarter of the foreground is on screen
+        leaf = synthetic(6, frameCount = 3).composite(slow(7, frameCount = 3), x1 = 32, y1 = 24)
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+        for n in range(leaf.frameCount):
+          leaf.frame(n)
+        self.assertGreaterEqual(leaf.selfRenderTime, SlowVideoClip.delay)
+        executor.close()
+    finally:
+      reflect.BranchExecutor.swap(oldExecutor)
+
+
+
+class ReaderPoolTestCase(unittest.TestCase):
+
+  def test_reader_assignment(self):
+    readers = []
+
+    class Reader(object):
+      # Reads frames of a synthetic video, keeping track of its position as imageio's ffmpeg reader
+      # does, and of how often it would have had to seek
+      format = None
+
+      def __init__(self, filepath):
+        self.position = -1
+        self.seeks = 0
+        self.closed = False
+        readers.append(self)
+
+      def get_meta_data(self):
+        return { "size": (64, 48), "nframes": 6000, "fps": 30 }
+
+      def get_data(self, n):
+        if n < self.position or n > self.position + 100:
+          self.seeks += 1
+        self.position = n
+        return numpy.full((48, 64, 3), n % 256, numpy.uint8)
+
+      def close(self):
+        self.closed = True
+
+    # Interleave reads of two far-apart parts of the file, as a composite of two subclips would
+    pool = reflect.core.roots.load.ReaderPool("video.mp4", maxReaders = 2, openReader = Reader)
+    for n in range(100):
+      self.assertEqual(pool.get_data(n)[0, 0, 0], n % 256)
+      self.assertEqual(pool.get_data(5000 + n)[0, 0, 0], (5000 + n) % 256)
+    self.assertEqual(pool.readerCount, 2)
+    self.assertEqual(pool.reads, 200)
+    self.assertEqual(pool.seeks, 1)
+    self.assertEqual(sum(reader.seeks for reader in readers), 1)
+
+    # At the cap, the reader that was used least recently seeks
+    pool.get_data(3000)
+    pool.get_data(101)
+    self.assertEqual(pool.readerCount, 2)
+    self.assertEqual([reader.position for reader in readers], [3000, 101])
+    self.assertEqual(pool.seeks, 3)
+
+    pool.close()
+    self.assertTrue(all(reader.closed for reader in readers))
+
+
+
+class PrefetcherTestCase(unittest.TestCase):
+
+  @reflect_session
+  def test_plan(self):
+    y = synthetic(1, frameCount = 100)
+    prefetcher = reflect.Prefetcher(lookahead = 5)
+    self.assertEqual(prefetcher.plan(y, 10, 1, True), [11, 12, 13, 14, 15])
+    self.assertEqual(prefetcher.plan(y, 1, -1, True), [0, 99, 98, 97, 96])
+    self.assertEqual(prefetcher.plan(y, 80, 9, False), [89, 98])
+    self.assertEqual(prefetcher.plan(synthetic(2, frameCount = 3), 1, 1, True), [2, 0])
+
+
+
+  @reflect_session
+  def test_prefetching(self):
+    y = synthetic(1, frameCount = 100).brighten(0.5)
+    cache = reflect.cache.SpecialisedCache(100*1024*1024)
+    reflect.cache.Cache.current().swap(cache)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+
+    prefetcher = reflect.Prefetcher(workerCount = 3, lookahead = 10)
+    prefetcher.start()
+    try:
+      prefetcher.update(y, 50, -3, loop = False)
+      self.assertTrue(prefetcher.waitUntilIdle(timeout = 10))
+      self.assertEqual([n for n in range(y.frameCount) if cache.contains(y, n)], list(range(20, 50, 3)))
+
+      # Nothing is prefetched while the script is running
+      cache.userScriptIsRunning = True
+      prefetcher.update(y, 0, 1)
+      self.assertTrue(prefetcher.waitUntilIdle(timeout = 10))
+      cache.userScriptIsRunning = False
+      self.assertFalse(any(cache.contains(y, n) for n in range(0, 11)))
+    finally:
+      prefetcher.stop()
+
+
+
+class MemoryTestCase(unittest.TestCase):
+
+  def test_meminfo(self):
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      filepath = os.path.join(directory, "meminfo")
+      with open(filepath, "w") as f:
+        f.write("MemTotal:        8000000 kB\nMemFree:          500000 kB\nMemAvailable:    2000000 kB\nHugePages_Total:       0\n")
+      meminfo = reflect.memory.readMeminfo(filepath)
+      self.assertEqual(meminfo["MemTotal"], 8000000 * 1024)
+      self.assertEqual(meminfo["MemAvailable"], 2000000 * 1024)
+      self.assertEqual(meminfo["HugePages_Total"], 0)
+      self.assertEqual(reflect.memory.readMeminfo(os.path.join(directory, "missing")), {})
+
+
+
+  def test_cgroups(self):
+    import os
+    import tempfile
+
+    def write(filepath, contents):
+      os.makedirs(os.path.dirname(filepath), exist_ok = True)
+      with open(filepath, "w") as f:
+        f.write(contents)
+
+    with tempfile.TemporaryDirectory() as directory:
+      # cgroup v2, where a parent's limit is lower than the process's own
+      root = os.path.join(directory, "v2")
+      write(os.path.join(root, "cgroup.controllers"), "cpu memory\n")
+      write(os.path.join(root, "parent", "memory.max"), "1000000\n")
+      write(os.path.join(root, "parent", "child", "memory.max"), "max\n")
+      write(os.path.join(root, "parent", "child", "memory.current"), "600000\n")
+      write(os.path.join(root, "parent", "child", "memory.stat"), "anon 400000\ninactive_file 100000\nactive_file 100000\n")
+      write(os.path.join(directory, "cgroup2"), "0::/parent/child\n")
+      self.assertEqual(reflect.memory.readCgroupMemory(root, os.path.join(directory, "cgroup2")), (1000000, 500000))
+
+      # cgroup v1, limited and unlimited
+      root = os.path.join(directory, "v1")
+      write(os.path.join(root, "memory", "docker", "abc", "memory.limit_in_bytes"), "2000000\n")
+      write(os.path.join(root, "memory", "docker", "abc", "memory.usage_in_bytes"), "900000\n")
+      write(os.path.join(root, "memory", "docker", "abc", "memory.stat"), "cache 300000\ntotal_inactive_file 200000\n")
+      write(os.path.join(directory, "cgroup1"), "12:cpu,cpuacct:/docker/abc\n4:memory:/docker/abc\n")
+      self.assertEqual(reflect.memory.readCgroupMemory(root, os.path.join(directory, "cgroup1")), (2000000, 700000))
+      write(os.path.join(root, "memory", "docker", "abc", "memory.limit_in_bytes"), "9223372036854771712\n")
+      self.assertEqual(reflect.memory.readCgroupMemory(root, os.path.join(directory, "cgroup1"))[0], None)
+
+
+
+class TraceTestCase(unittest.TestCase):
+
+  @reflect_session
+  def test_replay_matches_recording(self):
+    import os
+    import tempfile
+    for cacheKind in [reflect.cache.SpecialisedCache, reflect.cache.LRUCache]:
+      cache = cacheKind(6 * 64 * 48 * 3, enableStatistics = True)
+      reflect.cache.Cache.current().swap(cache)
+      with tempfile.TemporaryDirectory() as directory:
+        filepath = os.path.join(directory, "trace.bin")
+        cache.startTrace(filepath)
+        for seed in [1, 2]:
+          reflect.CompositionGraph.reset()
+          y = synthetic(1, frameCount = 8).brighten(0.1 * seed).blur(3)
+          cache.reprioritise(reflect.CompositionGraph.current())
+          cache.commit()
+          for loop in range(2):
+            for n in range(y.frameCount):
+              y.frame(n)
+        cache.stopTrace()
+
+        records = list(reflect.readTrace(filepath))
+        self.assertEqual(len([r for r in records if r[0] == "session"]), 2)
+        self.assertEqual(len([r for r in records if r[0] == "node"]), 5) # The root is shared between the sessions
+
+        # Replaying the trace against the same algorithm and capacity gives the same results
+        ((algorithm, capacity, result),) = reflect.simulate(filepath, algorithms = [[k for k, v in reflect.cache.cacheAlgorithms.items() if v is cacheKind][0]], capacities = [cache.maxSize])
+        self.assertEqual(result["hits"], cache._stats["hits"])
+        self.assertEqual(result["misses"], cache._stats["misses"]["compulsory"] + cache._stats["misses"]["noncompulsory"])
+        self.assertGreater(result["renderTime"], 0)
+
+        # A cache that can hold everything only misses each frame once
+        ((algorithm, capacity, result),) = reflect.simulate(filepath, algorithms = ["lru"], capacities = [1024 * 1024 * 1024])
+        self.assertEqual(result["misses"], 3 * 8 + 2 * 8)
+
+
+
+class DiskTierTestCase(unittest.TestCase):
+
+  def test_fingerprint_is_stable_across_processes(self):
+    import subprocess
+    import os
+    code = "import reflect; m = reflect.core.clips.VideoClipMetadata(size = (1920, 1080), frameCount = 100, fps = 30); print(reflect.core.clips.VideoClip('source', m).fingerprint)"
+    fingerprints = set()
+    for seed in ["1", "2"]:
+      env = dict(os.environ, PYTHONHASHSEED = seed)
+      fingerprints.add(subprocess.check_output([sys.executable, "-c", code], env = env).strip())
+    self.assertEqual(len(fingerprints), 1)
+
+
+
+  @reflect_session
+  def test_fingerprint(self):
+    x = synthetic(1)
+    self.assertEqual(x.brighten(0.5).fingerprint, synthetic(1).brighten(0.5).fingerprint)
+    self.assertNotEqual(x.brighten(0.5).fingerprint, x.brighten(0.25).fingerprint)
+    self.assertNotEqual(x.brighten(0.5).fingerprint, synthetic(2).brighten(0.5).fingerprint)
+
+    # Frames of greyscale clips rendered by the old (truncating) kernel must not be reused
+    import hashlib
+    y = x.greyscale()
+    oldDescription = (type(y).__name__, (x.fingerprint,), y.size, y.frameCount, y.fps, ())
+    self.assertNotEqual(y.fingerprint, hashlib.sha1(repr(oldDescription).encode("utf-8")).hexdigest())
+    self.assertNotEqual(y.fingerprint, x.greyscale(lazy = True).fingerprint)
+
+
+
+  def test_persistence(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      images = [numpy.full((48, 64, 3), i, dtype = numpy.uint8) for i in range(5)]
+      tier = reflect.DiskTier(directory, 3 * images[0].nbytes)
+      for i, image in enumerate(images):
+        tier.put("k{}".format(i), image)
+      self.assertEqual(len(tier), 3) # The two least recently used frames have been dropped
+      self.assertIsNone(tier.get("k0"))
+      tier.close()
+
+      tier = reflect.DiskTier(directory, 3 * images[0].nbytes)
+      for i in range(2, 5):
+        self.assertTrue(numpy.array_equal(tier.get("k{}".format(i)), images[i]))
+      tier.close()
+
+
+
+  def test_compaction(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      images = [numpy.full((48, 64, 3), i, dtype = numpy.uint8) for i in range(20)]
+      tier = reflect.DiskTier(directory, 4 * images[0].nbytes)
+      for i, image in enumerate(images):
+        tier.put("k{}".format(i), image)
+      self.assertLessEqual(tier._fileSize, 2 * tier.maxSize)
+      for i in range(16, 20):
+        self.assertTrue(numpy.array_equal(tier.get("k{}".format(i)), images[i]))
+      tier.close()
+
+
+
+  @reflect_session
+  def test_frames_survive_restart(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      def session():
+        cache = reflect.cache.SpecialisedCache(100*1024*1024)
+        cache.attachTier(reflect.DiskTier(directory, 100*1024*1024))
+        reflect.cache.Cache.current().swap(cache)
+        reflect.CompositionGraph.reset()
+        cache.userScriptIsRunning = True
+        y = synthetic(1).brighten(0.5)
+        cache.userScriptIsRunning = False
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+        return (cache, y)
+
+      (cache, y) = session()
+      images = [y.frame(n) for n in range(y.frameCount)]
+      cache.close()
+
+      (cache, y) = session()
+      for n, image in enumerate(images):
+        self.assertTrue(numpy.array_equal(cache.get(y, n), image))
+      cache.close()
+
+
+
+class CompressedTierTestCase(unittest.TestCase):
+
+  def test_lossless_round_trip(self):
+    tier = reflect.CompressedTier(1024*1024)
+    image = numpy.full((48, 64, 3), 7, dtype = numpy.uint8)
+    image[10:20, 10:20] = 200
+    tier.put("k", image)
+    self.assertTrue(numpy.array_equal(tier.get("k"), image))
+    self.assertLess(tier.currentSize, image.nbytes)
+    self.assertIsNone(tier.get("missing"))
+    self.assertEqual((tier.hits, tier.misses), (1, 1))
+
+
+
+  def test_lossy_round_trip(self):
+    tier = reflect.CompressedTier(1024*1024, codec = "jpeg")
+    image = numpy.zeros((48, 64, 3), dtype = numpy.uint8)
+    image[:, :, 0] = 255 # Pure red, which shouldn't come back as blue
+    tier.put("k", image)
+    decoded = tier.get("k")
+    self.assertEqual(decoded.shape, image.shape)
+    self.assertLess(numpy.abs(decoded.astype(int) - image).max(), 8)
+
+
+
+  def test_spills_into_lower_tier(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      images = [numpy.random.RandomState(i).randint(0, 256, (48, 64, 3)).astype(numpy.uint8) for i in range(5)]
+      tier = reflect.CompressedTier(3 * images[0].nbytes)
+      tier.lower = reflect.DiskTier(directory, 100*1024*1024)
+      for i, image in enumerate(images):
+        tier.put("k{}".format(i), image)
+      self.assertNotIn("k0", tier)
+      self.assertTrue(numpy.array_equal(tier.lower.get("k0"), images[0]))
+      tier.close()
+      self.assertEqual(len(tier.lower), 5)
+      tier.lower.close()
+
+
+
+  @reflect_session
+  def test_hit_avoids_rendering(self):
+    cache = reflect.cache.LRUCache(1, enableStatistics = True)
+    cache.attachTier(reflect.CompressedTier(100*1024*1024))
+    reflect.cache.Cache.current().swap(cache)
+    y = synthetic(1).brighten(0.5)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    image = y.frame(0) # Too big for the main cache, so it spills into the compressed tier
+
+    def fail(n):
+      raise AssertionError("frame {} was rendered again".format(n))
+    y._framegen = fail
+    self.assertTrue(numpy.array_equal(y.frame(0), image))
+    self.assertIn("compressed (zlib): 1 h", cache.stats())
+
+
+
+class SharedMemoryTierTestCase(unittest.TestCase):
+
+  def setUp(self):
+    import uuid
+    self.name = "reflect-test-{}".format(uuid.uuid4().hex[:8])
+
+
+
+  def tearDown(self):
+    import os
+    import tempfile
+    lockFilepath = os.path.join(tempfile.gettempdir(), "{}.lock".format(self.name))
+    if os.path.exists(lockFilepath):
+      os.remove(lockFilepath)
+
+
+
+  def test_round_trip_between_attachments(self):
+    images = [numpy.random.RandomState(i).randint(0, 256, (48, 64, 3)).astype(numpy.uint8) for i in range(3)]
+    owner = reflect.SharedMemoryTier(self.name, 1024*1024)
+    other = reflect.SharedMemoryTier(self.name)
+    self.assertTrue(owner.created)
+    self.assertFalse(other.created)
+    self.assertEqual(other.maxSize, 1024*1024)
+
+    owner.put("k0", images[0])
+    other.put("k1", images[1])
+    other.put("k2", images[2].astype(numpy.float32))
+    self.assertTrue(numpy.array_equal(other.get("k0"), images[0]))
+    self.assertTrue(numpy.array_equal(owner.get("k1"), images[1]))
+    self.assertEqual(owner.get("k2").dtype, numpy.float32)
+    self.assertIsNone(owner.get("missing"))
+    self.assertEqual(len(owner), 3)
+
+    other.close()
+    owner.close()
+    with self.assertRaises(ValueError):
+      reflect.SharedMemoryTier(self.name) # The owner unlinked it
+
+
+
+  def test_ring_spills_into_lower_tier(self):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+      images = [numpy.random.RandomState(i).randint(0, 256, (48, 64, 3)).astype(numpy.uint8) for i in range(5)]
+      tier = reflect.SharedMemoryTier(self.name, 3 * images[0].nbytes + 100, maxFrames = 8)
+      tier.lower = reflect.DiskTier(directory, 100*1024*1024)
+      for i, image in enumerate(images):
+        tier.put("k{}".format(i), image)
+      self.assertEqual(len(tier), 3)
+      self.assertNotIn("k1", tier)
+      self.assertTrue(numpy.array_equal(tier.get("k4"), images[4]))
+      self.assertTrue(numpy.array_equal(tier.lower.get("k1"), images[1]))
+      tier.close()
+      self.assertEqual(len(tier.lower), 5)
+      tier.lower.close()
+
+
+
+  def test_other_process_fills_cache(self):
+    import multiprocessing
+    tier = reflect.SharedMemoryTier(self.name, 1024*1024)
+    process = multiprocessing.get_context("spawn").Process(target = renderIntoSharedCache, args = (self.name, 3))
+    process.start()
+    process.join(60)
+    self.assertEqual(process.exitcode, 0)
+    self.assertTrue(numpy.array_equal(tier.get("k"), SyntheticVideoClip(3, (64, 48), 1)._framegen(0)))
+    tier.close()
+
+
+
+  @reflect_session
+  def test_rendered_frames_are_shared(self):
+    cache = reflect.cache.Cache.current()
+    tier = reflect.SharedMemoryTier(self.name, 1024*1024)
+    cache.attachTier(tier)
+    y = synthetic(1).brighten(0.5)
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    image = y.frame(0)
+
+    # Another process would find the frame under the same key, without rendering it
+    other = reflect.SharedMemoryTier(self.name)
+    self.assertTrue(numpy.array_equal(other.get(other.keyOf(y, 0)), image))
+    other.close()
+    tier.close()
+
+
+
+def renderIntoSharedCache(name, seed):
+  # Run in a separate process by SharedMemoryTierTestCase
+  tier = reflect.SharedMemoryTier(name)
+  tier.put("k", SyntheticVideoClip(seed, (64, 48), 1)._framegen(0))
+  tier.close()
+
+
+
 class EasingFunctionTestCase(unittest.TestCase):
 
   def test_defaults(self):
@@ -181,6 +1122,100 @@ class GraphTestCase(unittest.TestCase):
 
 
 
+  @reflect_session
+  def test_pointwise_fusion(self):
+    def nodesOf(graph):
+      nodes = {}
+      q = list(graph.leaves)
+      while q:
+        clip = q.pop()
+        nodes[id(clip)] = clip
+        if isinstance(clip._source, tuple):
+          q.extend(clip._source)
+      return list(nodes.values())
+
+    reflect.setMode("normal")
+    reflect.CompositionGraph.reset()
+    g = reflect.CompositionGraph.current()
+    x = synthetic(1, frameCount = 5)
+    a = x.brighten(0.3).greyscale().brighten(-0.2).greyscale().brighten(0.1)
+    b = x.brighten(-0.4) # Used by two clips, so it must not be absorbed into either chain
+    c = b.greyscale().brighten(0.5).composite(b.gaussianBlur(3).crop(x1 = 0, y1 = 0, x2 = 16, y2 = 16), x1 = 4, y1 = 4)
+    expected = [numpy.stack([leaf.frame(n) for n in range(leaf.frameCount)]) for leaf in [a, c]]
+    nodeCount = len(nodesOf(g))
+
+    g.fusePointwise()
+
+    self.assertEqual(len(g.leaves), 2)
+    leaves = sorted(g.leaves, key = lambda leaf: leaf.timestamp)
+    for leaf, frames in zip(leaves, expected):
+      self.assertTrue(numpy.array_equal(numpy.stack([leaf.frame(n) for n in range(leaf.frameCount)]), frames))
+    fused = [node for node in nodesOf(g) if isinstance(node, reflect.core.vfx.fuse.FusedColourVideoClip)]
+    self.assertEqual(len(fused), 2)
+    self.assertTrue(any(node._source[0] is x for node in fused))
+    self.assertTrue(any(node._source[0] is b for node in fused))
+    self.assertLess(len(nodesOf(g)), nodeCount)
+
+    # A lazy greyscale isn't fused, so its frames are still views of a single channel, but the
+    # effects beneath it are
+    reflect.CompositionGraph.reset()
+    g = reflect.CompositionGraph.current()
+    lazy = synthetic(2, frameCount = 5).brighten(0.3).brighten(-0.1).greyscale(lazy = True)
+    expected = numpy.stack([lazy.frame(n) for n in range(lazy.frameCount)])
+
+    g.fusePointwise()
+
+    (leaf,) = g.leaves
+    self.assertIsInstance(leaf, reflect.core.vfx.greyscale.GreyscaleVideoClip)
+    self.assertIsInstance(leaf._source[0], reflect.core.vfx.fuse.FusedColourVideoClip)
+    for n in range(leaf.frameCount):
+      image = leaf.frame(n)
+      self.assertEqual(image.strides[-1], 0)
+      self.assertFalse(image.flags.writeable)
+      self.assertTrue(numpy.array_equal(image, expected[n]))
+
+
+
+  def test_composite_flattening(self):
+    reflect.setMode("normal")
+    reflect.CompositionGraph.reset()
+    g = reflect.CompositionGraph.current()
+    x = synthetic(1, frameCount = 5)
+    a = synthetic(2, size = (20, 16), frameCount = 5)
+    b = synthetic(3, size = (30, 10), frameCount = 5)
+    c = synthetic(4, size = (8, 8), frameCount = 5)
+    d = synthetic(5, size = (12, 12), frameCount = 5)
+    e = synthetic(6, size = (4, 4), frameCount = 5) # Hidden behind c
+    s = synthetic(7, size = (16, 16), frameCount = 3) # Shorter than x
+    shared = x.composite(d, x1 = 40, y1 = 30) # Used by two clips, so it must not be absorbed
+    y = x.composite(a, x1 = -4, y1 = 2).composite(b, x1 = 10, y1 = 8).composite(e, x1 = 14, y1 = 12).composite(c, x1 = 12, y1 = 10).composite(a.greyscale(), x1 = 50, y1 = 40)
+    z = shared.composite(c, x1 = 0, y1 = 0)
+    w = shared.composite(b, x1 = 0, y1 = 0)
+    v = x.composite(s, n1 = 0, n2 = 5).composite(d, x1 = 2, y1 = 2)
+    expected = [numpy.stack([leaf.frame(n) for n in range(leaf.frameCount)]) for leaf in [y, z, w, v]]
+
+    g.flattenComposites()
+
+    self.assertEqual(len(g.leaves), 4)
+    leaves = sorted(g.leaves, key = lambda leaf: leaf.timestamp)
+    for leaf, frames in zip(leaves, expected):
+      self.assertTrue(numpy.array_equal(numpy.stack([leaf.frame(n) for n in range(leaf.frameCount)]), frames))
+      self.assertTrue(numpy.array_equal(numpy.stack([leaf.frame(n, (6, 4, 30, 20)) for n in range(leaf.frameCount)]), frames[:, 4:20, 6:30]))
+    self.assertIsInstance(leaves[0], reflect.core.vfx.layered.LayeredCompositeVideoClip)
+    self.assertIs(leaves[0]._source[0], x)
+    self.assertEqual(len(leaves[0]._source), 6)
+    self.assertIs(leaves[1], z)
+    self.assertIs(leaves[2], w)
+    self.assertIs(leaves[3], v) # A composite with a short foreground can't become a layer
+
+    # The hidden layer is never rendered
+    requests = []
+    e.frame = lambda n, region = None: requests.append(n)
+    leaves[0].frame(0)
+    self.assertEqual(requests, [])
+
+
+
 class TimecodesTestCase(unittest.TestCase):
 
   def test_timecodes(self):
@@ -230,6 +1265,179 @@ class TimecodesTestCase(unittest.TestCase):
 
 class ClipsTestCase(unittest.TestCase):
 
+  @reflect_session
+  def test_batched_frames(self):
+    def script():
+      x = synthetic(1, frameCount = 20)
+      z = x.brighten(0.3).crop(x1 = 5, y1 = 10, x2 = 40, y2 = 30)
+      return [z, z.reverse(), z.subclip(3, 15), z.speed(0.6), x.brighten(-0.2).greyscale(), x.greyscale(lazy = True)]
+
+    for mode in ["normal", "server"]:
+      reflect.setMode(mode)
+      reflect.CompositionGraph.reset()
+      clips = script()
+      if mode == "server":
+        cache = reflect.cache.Cache.current()
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+        clips[0].frame(4) # Mix cached and uncached frames
+
+      for clip in clips:
+        expected = numpy.stack([clip.frame(n) for n in range(clip.frameCount)])
+        for start, stop in [(0, clip.frameCount), (1, clip.frameCount - 1), (2, 2)]:
+          frames = clip.frames(start, stop)
+          self.assertEqual(frames.shape, (stop - start, clip.height, clip.width, 3))
+          self.assertTrue(numpy.array_equal(frames, expected[start:stop]), "{} in {} mode".format(clip, mode))
+        with self.assertRaises(IndexError):
+          clip.frames(0, clip.frameCount + 1)
+
+    # Concatenations are built directly, since concat() relies on collections.Iterable
+    reflect.setMode("normal")
+    x = synthetic(1, frameCount = 12)
+    y = synthetic(2, frameCount = 8).greyscale()
+    metadata = reflect.core.clips.VideoClipMetadata(size = x.size, frameCount = 20, fps = 30)
+    clip = reflect.core.vfx.concat.ConcatenatedVideoClip((x, y), metadata)
+    ns = [19, 0, 11, 12, 5, 12]
+    self.assertTrue(numpy.array_equal(clip._frames(ns), numpy.stack([clip.frame(n) for n in ns])))
+
+
+
+  @reflect_session
+  def test_regions(self):
+    reflect.setTransformations([]) # Keep the crops above the effects that they crop
+    x = synthetic(1, size = (96, 60), frameCount = 4)
+    y = synthetic(2, size = (96, 60), frameCount = 4)
+    metadata = reflect.core.clips.VideoClipMetadata(size = x.size, frameCount = 4, fps = 30)
+    slide = reflect.core.clips.clipMethod(reflect.core.vfx.slide.SlideTransitionVideoClip) # Without slide's concats
+    clips = [
+      x.gaussianBlur(7),
+      x.blur((4, 3)).brighten(0.2),
+      x.resize((48, 30)),
+      x.resize((144, 90), interpolation = cv2.INTER_CUBIC),
+      x.resize((64, 40)).greyscale().resize((96, 60), interpolation = cv2.INTER_LINEAR),
+      x.composite(y.gaussianBlur(5).crop(x1 = 10, y1 = 5, x2 = 50, y2 = 45), x1 = 60, y1 = -10),
+      slide((x.blur(3), y.gaussianBlur(3)), metadata, "left", 4, [0.0, 0.3, 0.8, 1.0]),
+      slide((x, y.reverse()), metadata, "bottom", 4, [0.1, 0.5, 0.6, 0.9]),
+    ]
+
+    random = numpy.random.RandomState(0)
+    for mode in ["normal", "server"]:
+      reflect.setMode(mode)
+      if mode == "server":
+        cache = reflect.cache.Cache.current()
+        cache.reprioritise(reflect.CompositionGraph.current())
+        cache.commit()
+      for clip in clips:
+        for n in range(clip.frameCount):
+          x1 = random.randint(0, clip.width - 1)
+          y1 = random.randint(0, clip.height - 1)
+          (x2, y2) = (random.randint(x1 + 1, clip.width + 1), random.randint(y1 + 1, clip.height + 1))
+          part = clip.frame(n, (x1, y1, x2, y2))
+          self.assertTrue(numpy.array_equal(part, clip.frame(n)[y1:y2, x1:x2]), "{} in {} mode".format(clip, mode))
+
+    # Only the pixels that the crop depends on are requested from upstream
+    reflect.setMode("normal")
+    regions = []
+    frame = x.frame
+    x.frame = lambda n, region = None: regions.append(region) or frame(n, region)
+    x.gaussianBlur(5).crop(x1 = 40, y1 = 0, x2 = 50, y2 = 10).frame(0)
+    self.assertEqual(regions[0], (38, 0, 52, 12))
+
+
+
+  @reflect_session
+  def test_occlusion(self):
+    reflect.setMode("normal")
+    x = synthetic(1, size = (64, 48), frameCount = 6)
+    y = synthetic(2, size = (64, 48), frameCount = 6)
+    z = synthetic(3, size = (80, 60), frameCount = 8)
+
+    # A foreground that covers the whole background replaces the composite
+    self.assertIs(x.composite(y), y)
+    self.assertIs(x.composite(x.crop(x1 = 0, y1 = 0, x2 = 16, y2 = 16), x1 = 4, y1 = 4).composite(y), y)
+    covered = x.composite(z, x1 = -10, y1 = -5, n1 = 0, n2 = 6)
+    self.assertNotIsInstance(covered, reflect.core.vfx.composite.CompositeVideoClip)
+    self.assertEqual((covered.size, covered.frameCount), (x.size, x.frameCount))
+    self.assertTrue(numpy.array_equal(covered.frame(3), z.frame(3)[5:53, 10:74]))
+    self.assertEqual(reflect.CompositionGraph.current().leaves, { y, covered })
+
+    # Otherwise only the uncovered parts of the background are requested
+    bg = x.gaussianBlur(5)
+    regions = []
+    frame = bg.frame
+    bg.frame = lambda n, region = None: regions.append(region) or frame(n, region)
+    fgRegion = (8, 10, 8 + 40, 10 + 30)
+    composite = bg.composite(z.crop(x1 = 0, y1 = 0, x2 = 40, y2 = 30), x1 = 8, y1 = 10, n1 = 0, n2 = 6)
+    expected = frame(2).copy()
+    expected[10:40, 8:48] = z.frame(2)[0:30, 0:40]
+    self.assertTrue(numpy.array_equal(composite.frame(2), expected))
+    self.assertEqual(len(regions), 4)
+    for region in regions:
+      self.assertIsNone(reflect.core.util.intersectRegions(region, fgRegion))
+    self.assertEqual(sum((x2 - x1) * (y2 - y1) for (x1, y1, x2, y2) in regions), 64 * 48 - 40 * 30)
+
+
+
+  @reflect_session
+  def test_lazy_greyscale(self):
+    reflect.setMode("normal")
+    x = synthetic(1, frameCount = 3)
+    grey = x.greyscale()
+    lazy = x.greyscale(lazy = True)
+    self.assertNotEqual(grey, lazy)
+
+    image = x.frame(1)
+    expected = numpy.dot(image, [0.299, 0.587, 0.114])
+    frame = lazy.frame(1)
+    self.assertTrue(numpy.array_equal(frame, grey.frame(1)))
+    self.assertLess(numpy.abs(frame[:, :, 0] - expected).max(), 1)
+    self.assertEqual(frame.strides[2], 0)
+    self.assertFalse(frame.flags.writeable)
+
+    # Effects that write into their source frames copy them first
+    composite = lazy.composite(x.crop(x1 = 0, y1 = 0, x2 = 8, y2 = 8), x1 = 2, y1 = 2)
+    self.assertTrue(numpy.array_equal(composite.frame(1)[2:10, 2:10], image[0:8, 0:8]))
+    self.assertTrue(numpy.array_equal(composite.frame(1)[12:], grey.frame(1)[12:]))
+
+
+
+  @reflect_session
+  def test_pickling(self):
+    import pickle
+    y = synthetic(1, frameCount = 8).brighten(0.2).crop(x1 = 4, y1 = 4, x2 = 20, y2 = 20).reverse()
+    cache = reflect.cache.Cache.current()
+    cache.reprioritise(reflect.CompositionGraph.current())
+    cache.commit()
+    y.frame(0)
+
+    # The copy leaves the graph and the cache behind, but renders the same frames
+    copy = pickle.loads(pickle.dumps(y))
+    self.assertIsNone(copy._source[0].cacheEntry)
+    self.assertFalse(hasattr(copy, "_graph"))
+    self.assertEqual(copy.fingerprint, y.fingerprint)
+    reflect.setMode("normal")
+    self.assertTrue(numpy.array_equal(copy.frames(), y.frames()))
+
+
+
+  @unittest.skipUnless(shutil.which("ffmpeg") or importlib.util.find_spec("imageio_ffmpeg"), "requires ffmpeg")
+  def test_parallel_save(self):
+    import os
+    import tempfile
+    reflect.setMode("normal")
+    reflect.CompositionGraph.reset()
+    y = synthetic(1, size = (64, 48), frameCount = 30).brighten(0.2)
+    with tempfile.TemporaryDirectory() as directory:
+      y.save(os.path.join(directory, "serial.mkv"), codec = "ffv1", pixelformat = "bgr0")
+      y.save(os.path.join(directory, "parallel.mkv"), codec = "ffv1", pixelformat = "bgr0", workers = 3)
+      serial = imageio.get_reader(os.path.join(directory, "serial.mkv"))
+      parallel = imageio.get_reader(os.path.join(directory, "parallel.mkv"))
+      self.assertEqual(parallel.count_frames(), 30)
+      for a, b in zip(serial, parallel):
+        self.assertTrue(numpy.array_equal(a, b))
+
+
+
   def test_memoisation(self):
     memoizeHash = reflect.core.clips.memoizeHash
 